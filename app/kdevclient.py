@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# Thin kdevimg client for the build daemon
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+# Only the standard library is imported here, startup time is the point.
+import os
+import sys
+import json
+import socket
+
+def socket_path():
+    return os.environ.get("KDEV_SOCKET", os.path.join(os.path.expanduser("~"), '.kdev', 'kdevimg.sock'))
+
+def main():
+    argv = sys.argv[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(socket_path())
+    except socket.error:
+        if argv == ['--stop']:
+            return 0
+        # No daemon, run the command the slow way.
+        os.execvp('kdevimg', ['kdevimg'] + argv)
+
+    if argv == ['--stop']:
+        request = {"stop": True}
+    else:
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+
+    sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    code = 1
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if len(chunk) == 0:
+            break
+        data += chunk
+        lines = data.split(b'\n')
+        data = lines.pop()
+        for line in lines:
+            msg = json.loads(line.decode('utf-8'))
+            if "out" in msg:
+                sys.stdout.write(msg["out"])
+                sys.stdout.flush()
+            elif "exit" in msg:
+                code = msg["exit"]
+
+    sock.close()
+
+    return code
+
+if __name__ == '__main__':
+    sys.exit(main())
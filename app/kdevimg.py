@@ -24,59 +24,79 @@
 import os
 import click
 import logging
-from kdev import KdevBuild, get_recipe_name
-import pkg_resources
+import sys
 import fnmatch
+from kdev import KdevBuild, RecipeIndex, BuildMatrix, BuildDaemon, RemoteWorker
+from kdev._daemon import socket_path
+from kdev._jobs import parse_size
+import pkg_resources
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(message)s')
 logger.setLevel(logging.INFO)
 
+# Recipe index and build objects outlive a single command when running as
+# a daemon, which is what makes repeated invocations cheap.
+_warm = {"serving": False, "index": None, "builds": {}}
+
 @click.group(chain=True)
-@click.option('--kernel-src', '-k', type=click.Path(), default=os.path.join(os.getcwd(), 'kernel'), help='Kernel source')
-@click.option('--out', '-o', type=click.Path(), default=os.path.join(os.getcwd(), 'out'), help='Out directory')
-@click.option('--rootfs-src', type=click.Path(), default=os.path.join(os.getcwd(), 'rootfs'), help='Rootfs source')
+@click.option('--kernel-src', '-k', type=click.Path(), default=None, help='Kernel source (default: ./kernel)')
+@click.option('--out', '-o', type=click.Path(), default=None, help='Out directory (default: ./out)')
+@click.option('--rootfs-src', type=click.Path(), default=None, help='Rootfs source (default: ./rootfs)')
 @click.option('--recipe-dir', '-r', type=click.Path(), default=None, help='Recipe Directory')
 @click.option('--recipe-root', type=click.Path(), default=(), multiple=True, help='Additional recipe root')
+@click.option('--jobs', '-j', type=int, default=0,
+              help='Job budget shared by parallel build stages (0 = sized from cpus, cpu quota and memory)')
+@click.option('--load-average', '-l', type=float, default=None, help='Start no new make jobs above this load')
+@click.option('--cache-dir', type=click.Path(), default=os.path.join(os.path.expanduser("~"), '.kdev-cache'),
+              help='Stage cache directory')
+@click.option('--cache/--no-cache', default=True, help='Reuse unchanged stage outputs from the stage cache')
+@click.option('--cache-size', default='20G', help='Prune least recently used stage cache entries above this size')
+@click.option('--mirror-dir', type=click.Path(), default=os.path.join(os.path.expanduser("~"), '.kdev-mirrors'),
+              help='Local git mirrors of rootfs sources')
+@click.option('--remote', default=None, envvar='KDEV_REMOTE',
+              help='Build workers for kernel builds, host:port or unix:path, comma separated')
+@click.option('--offline/--no-offline', default=False, help='Build from the local mirrors without fetching')
 @click.option('--debug/--no-debug', default=False)
 @click.pass_context
-def cli(ctx, kernel_src, out, rootfs_src, recipe_dir, recipe_root, debug):
+def cli(ctx, kernel_src, out, rootfs_src, recipe_dir, recipe_root, jobs, load_average, cache_dir, cache, cache_size,
+        mirror_dir, remote, offline, debug):
+    # Defaults are resolved per command, a daemon serves clients in different dirs.
     ctx.obj = {}
-    ctx.obj['KSRC'] = kernel_src
-    ctx.obj['OUT'] = out
-    ctx.obj['ROOTFS_SRC'] = rootfs_src
+    ctx.obj['KSRC'] = os.path.abspath(kernel_src or 'kernel')
+    ctx.obj['OUT'] = os.path.abspath(out or 'out')
+    ctx.obj['ROOTFS_SRC'] = os.path.abspath(rootfs_src or 'rootfs')
     ctx.obj['RECIPE_DIR'] = recipe_dir
     ctx.obj['RECIPE_ROOT'] = list(recipe_root)
+    ctx.obj['JOBS'] = jobs
+    ctx.obj['LOAD'] = load_average
+    ctx.obj['CACHE_DIR'] = cache_dir if cache else None
+    ctx.obj['CACHE_SIZE'] = parse_size(cache_size)
+    ctx.obj['MIRROR_DIR'] = mirror_dir
+    ctx.obj['REMOTE'] = remote
     ctx.obj['DEBUG'] = debug
 
     ctx.obj['RECIPE_ROOT'].append(os.path.join(os.path.expanduser("~"), '.kdev-recipes'))
     ctx.obj['RECIPE_ROOT'].append(pkg_resources.resource_filename('kdev', 'recipes'))
 
-    if ctx.obj['DEBUG']:
-        logger.level = logging.DEBUG
-
-    def recursive_glob(treeroot, pattern):
-        results = []
-        logger.info("Root: %s Pattern: %s", treeroot, pattern)
-        for base, dirs, files in os.walk(treeroot):
-            goodfiles = fnmatch.filter(files, pattern)
-            results.extend(os.path.join(base, f) for f in goodfiles)
-        return results
+    logger.setLevel(logging.DEBUG if ctx.obj['DEBUG'] else logging.INFO)
 
-    if ctx.obj['RECIPE_DIR'] is None:
-        recipe_list = []
-        config_list = []
+    if offline:
+        os.environ["KDEV_OFFLINE"] = "1"
 
-        for root in ctx.obj['RECIPE_ROOT']:
-            if os.path.exists(root):
-                config_list += recursive_glob(root, 'board.json')
+def get_build(ctx):
+    # Recipe selection only happens for commands which work on one recipe.
+    if 'OBJ' in ctx.obj:
+        return ctx.obj['OBJ']
 
-        config_list = reduce(lambda l, x: l if x in l else l + [x], config_list, [])
+    rindex = get_index()
 
-        for config in config_list:
-            recipe_list.append((get_recipe_name(os.path.dirname(config), logger), os.path.dirname(config)))
+    if ctx.obj['RECIPE_DIR'] is None and _warm["serving"]:
+        logger.error("The build daemon can not prompt for a recipe, pass --recipe-dir")
+        raise AttributeError
 
-        recipe_list = reduce(lambda l, x: l if x[0] in [i[0] for i in l] else l + [x], recipe_list, [])
+    if ctx.obj['RECIPE_DIR'] is None:
+        recipe_list = rindex.discover(ctx.obj['RECIPE_ROOT'])
 
         if len(recipe_list) > 0:
             print("select one of the following recipe")
@@ -94,55 +114,178 @@ def cli(ctx, kernel_src, out, rootfs_src, recipe_dir, recipe_root, debug):
         logger.error("No valid recipe found")
         raise AttributeError
 
-    ctx.obj['OBJ'] = KdevBuild(kernel_dir=ctx.obj['KSRC'], rootfs_dir=ctx.obj['ROOTFS_SRC'], recipe_dir=ctx.obj['RECIPE_DIR'],
-                               out_dir=ctx.obj['OUT'], logger=logger)
+    recipecfg = rindex.get_cfg(ctx.obj['RECIPE_DIR'])
+    rindex.save()
+
+    key = (ctx.obj['KSRC'], ctx.obj['ROOTFS_SRC'], os.path.abspath(ctx.obj['RECIPE_DIR']), ctx.obj['OUT'],
+           ctx.obj['CACHE_DIR'], ctx.obj['CACHE_SIZE'], ctx.obj['MIRROR_DIR'], ctx.obj['REMOTE'], ctx.obj['LOAD'])
+    obj = _warm["builds"].get(key)
+
+    if obj is not None and obj.recipecfg == recipecfg:
+        obj.new_report()
+    else:
+        obj = KdevBuild(kernel_dir=ctx.obj['KSRC'], rootfs_dir=ctx.obj['ROOTFS_SRC'], recipe_dir=ctx.obj['RECIPE_DIR'],
+                        out_dir=ctx.obj['OUT'], cache_dir=ctx.obj['CACHE_DIR'], recipecfg=recipecfg,
+                        mirror_dir=ctx.obj['MIRROR_DIR'], remote=ctx.obj['REMOTE'], load=ctx.obj['LOAD'],
+                        cache_size=ctx.obj['CACHE_SIZE'], logger=logger)
+        if _warm["serving"]:
+            _warm["builds"][key] = obj
+
+    ctx.obj['OBJ'] = obj
+
+    return ctx.obj['OBJ']
+
+def get_index():
+    if _warm["index"] is None:
+        _warm["index"] = RecipeIndex(logger=logger)
+
+    return _warm["index"]
 
 @cli.command('build-kernel', short_help='build only kernel')
 @click.pass_context
 def build_kernel(ctx):
-    click.echo('Building kernel for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(kbuild=True)
+    click.echo('Building kernel for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(kbuild=True, jobs=ctx.obj['JOBS'])
 
 @cli.command('build-rootfs', short_help='build only rootfs')
 @click.pass_context
 def build_rootfs(ctx):
-    click.echo('Building rootfs for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(rbuild=True)
+    click.echo('Building rootfs for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(rbuild=True, jobs=ctx.obj['JOBS'])
 
 @cli.command('update-rootfs', short_help='Update rootfs')
 @click.pass_context
 def update_rootfs(ctx):
-    click.echo('Updating rootfs for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(rupdate=True)
+    click.echo('Updating rootfs for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(rupdate=True, jobs=ctx.obj['JOBS'])
 
 @cli.command('build-initramfs', short_help='build only initramfs')
 @click.pass_context
 def build_initramfs(ctx):
-    click.echo('Building initramfs for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(ibuild=True)
+    click.echo('Building initramfs for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(ibuild=True, jobs=ctx.obj['JOBS'])
 
 @cli.command('update-initramfs', short_help='Update initramfs')
 @click.pass_context
 def update_initramfs(ctx):
-    click.echo('Updating initramfs for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(iupdate=True)
+    click.echo('Updating initramfs for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(iupdate=True, jobs=ctx.obj['JOBS'])
 
 @cli.command('gen-image', short_help='Generate images')
 @click.pass_context
 def gen_image(ctx):
-    click.echo('Generating image for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(gen_image=True)
+    click.echo('Generating image for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(gen_image=True, jobs=ctx.obj['JOBS'])
+
+@cli.command('build-modules', short_help='Rebuild changed modules with M= and update the images')
+@click.argument('dirs', nargs=-1, type=click.Path())
+@click.pass_context
+def build_modules(ctx, dirs):
+    click.echo('Building modules for recipe %s' % (get_build(ctx).recipename))
+    if not get_build(ctx).build_modules(list(dirs), jobs=ctx.obj['JOBS']):
+        sys.exit(1)
 
 @cli.command('burn-drive', short_help='Burn images to a device')
 @click.option('--dev', type=str, default=None, help='Device node /dev/<node>')
 @click.option('--force/--no-force', default=False)
+@click.option('--image', type=click.Path(exists=True), default=None, help='Flash this prebuilt disk image')
+@click.option('--full/--no-full', default=False, help='Rewrite every data block, ignoring the last flash of the device')
 @click.pass_context
-def burn_drive(ctx, dev, force):
-    click.echo('Generating image for recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].burn_drive(dev, force)
+def burn_drive(ctx, dev, force, image, full):
+    click.echo('Generating image for recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).burn_drive(dev, force, image, full)
+
+@cli.command('watch', short_help='Rebuild affected stages when sources or recipe files change')
+@click.option('--delay', type=float, default=0.5, help='Seconds without changes before a rebuild starts')
+@click.pass_context
+def watch(ctx, delay):
+    click.echo('Watching recipe %s' % (get_build(ctx).recipename))
+    while get_build(ctx).watch(delay, jobs=ctx.obj['JOBS']):
+        click.echo('Recipe %s changed, reloading' % (get_build(ctx).recipename))
+        ctx.obj.pop('OBJ')
+        get_build(ctx).build(kbuild=True, rbuild=True, ibuild=True, rupdate=True, iupdate=True, gen_image=True,
+                             jobs=ctx.obj['JOBS'])
+
+@cli.command('boot-test', short_help='Boot the built images in QEMU and check boot times')
+@click.option('--runs', type=int, default=1, help='Boots per test, the median is recorded')
+@click.option('--timeout', type=int, default=120, help='Seconds until a boot counts as hung')
+@click.option('--threshold', type=float, default=0.1, help='Slowdown against recent boots reported as regression')
+@click.pass_context
+def boot_test(ctx, runs, timeout, threshold):
+    click.echo('Boot testing recipe %s' % (get_build(ctx).recipename))
+    if not get_build(ctx).boot_test(runs, timeout, threshold):
+        sys.exit(1)
 
 @cli.command('build-all', short_help='build all')
 @click.pass_context
 def gen_image(ctx):
-    click.echo('Building recipe %s' % (ctx.obj['OBJ'].recipename))
-    ctx.obj['OBJ'].build(kbuild=True, rbuild=True, ibuild=True, rupdate=True, iupdate=True, gen_image=True)
+    click.echo('Building recipe %s' % (get_build(ctx).recipename))
+    get_build(ctx).build(kbuild=True, rbuild=True, ibuild=True, rupdate=True, iupdate=True, gen_image=True, jobs=ctx.obj['JOBS'])
+
+@cli.command('build-matrix', short_help='build several recipes without prompting')
+@click.argument('recipes', nargs=-1, required=True)
+@click.pass_context
+def build_matrix(ctx, recipes):
+    rindex = get_index()
+    known = rindex.discover(ctx.obj['RECIPE_ROOT'])
+    selected = []
+
+    # Recipes are given as names, name globs or recipe directories.
+    for pattern in recipes:
+        if os.path.exists(os.path.join(pattern, 'board.json')):
+            matches = [(rindex.get_name(pattern), os.path.abspath(pattern))]
+        else:
+            matches = [recipe for recipe in known if fnmatch.fnmatch(recipe[0], pattern)]
+        if len(matches) == 0:
+            logger.error("No recipe matches %s" % pattern)
+            sys.exit(1)
+        for name, recipe_dir in matches:
+            if name is not None and name not in [recipe[0] for recipe in selected]:
+                selected.append((name, recipe_dir, rindex.get_cfg(recipe_dir)))
+
+    rindex.save()
+
+    click.echo('Building recipes %s' % ' '.join([recipe[0] for recipe in selected]))
+
+    matrix = BuildMatrix(selected, kernel_dir=ctx.obj['KSRC'], rootfs_dir=ctx.obj['ROOTFS_SRC'],
+                         out_dir=ctx.obj['OUT'], cache_dir=ctx.obj['CACHE_DIR'], cache_size=ctx.obj['CACHE_SIZE'],
+                         jobs=ctx.obj['JOBS'], mirror_dir=ctx.obj['MIRROR_DIR'], remote=ctx.obj['REMOTE'],
+                         load=ctx.obj['LOAD'], logger=logger)
+    status = matrix.run()
+
+    summary = matrix.summary()
+    click.echo(summary)
+    if not os.path.exists(ctx.obj['OUT']):
+        os.makedirs(ctx.obj['OUT'])
+    with open(os.path.join(ctx.obj['OUT'], 'matrix-summary.txt'), 'w') as fp:
+        fp.write(summary + '\n')
+
+    if not status:
+        sys.exit(1)
+
+@cli.command('worker', short_help='Run kernel builds for other kdevimg hosts')
+@click.option('--listen', default='localhost:7450', help='host:port (needs a token) or unix:path to listen on')
+@click.option('--work-dir', type=click.Path(), default=os.path.join(os.path.expanduser("~"), '.kdev-worker'),
+              help='Blob store and build workspaces')
+@click.option('--token', default=None, envvar='KDEV_REMOTE_TOKEN', help='Shared secret clients have to send')
+@click.pass_context
+def worker(ctx, listen, work_dir, token):
+    jobs = ctx.obj['JOBS'] if ctx.obj['JOBS'] > 0 else None
+    if not RemoteWorker(listen, work_dir, token=token, jobs=jobs, logger=logger).serve():
+        sys.exit(1)
+
+@cli.command('serve', short_help='Keep recipes and build objects warm for kdevimg-client')
+@click.option('--socket', 'path', type=click.Path(), default=None, help='Unix socket (default: ~/.kdev/kdevimg.sock)')
+def serve(path):
+    def handler(argv):
+        try:
+            cli.main(args=argv, prog_name='kdevimg', standalone_mode=False)
+        except click.ClickException as e:
+            e.show()
+            return e.exit_code
+        return 0
+
+    _warm["serving"] = True
+    daemon = BuildDaemon(path or socket_path(), handler, logger=logger)
+    if not daemon.serve():
+        sys.exit(1)
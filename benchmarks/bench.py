@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmarks of kdev's own build overhead, run from the source tree with
+# PYTHONPATH=. python benchmarks/bench.py
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import sys
+import json
+import click
+import time
+import random
+import shutil
+import logging
+import tempfile
+import pkg_resources
+from klibs import is_valid_kernel
+from kdev._index import RecipeIndex, parse_recipe
+from kdev._kconfig import KconfigMap, update_config
+from kdev._treesync import TreeSync
+from kdev._manifest import TreeManifest, patch_ext_image
+from kdev._cpio import gen_cpio_image
+from kdev._diskimg import DiskImage, which
+from kdev._shell import ShellSession
+
+logger = logging.getLogger(__name__)
+
+# Busybox installs one binary and a symlink per applet.
+APPLETS = ['sh', 'ls', 'cat', 'cp', 'mv', 'rm', 'mount', 'umount', 'ifconfig', 'ip', 'ps', 'top', 'vi', 'grep',
+           'sed', 'awk', 'find', 'tar', 'gzip', 'dmesg', 'insmod', 'modprobe', 'init', 'getty', 'login']
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+class BenchFixtures(object):
+    def __init__(self, root, scale=1, seed=0):
+        self.root = root
+        self.scale = scale
+        self.random = random.Random(seed)
+        self.kernel = os.path.join(root, 'kernel')
+        self.recipes = os.path.join(root, 'recipes')
+        self.tree = os.path.join(root, 'tree')
+        self.config = os.path.join(root, 'kernel.config')
+
+    def _write(self, path, data):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    def make_kernel(self):
+        # Just the top level files a kernel source tree check looks at.
+        self._write(os.path.join(self.kernel, 'Makefile'),
+                    b'VERSION = 5\nPATCHLEVEL = 0\nSUBLEVEL = 0\nEXTRAVERSION =\nNAME = bench\n')
+        self._write(os.path.join(self.kernel, 'Kconfig'), b'mainmenu "Linux/$(ARCH) Kernel Configuration"\n')
+        for name in ['init/main.c', 'kernel/fork.c', 'arch/x86/Makefile', 'scripts/Kbuild.include']:
+            self._write(os.path.join(self.kernel, name), b'\n')
+
+    def make_recipes(self, count):
+        src = pkg_resources.resource_filename('kdev', 'recipes/qemu-x86_64')
+        for index in range(count * self.scale):
+            dst = os.path.join(self.recipes, "group%d" % (index % 8), "recipe%d" % index)
+            shutil.copytree(src, dst)
+            with open(os.path.join(dst, 'board.json')) as fp:
+                board = json.load(fp)
+            board["recipe-name"] = "bench-%d" % index
+            with open(os.path.join(dst, 'board.json'), 'w') as fp:
+                json.dump(board, fp, indent=4)
+
+    def make_config(self, symbols=6000):
+        lines = ["#", "# Automatically generated file; DO NOT EDIT.", "#"]
+        for index in range(symbols):
+            if index % 7 == 0:
+                lines.append("# CONFIG_BENCH_%d is not set" % index)
+            elif index % 5 == 0:
+                lines.append('CONFIG_BENCH_%d="value%d"' % (index, index))
+            else:
+                lines.append("CONFIG_BENCH_%d=%s" % (index, self.random.choice(['y', 'm'])))
+        self._write(self.config, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def make_tree(self, files=5000):
+        # Looks like a busybox install plus modules and firmware blobs.
+        self._write(os.path.join(self.tree, 'bin/busybox'), os.urandom(1024 * 1024))
+        for applet in APPLETS:
+            os.symlink('busybox', os.path.join(self.tree, 'bin', applet))
+
+        for index in range(files * self.scale):
+            path = os.path.join(self.tree, 'lib/modules/5.0.0/kernel/d%d/s%d/m%d.ko' % (index % 50, index % 7, index))
+            size = self.random.choice([0, 512, 4096, 16384, 65536])
+            self._write(path, os.urandom(size // 2) + b'\0' * (size - size // 2))
+
+    def create(self):
+        self.make_kernel()
+        self.make_recipes(32)
+        self.make_config()
+        self.make_tree()
+
+class BenchSuite(object):
+    def __init__(self, work_dir=None, scale=1, repeat=3, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.work_dir = work_dir
+        self.scale = scale
+        self.repeat = repeat
+        self.results = {}
+
+    def _time(self, name, func, setup=None):
+        times = []
+
+        for index in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.time()
+            if func() is False:
+                self.logger.error("Benchmark %s failed", name)
+                return
+            times.append(time.time() - start)
+
+        self.results[name] = median(times)
+        self.logger.info("%-28s %9.3fs", name, self.results[name])
+
+    def _rm(self, *paths):
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def run(self):
+        root = tempfile.mkdtemp(prefix='kdev-bench-', dir=self.work_dir)
+        try:
+            fx = BenchFixtures(root, self.scale)
+            start = time.time()
+            fx.create()
+            self.logger.info("Fixtures created in %.1fs", time.time() - start)
+            self._run(fx, root)
+        finally:
+            shutil.rmtree(root)
+
+        return self.results
+
+    def _run(self, fx, root):
+        index_file = os.path.join(root, 'index.json')
+        board = os.path.join(fx.recipes, 'group0', 'recipe0')
+
+        self._time('kernel-check', lambda: is_valid_kernel(fx.kernel, self.logger))
+        self._time('recipe-discover-cold', lambda: len(RecipeIndex(index_file).discover([fx.recipes])) > 0,
+                   lambda: self._rm(index_file))
+        self._time('recipe-discover-warm', lambda: len(RecipeIndex(index_file).discover([fx.recipes])) > 0)
+        self._time('schema-validate', lambda: parse_recipe(board) is not None)
+
+        fragments = ['CONFIG_BLK_DEV_INITRD=y', 'CONFIG_INITRAMFS_SOURCE=%s' % fx.tree,
+                     'CONFIG_INITRAMFS_ROOT_UID=0', 'CONFIG_INITRAMFS_ROOT_GID=0']
+        dotconfig = os.path.join(root, 'obj', '.config')
+        os.makedirs(os.path.dirname(dotconfig))
+
+        self._time('kconfig-merge', lambda: KconfigMap.load(fx.config).merge(fragments) is not None)
+        # The first update writes the config, the timed ones find it up to date.
+        update_config(fx.config, fragments, dotconfig, lambda: True, logger=self.logger)
+        self._time('kconfig-update-unchanged',
+                   lambda: update_config(fx.config, fragments, dotconfig, lambda: True, logger=self.logger) is False)
+
+        synced = os.path.join(root, 'synced')
+        self._time('treesync-full', lambda: TreeSync(logger=self.logger).sync(fx.tree, synced),
+                   lambda: self._rm(synced))
+        self._time('treesync-unchanged', lambda: TreeSync(logger=self.logger).sync(fx.tree, synced))
+        self._time('manifest-scan', lambda: TreeManifest.scan(fx.tree) is not None)
+
+        cpio = os.path.join(root, 'initramfs.cpio.gz')
+        self._time('cpio-gzip', lambda: gen_cpio_image(fx.tree, cpio, 'gzip', logger=self.logger))
+
+        if which('mkfs.ext4') is None:
+            self.logger.warning("mkfs.ext4 not found, skipping ext and disk benchmarks")
+            return
+
+        old = TreeManifest.scan(fx.tree)
+        size = sum([entry["size"] for entry in old.entries.values()]) // (1024 * 1024) * 2 + 64
+        ext = os.path.join(root, 'rootfs.ext4')
+        pristine = ext + '.orig'
+
+        def mkfs():
+            sh = ShellSession(logger=self.logger)
+            ret = sh.cmd("mkfs.ext4 -q -F -d %s %s %dM" % (fx.tree, ext, size))
+            sh.close()
+            return ret[0] == 0
+
+        self._time('ext4-mkfs', mkfs, lambda: self._rm(ext))
+        shutil.copy(ext, pristine)
+
+        # An incremental rootfs update touching a handful of files.
+        for index in range(20):
+            fx._write(os.path.join(fx.tree, 'etc/bench%d' % index), os.urandom(4096))
+        new = TreeManifest.scan(fx.tree, old)
+        self._time('ext4-patch', lambda: patch_ext_image(ext, fx.tree, old, new, self.logger),
+                   lambda: shutil.copy(pristine, ext))
+        self._rm(ext, pristine)
+
+        def disk():
+            image = DiskImage(os.path.join(root, 'disk.img'), size + 4, seed='bench', logger=self.logger)
+            image.add_partition('rootfs', size, 20, 'ext4', staging=fx.tree)
+            return image.build()
+
+        self._time('disk-assemble', disk)
+
+    def compare(self, baseline, threshold=0.2):
+        regressions = []
+
+        for name in sorted(self.results):
+            if name not in baseline:
+                continue
+            base = baseline[name]
+            now = self.results[name]
+            change = (now - base) / base * 100.0 if base > 0 else 0.0
+            self.logger.info("%-28s %9.3fs %9.3fs %+7.1f%%", name, base, now, change)
+            # Very short cases are all noise.
+            if now > base * (1 + threshold) and now - base > 0.01:
+                regressions.append(name)
+
+        return regressions
+
+@click.command(help='Time kdev stages on synthetic fixtures and compare with a baseline')
+@click.option('--baseline', type=click.Path(), default=None, help='Baseline results (default: ~/.kdev/benchmark.json)')
+@click.option('--save-baseline', is_flag=True, default=False, help='Store these results as the new baseline')
+@click.option('--scale', type=int, default=1, help='Multiplier for the number of fixture files and recipes')
+@click.option('--repeat', type=int, default=3, help='Runs per benchmark, the median is reported')
+@click.option('--threshold', type=float, default=20.0, help='Slowdown in percent reported as a regression')
+@click.option('--work-dir', type=click.Path(), default=None, help='Where to create the fixtures')
+def benchmark(baseline, save_baseline, scale, repeat, threshold, work_dir):
+    baseline = baseline or os.path.join(os.path.expanduser("~"), '.kdev', 'benchmark.json')
+    suite = BenchSuite(work_dir=work_dir, scale=scale, repeat=repeat, logger=logger)
+    results = suite.run()
+
+    if save_baseline:
+        if not os.path.exists(os.path.dirname(os.path.abspath(baseline))):
+            os.makedirs(os.path.dirname(os.path.abspath(baseline)))
+        with open(baseline, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+        click.echo('Saved baseline %s' % baseline)
+        return
+
+    if not os.path.exists(baseline):
+        click.echo('No baseline %s, run with --save-baseline first' % baseline)
+        return
+
+    with open(baseline) as fp:
+        regressions = suite.compare(json.load(fp), threshold / 100.0)
+
+    if len(regressions) > 0:
+        click.echo('Regressions: %s' % ' '.join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.INFO)
+    benchmark()
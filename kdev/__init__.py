@@ -17,3 +17,10 @@
 #
 
 from kdev._kdev import KdevBuild, get_recipe_name
+from kdev._scheduler import StageScheduler
+from kdev._cache import StageCache
+from kdev._index import RecipeIndex
+from kdev._matrix import BuildMatrix
+from kdev._report import BuildReport
+from kdev._daemon import BuildDaemon
+from kdev._remote import RemoteWorker
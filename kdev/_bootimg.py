@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Android boot image writer
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import json
+import struct
+import hashlib
+import logging
+
+BOOT_MAGIC = b'ANDROID!'
+BOOT_NAME_SIZE = 16
+BOOT_ARGS_SIZE = 512
+BOOT_EXTRA_ARGS_SIZE = 1024
+
+# Version 0 header, same layout as mkbootimg writes it.
+HEADER = struct.Struct('<8s10I%ds%ds32s%ds' % (BOOT_NAME_SIZE, BOOT_ARGS_SIZE, BOOT_EXTRA_ARGS_SIZE))
+
+# mkbootimg default when no second stage offset is given.
+SECOND_OFFSET = 0x00f00000
+
+_version_re = re.compile(r'^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?$')
+
+def _int(value, default=0):
+    if isinstance(value, int):
+        return value
+    value = value.strip()
+    return int(value, 0) if len(value) > 0 else default
+
+def os_version(version, patch_level):
+    match = _version_re.match(version.strip())
+    if match is None:
+        raise ValueError("Invalid os version %s" % version)
+    a, b, c = [int(field or 0) for field in match.groups()]
+
+    # Patch levels are given either as YYYYMM or as the raw 11 bit field.
+    if patch_level >= 200001:
+        patch_level = ((patch_level // 100 - 2000) << 4) | (patch_level % 100)
+
+    return (((a & 0x7f) << 14 | (b & 0x7f) << 7 | (c & 0x7f)) << 11) | (patch_level & 0x7ff)
+
+class BootImageWriter(object):
+    def __init__(self, image, pagesize=4096, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.image = image
+        self.pagesize = pagesize
+
+    def _pad(self, fp, size):
+        if size % self.pagesize:
+            fp.write(b'\0' * (self.pagesize - size % self.pagesize))
+
+    def _copy(self, fp, path, sha):
+        # Each blob is hashed while it is copied, followed by its size, like
+        # mkbootimg does it.
+        size = 0
+        if path is not None:
+            with open(path, 'rb') as src:
+                while True:
+                    data = src.read(1024 * 1024)
+                    if len(data) == 0:
+                        break
+                    fp.write(data)
+                    if sha is not None:
+                        sha.update(data)
+                    size += len(data)
+            self._pad(fp, size)
+        if sha is not None:
+            sha.update(struct.pack('<I', size))
+        return size
+
+    def write(self, kernel, ramdisk=None, second=None, cmdline='', name='', base=0x10000000,
+              kernel_offset=0x00008000, ramdisk_offset=0x01000000, second_offset=SECOND_OFFSET, tags_offset=0x100,
+              version=0, use_id=True):
+        cmdline = cmdline.encode('utf-8') if not isinstance(cmdline, bytes) else cmdline
+        name = name.encode('utf-8') if not isinstance(name, bytes) else name
+
+        # Command lines too long for the header continue in extra_cmdline,
+        # like mkbootimg both fields keep their terminating NUL.
+        if len(cmdline) > BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE - 2:
+            raise ValueError("Kernel command line is %d bytes, at most %d fit" %
+                             (len(cmdline), BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE - 2))
+
+        sha = hashlib.sha1() if use_id else None
+
+        # Blobs go straight after the header page, the header itself is only
+        # known once all of them went through the hash.
+        with open(self.image, 'wb') as fp:
+            fp.seek(self.pagesize)
+            kernel_size = self._copy(fp, kernel, sha)
+            ramdisk_size = self._copy(fp, ramdisk, sha)
+            second_size = self._copy(fp, second, sha)
+
+            fp.seek(0)
+            fp.write(HEADER.pack(BOOT_MAGIC,
+                                 kernel_size, (base + kernel_offset) & 0xffffffff,
+                                 ramdisk_size, (base + ramdisk_offset) & 0xffffffff,
+                                 second_size, (base + second_offset) & 0xffffffff,
+                                 (base + tags_offset) & 0xffffffff,
+                                 self.pagesize, 0, version,
+                                 name[:BOOT_NAME_SIZE - 1],
+                                 cmdline[:BOOT_ARGS_SIZE - 1],
+                                 sha.digest() if sha is not None else b'',
+                                 cmdline[BOOT_ARGS_SIZE - 1:]))
+
+        return kernel_size, ramdisk_size, second_size
+
+def _inputs(params, paths, cmdline, name):
+    state = {"params": params, "cmdline": cmdline, "name": name, "files": {}}
+    for key, path in paths.items():
+        if path is not None:
+            st = os.stat(path)
+            state["files"][key] = [path, st.st_size, st.st_mtime]
+    return state
+
+def gen_boot_image(image, kernel, ramdisk=None, second=None, cmdline='', name='', params=None, logger=None):
+    logger = logger or logging.getLogger(__name__)
+    params = params or {}
+    stamp = image + '.inputs'
+
+    for path in [kernel, ramdisk, second]:
+        if path is not None and not os.path.exists(path):
+            logger.error("Boot image input %s does not exist", path)
+            return False
+
+    state = _inputs(params, {"kernel": kernel, "ramdisk": ramdisk, "second": second}, cmdline, name)
+
+    if os.path.exists(image) and os.path.exists(stamp):
+        with open(stamp) as fp:
+            old = json.load(fp)
+        st = os.stat(image)
+        if old.get("inputs") == json.loads(json.dumps(state)) and old.get("image") == [st.st_size, st.st_mtime]:
+            logger.info("Boot image %s is up to date", image)
+            return True
+
+    if os.path.exists(stamp):
+        os.remove(stamp)
+
+    tmp = image + '.tmp'
+    writer = BootImageWriter(tmp, params.get("pagesize", 4096), logger)
+
+    try:
+        sizes = writer.write(kernel, ramdisk, second, cmdline, name,
+                             base=_int(params.get("base", "0x10000000")),
+                             kernel_offset=_int(params.get("kernel-offset", "0x00008000")),
+                             ramdisk_offset=_int(params.get("ramdisk-offset", "0x01000000")),
+                             second_offset=_int(params.get("second-offset", ""), SECOND_OFFSET),
+                             tags_offset=_int(params.get("tags-offset", 0x100)),
+                             version=os_version(params.get("os-version", "v1.0"), params.get("os-patch-level", 0)),
+                             use_id=params.get("use-id", True))
+    except (IOError, OSError, ValueError) as e:
+        logger.error("Generating boot image %s failed: %s", image, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+    os.rename(tmp, image)
+
+    st = os.stat(image)
+    with open(stamp, 'w') as fp:
+        json.dump({"inputs": state, "image": [st.st_size, st.st_mtime]}, fp)
+
+    logger.info("Boot image %s: kernel %d, ramdisk %d, second %d bytes", image, *sizes)
+
+    return True
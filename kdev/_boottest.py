@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# QEMU boot time test
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import json
+import time
+import select
+import signal
+import logging
+import subprocess
+
+QEMU = {
+    "x86_64": (["qemu-system-x86_64"], "ttyS0"),
+    "i386": (["qemu-system-i386"], "ttyS0"),
+    "arm64": (["qemu-system-aarch64", "-M", "virt", "-cpu", "cortex-a57"], "ttyAMA0"),
+}
+
+# What arch/<arch>/boot/ holds after a build, arm64 has no bzImage.
+KERNEL_IMAGE = {
+    "x86_64": "bzImage",
+    "i386": "bzImage",
+    "arm64": "Image",
+}
+
+_userspace_re = re.compile(br'Run \S+ as init process|Freeing unused kernel (image )?memory')
+_enter_re = re.compile(br'Please press Enter to activate this console')
+_prompt_re = re.compile(br'(^|\n)[^\n]{0,64}[#$] $')
+
+HISTORY_RUNS = 5
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+class BootTest(object):
+    def __init__(self, arch, kernel, initrd=None, rootfs=None, cmdline='', memory=512, timeout=120, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.arch = arch
+        self.kernel = kernel
+        self.initrd = initrd
+        self.rootfs = rootfs
+        self.cmdline = cmdline
+        self.memory = memory
+        self.timeout = timeout
+
+    def command(self):
+        if self.arch not in QEMU:
+            self.logger.error("Boot test does not support arch %s", self.arch)
+            return None
+
+        qemu, console = QEMU[self.arch]
+        append = "console=%s panic=-1 %s" % (console, self.cmdline)
+
+        # TCG only, build machines and CI containers rarely have /dev/kvm.
+        cmd = qemu + ["-accel", "tcg", "-m", "%d" % self.memory, "-nographic", "-no-reboot",
+                      "-monitor", "none", "-serial", "stdio", "-kernel", self.kernel]
+        if self.initrd is not None:
+            cmd += ["-initrd", self.initrd]
+        if self.rootfs is not None:
+            # snapshot keeps the tested image byte for byte as it was built.
+            cmd += ["-drive", "file=%s,format=raw,if=virtio,snapshot=on" % self.rootfs]
+            if self.initrd is None and 'root=' not in append:
+                append += " root=/dev/vda rw"
+        cmd += ["-append", append.strip()]
+
+        return cmd
+
+    def run(self, log_file=None):
+        result = {"userspace": None, "shell": None, "status": "timeout"}
+        cmd = self.command()
+        if cmd is None:
+            result["status"] = "error"
+            return result
+
+        self.logger.debug(' '.join(cmd))
+
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            self.logger.error("Starting %s failed: %s", cmd[0], e)
+            result["status"] = "error"
+            return result
+
+        start = time.time()
+        console = b''
+        log = open(log_file, 'wb') if log_file is not None else None
+        poweroff = None
+
+        try:
+            while time.time() - start < self.timeout:
+                ready = select.select([proc.stdout], [], [], 0.5)[0]
+                if len(ready) == 0:
+                    if proc.poll() is not None:
+                        break
+                    continue
+                data = os.read(proc.stdout.fileno(), 4096)
+                if len(data) == 0:
+                    break
+                if log is not None:
+                    log.write(data)
+                # Only the recent output matters for matching.
+                console = (console + data)[-8192:]
+                now = time.time() - start
+
+                if result["userspace"] is None and _userspace_re.search(console):
+                    result["userspace"] = now
+                if _enter_re.search(console):
+                    console = b''
+                    proc.stdin.write(b'\n')
+                    proc.stdin.flush()
+                if result["userspace"] is not None and result["shell"] is None and _prompt_re.search(console):
+                    result["shell"] = now
+                    result["status"] = "ok"
+                    proc.stdin.write(b'poweroff -f\n')
+                    proc.stdin.flush()
+                    poweroff = time.time()
+                if poweroff is not None and time.time() - poweroff > 10:
+                    break
+        finally:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+                time.sleep(1)
+                if proc.poll() is None:
+                    proc.kill()
+            proc.wait()
+            if log is not None:
+                log.close()
+
+        if result["status"] != "ok" and result["userspace"] is None and proc.returncode not in [0, None]:
+            result["status"] = "error"
+
+        return result
+
+class BootHistory(object):
+    def __init__(self, path, threshold=0.1, min_delta=0.25, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        # TCG boot times jitter, a regression has to be both relatively and
+        # absolutely bigger than the noise.
+        self.threshold = threshold
+        self.min_delta = min_delta
+        self.entries = []
+
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    self.entries = json.load(fp)
+            except ValueError:
+                self.logger.warning("Ignoring corrupt boot history %s", path)
+
+    def baseline(self, key):
+        values = [entry[key] for entry in self.entries if entry["status"] == "ok" and entry.get(key) is not None]
+        values = values[-HISTORY_RUNS:]
+
+        return median(values) if len(values) > 0 else None
+
+    def check(self, entry):
+        regressions = []
+
+        for key in ["userspace", "shell"]:
+            base = self.baseline(key)
+            if base is None or entry.get(key) is None:
+                continue
+            if entry[key] > base * (1 + self.threshold) and entry[key] - base > self.min_delta:
+                regressions.append("%s %.2fs -> %.2fs (+%.0f%%)" % (key, base, entry[key],
+                                                                     100.0 * (entry[key] - base) / base))
+
+        if len(regressions) > 0 and len(self.entries) > 0:
+            last = self.entries[-1]
+            changed = [name for name, digest in entry["inputs"].items() if last.get("inputs", {}).get(name) != digest]
+            if len(changed) > 0:
+                regressions.append("changed since the last boot: %s" % ', '.join(sorted(changed)))
+
+        return regressions
+
+    def add(self, entry):
+        self.entries.append(entry)
+
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(self.entries, fp, indent=1)
+        os.rename(self.path + '.tmp', self.path)
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+# Content addressed build stage cache
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import json
+import stat
+import shutil
+import hashlib
+import logging
+import tempfile
+from pyshell import PyShell
+from kdev._treesync import clone_file
+
+MAX_SIZE = 20 * 1024 * 1024 * 1024
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+def hash_file(path, algo='sha256'):
+    h = hashlib.new(algo)
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_tree(root, algo='sha256'):
+    h = hashlib.new(algo)
+
+    if not os.path.exists(root):
+        return None
+
+    for base, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = os.path.join(base, name)
+            st = os.lstat(path)
+            h.update(_to_bytes("%s %o\n" % (os.path.relpath(path, root), st.st_mode)))
+            if stat.S_ISLNK(st.st_mode):
+                h.update(_to_bytes(os.readlink(path)))
+            elif stat.S_ISREG(st.st_mode):
+                h.update(_to_bytes(hash_file(path, algo)))
+            elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                h.update(_to_bytes("%d" % st.st_rdev))
+
+    return h.hexdigest()
+
+def git_revision(path, exclude=(), logger=None):
+    if not os.path.exists(os.path.join(path, '.git')):
+        return None
+
+    sh = PyShell(logger=logger)
+
+    ret = sh.cmd("git -C %s rev-parse HEAD" % path)
+    if ret[0] != 0:
+        return None
+
+    rev = ret[1].strip()
+
+    # Local modifications are part of the revision.
+    ret = sh.cmd("git -C %s status --porcelain --untracked-files=no" % path)
+    if ret[0] != 0:
+        return None
+
+    if len(ret[1].strip()) > 0:
+        ret = sh.cmd("git -C %s diff HEAD" % path)
+        if ret[0] != 0:
+            return None
+        rev += '-' + hashlib.sha256(_to_bytes(ret[1])).hexdigest()
+
+    # So are new files git does not know about yet, minus build output dirs
+    # which live inside the tree.
+    cmd = "git -C %s ls-files --others --exclude-standard" % path
+    if len(exclude) > 0:
+        cmd += " -- . " + ' '.join(["':(exclude)%s'" % name for name in exclude])
+    ret = sh.cmd(cmd)
+    if ret[0] != 0:
+        return None
+
+    untracked = sorted([name for name in ret[1].splitlines() if len(name) > 0])
+    if len(untracked) > 0:
+        h = hashlib.sha256()
+        for name in untracked:
+            fpath = os.path.join(path, name)
+            h.update(_to_bytes(name + '\n'))
+            if os.path.islink(fpath):
+                h.update(_to_bytes(os.readlink(fpath)))
+            elif os.path.isfile(fpath):
+                h.update(_to_bytes(hash_file(fpath)))
+        rev += '-' + h.hexdigest()
+
+    return rev
+
+def tree_state(root):
+    # Cheap per path snapshot, to tell what a stage wrote into a shared dir.
+    state = {}
+
+    for base, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(base, name)
+            st = os.lstat(path)
+            state[os.path.relpath(path, root)] = (st.st_mode, st.st_size, st.st_mtime)
+
+    return state
+
+def tree_changes(before, root):
+    after = tree_state(root)
+    return set([rpath for rpath, value in after.items() if before.get(rpath) != value])
+
+def _copy_entry(spath, dpath, logger):
+    st = os.lstat(spath)
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(spath), dpath)
+    elif stat.S_ISDIR(st.st_mode):
+        os.mkdir(dpath)
+        shutil.copystat(spath, dpath)
+    elif stat.S_ISREG(st.st_mode):
+        clone_file(spath, dpath)
+        shutil.copystat(spath, dpath)
+    else:
+        try:
+            os.mknod(dpath, st.st_mode, st.st_rdev)
+        except OSError:
+            logger.warning("Skipping special file %s", spath)
+
+def copy_tree(src, dst, logger=None, paths=None):
+    logger = logger or logging.getLogger(__name__)
+
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+
+    # Only the selected paths and their parents, when given.
+    keep = None
+    if paths is not None:
+        keep = set()
+        for rpath in paths:
+            while len(rpath) > 0 and rpath not in keep:
+                keep.add(rpath)
+                rpath = os.path.dirname(rpath)
+
+    for base, dirs, files in os.walk(src):
+        ddir = os.path.join(dst, os.path.relpath(base, src))
+        if keep is not None:
+            dirs[:] = [name for name in dirs if os.path.relpath(os.path.join(base, name), src) in keep]
+            files = [name for name in files if os.path.relpath(os.path.join(base, name), src) in keep]
+        for name in dirs + files:
+            _copy_entry(os.path.join(base, name), os.path.join(ddir, name), logger)
+
+    shutil.copystat(src, dst)
+
+def merge_tree(src, dst, logger=None):
+    # Like copy_tree, but anything in dst which src does not have is kept.
+    logger = logger or logging.getLogger(__name__)
+
+    if not os.path.isdir(dst):
+        _remove(dst)
+        os.makedirs(dst)
+
+    for base, dirs, files in os.walk(src):
+        ddir = os.path.join(dst, os.path.relpath(base, src))
+        for name in dirs + files:
+            spath = os.path.join(base, name)
+            dpath = os.path.join(ddir, name)
+            if os.path.isdir(dpath) and not os.path.islink(dpath) and os.path.isdir(spath) and \
+                    not os.path.islink(spath):
+                continue
+            if os.path.lexists(dpath):
+                _remove(dpath)
+            _copy_entry(spath, dpath, logger)
+
+def _remove(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+def _tree_bytes(root):
+    total = 0
+
+    for base, dirs, files in os.walk(root):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(base, name)).st_size
+            except OSError:
+                continue
+
+    return total
+
+class StageCache(object):
+    def __init__(self, cache_dir, max_size=MAX_SIZE, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.cache_dir = os.path.abspath(cache_dir)
+        # Every key holds a full copy of its outputs, least recently used
+        # entries go once the cache grows past max_size.
+        self.max_size = max_size
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, inputs):
+        # Any input which could not be resolved makes the stage uncacheable.
+        for value in inputs.values():
+            if value is None:
+                return None
+
+        return hashlib.sha256(_to_bytes(json.dumps(inputs, sort_keys=True))).hexdigest()
+
+    def _entry(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def lookup(self, stage, key):
+        if key is None:
+            return False
+
+        return os.path.exists(os.path.join(self._entry(stage, key), '.complete'))
+
+    def restore(self, stage, key, outputs, merge=False):
+        if not self.lookup(stage, key):
+            self.logger.info("Stage cache miss for %s", stage)
+            return False
+
+        entry = self._entry(stage, key)
+
+        for name, dst in outputs.items():
+            src = os.path.join(entry, name)
+            if not os.path.lexists(src):
+                self.logger.error("Stage cache entry %s is missing %s", entry, name)
+                return False
+            # Outputs shared with later stages, like a rootfs install dir
+            # which also holds modules and recipe updates, are merged into.
+            if merge and os.path.isdir(src):
+                merge_tree(src, dst, self.logger)
+                continue
+            _remove(dst)
+            if not os.path.exists(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if os.path.isdir(src):
+                copy_tree(src, dst, self.logger)
+            else:
+                shutil.copy2(src, dst)
+
+        # Hits keep an entry from being pruned.
+        os.utime(os.path.join(entry, '.complete'), None)
+
+        self.logger.info("Stage cache hit for %s (%s)", stage, key[:12])
+
+        return True
+
+    def store(self, stage, key, outputs, paths=None):
+        if key is None:
+            return False
+
+        if not os.path.exists(os.path.join(self.cache_dir, stage)):
+            os.makedirs(os.path.join(self.cache_dir, stage))
+
+        # Entries are assembled next to their final location and renamed in
+        # place, so a concurrent reader never sees a partial entry.
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.join(self.cache_dir, stage))
+
+        for name, src in outputs.items():
+            if not os.path.exists(src):
+                self.logger.error("Stage %s output %s does not exist", stage, src)
+                shutil.rmtree(tmp)
+                return False
+            if os.path.isdir(src):
+                copy_tree(src, os.path.join(tmp, name), self.logger, (paths or {}).get(name))
+            else:
+                shutil.copy2(src, os.path.join(tmp, name))
+
+        with open(os.path.join(tmp, '.complete'), 'w') as fp:
+            fp.write("%d\n" % _tree_bytes(tmp))
+
+        entry = self._entry(stage, key)
+        _remove(entry)
+
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp)
+            return False
+
+        self.logger.info("Stored %s in stage cache (%s)", stage, key[:12])
+
+        self.prune(keep=entry)
+
+        return True
+
+    def _entries(self):
+        entries = []
+
+        for stage in os.listdir(self.cache_dir):
+            if not os.path.isdir(os.path.join(self.cache_dir, stage)):
+                continue
+            for key in os.listdir(os.path.join(self.cache_dir, stage)):
+                entry = self._entry(stage, key)
+                marker = os.path.join(entry, '.complete')
+                try:
+                    mtime = os.stat(marker).st_mtime
+                    with open(marker) as fp:
+                        size = int(fp.read().strip() or '-1')
+                except (IOError, OSError, ValueError):
+                    continue
+                if size < 0:
+                    size = _tree_bytes(entry)
+                entries.append((mtime, size, entry))
+
+        return entries
+
+    def prune(self, keep=None):
+        if not self.max_size:
+            return 0
+
+        entries = self._entries()
+        total = sum([size for mtime, size, entry in entries])
+        removed = 0
+
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            _remove(entry)
+            total -= size
+            removed += 1
+
+        if removed > 0:
+            self.logger.info("Pruned %d stage cache entries, %dM left", removed, total // (1024 * 1024))
+
+        return removed
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# Compiler cache wrapper for kernel builds
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import json
+import logging
+import subprocess
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+CACHE_TOOLS = ['ccache', 'sccache']
+
+class CompilerCache(object):
+    def __init__(self, tool='ccache', cache_dir=None, max_size='10G', base_dir=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.tool = tool
+        self.path = which(tool) if tool in CACHE_TOOLS else None
+        self.cache_dir = os.path.expanduser(cache_dir or os.path.join('~', '.kdev-%s' % tool))
+        self.max_size = max_size
+        self.base_dir = base_dir
+
+        if self.path is None:
+            self.logger.warning("Compiler cache %s not found, building without it", tool)
+
+    def available(self):
+        return self.path is not None
+
+    def wrap(self, cc):
+        return "%s %s" % (self.path, cc if len(cc) > 0 else 'gcc')
+
+    def env(self):
+        env = dict(os.environ)
+
+        # The tools evict least recently used entries once they grow past the limit.
+        if self.tool == 'ccache':
+            env["CCACHE_DIR"] = self.cache_dir
+            env["CCACHE_MAXSIZE"] = self.max_size
+            if self.base_dir is not None:
+                # Recipes build the same sources into different O= dirs,
+                # so paths and the cwd must not be part of the hash.
+                env["CCACHE_BASEDIR"] = self.base_dir
+                env["CCACHE_NOHASHDIR"] = "1"
+        else:
+            env["SCCACHE_DIR"] = self.cache_dir
+            env["SCCACHE_CACHE_SIZE"] = self.max_size
+
+        return env
+
+    def _run(self, args):
+        try:
+            proc = subprocess.Popen([self.path] + args, env=self.env(), stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError:
+            return None
+        out, err = proc.communicate()
+
+        return out if proc.returncode == 0 else None
+
+    def stats(self):
+        if not self.available():
+            return None
+
+        if self.tool == 'sccache':
+            out = self._run(['--show-stats', '--stats-format=json'])
+            if out is None:
+                return None
+            try:
+                stats = json.loads(out)["stats"]
+                return {"hits": sum(stats["cache_hits"]["counts"].values()),
+                        "misses": sum(stats["cache_misses"]["counts"].values())}
+            except (ValueError, KeyError, TypeError):
+                return None
+
+        out = self._run(['--print-stats'])
+        if out is not None:
+            values = dict(line.split('\t', 1) for line in out.splitlines() if '\t' in line)
+            return {"hits": int(values.get("direct_cache_hit", 0)) + int(values.get("preprocessed_cache_hit", 0)),
+                    "misses": int(values.get("cache_miss", 0))}
+
+        # Older ccache only has the human readable summary.
+        out = self._run(['-s'])
+        if out is None:
+            return None
+
+        hits = sum([int(x) for x in re.findall(r'cache hit \((?:direct|preprocessed)\)\s+(\d+)', out)])
+        misses = re.search(r'cache miss\s+(\d+)', out)
+
+        return {"hits": hits, "misses": int(misses.group(1)) if misses is not None else 0}
+
+    def diff(self, before, after):
+        if before is None or after is None:
+            return None
+
+        hits = after["hits"] - before["hits"]
+        misses = after["misses"] - before["misses"]
+        total = hits + misses
+
+        return {"hits": hits, "misses": misses, "hit-rate": (100.0 * hits / total) if total > 0 else 0.0}
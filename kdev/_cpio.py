@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+# Streaming newc cpio writer with parallel block compression
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import stat
+import zlib
+import struct
+import logging
+import subprocess
+from multiprocessing.pool import ThreadPool
+from kdev._scheduler import cpu_count
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+COMPRESSION_TYPES = ['gzip', 'zstd', 'xz', 'none']
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def _gf2_times(mat, vec):
+    total = 0
+    index = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[index]
+        vec >>= 1
+        index += 1
+    return total
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[index]) for index in range(32)]
+
+def crc32_combine(crc1, crc2, len2):
+    # Same as zlib's crc32_combine(), which python does not expose.
+    if len2 == 0:
+        return crc1
+
+    odd = [0xedb88320] + [1 << index for index in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+
+    return crc1 ^ crc2
+
+def _deflate_block(data, level):
+    # Blocks end on a byte boundary without a final bit, so their raw deflate
+    # streams simply concatenate into one, like pigz does it.
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+    return body, zlib.crc32(data) & 0xffffffff, len(data)
+
+class _PipeCompressor(object):
+    def __init__(self, fileobj, cmd):
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise IOError("compressor exited with %d" % self.proc.returncode)
+
+class _BlockCompressor(object):
+    def __init__(self, fileobj, func, level, threads):
+        self.fileobj = fileobj
+        self.func = func
+        self.level = level
+        self.pool = ThreadPool(threads)
+        self.pending = []
+        self.buf = []
+        self.size = 0
+        self.depth = threads * 2
+
+    def _emit(self, result):
+        self.fileobj.write(result)
+
+    def _submit(self):
+        if self.size == 0:
+            return
+        data = b''.join(self.buf)
+        self.buf = []
+        self.size = 0
+        self.pending.append(self.pool.apply_async(self.func, (data, self.level)))
+        # Bound the memory held by in-flight blocks, output stays in submit order.
+        while len(self.pending) > self.depth:
+            self._emit(self.pending.pop(0).get())
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= BLOCK_SIZE:
+            self._submit()
+
+    def close(self):
+        self._submit()
+        while len(self.pending) > 0:
+            self._emit(self.pending.pop(0).get())
+        self.pool.close()
+        self.pool.join()
+
+class _GzipCompressor(_BlockCompressor):
+    # The kernel initramfs unpacker takes a single gzip member only, one
+    # that ends in the middle of a cpio entry is "junk at the end". Blocks
+    # are deflated in parallel but go out as one member.
+    def __init__(self, fileobj, level, threads):
+        _BlockCompressor.__init__(self, fileobj, _deflate_block, level, threads)
+        self.crc = 0
+        self.length = 0
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\x03')
+
+    def _emit(self, result):
+        body, crc, length = result
+        self.fileobj.write(body)
+        self.crc = crc32_combine(self.crc, crc, length)
+        self.length += length
+
+    def close(self):
+        _BlockCompressor.close(self)
+        # An empty final block terminates the deflate stream.
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.fileobj.write(comp.flush(zlib.Z_FINISH))
+        self.fileobj.write(struct.pack('<II', self.crc, self.length & 0xffffffff))
+
+class _XzCompressor(object):
+    # One xz stream, the kernel decoder does not take concatenated ones.
+    def __init__(self, fileobj, level):
+        self.fileobj = fileobj
+        self.comp = lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=level)
+
+    def write(self, data):
+        self.fileobj.write(self.comp.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.comp.flush())
+
+class _ZstdCompressor(object):
+    def __init__(self, fileobj, level, threads):
+        self.comp = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.writer = self.comp.stream_writer(fileobj)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+
+def compressor(fileobj, compression='gzip', level=0, threads=0):
+    threads = threads if threads > 0 else cpu_count()
+
+    if compression == 'gzip':
+        return _GzipCompressor(fileobj, level or 6, threads)
+    elif compression == 'xz':
+        # xz -T still writes a single stream, split in independent blocks
+        # which the kernel decoder handles.
+        if which('xz') is not None or lzma is None:
+            return _PipeCompressor(fileobj, ['xz', '-%d' % (level or 6), '--check=crc32', '-T%d' % threads, '-c'])
+        return _XzCompressor(fileobj, level or 6)
+    elif compression == 'zstd':
+        if zstandard is not None:
+            return _ZstdCompressor(fileobj, level or 3, threads)
+        return _PipeCompressor(fileobj, ['zstd', '-%d' % (level or 3), '-T%d' % threads, '-q', '-c'])
+    elif compression == 'none':
+        return _BlockCompressor(fileobj, lambda data, level: data, 0, 1)
+
+    raise ValueError("Invalid compression type %s" % compression)
+
+class CpioWriter(object):
+    def __init__(self, fileobj, mtime=None, uid=None, gid=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.fileobj = fileobj
+        self.mtime = mtime
+        self.uid = uid
+        self.gid = gid
+        # Same inode base as the kernel's gen_init_cpio.
+        self.ino = 721
+        self.offset = 0
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _pad(self):
+        if self.offset % 4:
+            self._write(b'\0' * (4 - self.offset % 4))
+
+    def _header(self, name, mode, uid, gid, nlink, mtime, size, rdev):
+        name = name.encode('utf-8') if not isinstance(name, bytes) else name
+        self.ino += 1
+        fields = (self.ino, mode, uid, gid, nlink, int(mtime), size, 0, 0,
+                  os.major(rdev), os.minor(rdev), len(name) + 1, 0)
+        self._write(b'070701' + b''.join([('%08X' % field).encode('ascii') for field in fields]))
+        self._write(name + b'\0')
+        self._pad()
+
+    def add(self, path, name):
+        st = os.lstat(path)
+        mode = st.st_mode
+        mtime = self.mtime if self.mtime is not None else st.st_mtime
+        uid = self.uid if self.uid is not None else st.st_uid
+        gid = self.gid if self.gid is not None else st.st_gid
+
+        if stat.S_ISREG(mode):
+            self._header(name, mode, uid, gid, 1, mtime, st.st_size, 0)
+            with open(path, 'rb') as fp:
+                remaining = st.st_size
+                while remaining > 0:
+                    data = fp.read(min(remaining, 1024 * 1024))
+                    if len(data) == 0:
+                        raise IOError("%s shrunk while being archived" % path)
+                    self._write(data)
+                    remaining -= len(data)
+            self._pad()
+        elif stat.S_ISLNK(mode):
+            target = os.readlink(path)
+            target = target.encode('utf-8') if not isinstance(target, bytes) else target
+            self._header(name, mode, uid, gid, 1, mtime, len(target), 0)
+            self._write(target)
+            self._pad()
+        elif stat.S_ISDIR(mode):
+            self._header(name, mode, uid, gid, 2, mtime, 0, 0)
+        else:
+            self._header(name, mode, uid, gid, 1, mtime, 0, st.st_rdev)
+
+    def add_tree(self, root):
+        # Sorted walk with each directory ahead of its contents gives a
+        # deterministic archive which unpacks in a single pass.
+        for base, dirs, files in os.walk(root):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = os.path.join(base, name)
+                self.add(path, os.path.relpath(path, root))
+
+    def close(self):
+        self._header('TRAILER!!!', 0, 0, 0, 1, 0, 0, 0)
+        if self.offset % 512:
+            self._write(b'\0' * (512 - self.offset % 512))
+
+def gen_cpio_image(root, image, compression='gzip', level=0, threads=0, reproducible=True, logger=None):
+    logger = logger or logging.getLogger(__name__)
+
+    if not os.path.exists(root):
+        logger.error("Initramfs dir %s does not exist", root)
+        return False
+
+    if reproducible:
+        mtime = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+        uid, gid = 0, 0
+    else:
+        mtime, uid, gid = None, None, None
+
+    tmp = image + '.tmp'
+
+    try:
+        with open(tmp, 'wb') as fp:
+            comp = compressor(fp, compression, level, threads)
+            writer = CpioWriter(comp, mtime=mtime, uid=uid, gid=gid, logger=logger)
+            writer.add_tree(root)
+            writer.close()
+            comp.close()
+    except (IOError, OSError, ValueError) as e:
+        logger.error("Generating cpio image %s failed: %s", image, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+    os.rename(tmp, image)
+
+    return True
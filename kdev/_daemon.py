@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# Build daemon serving kdevimg commands over a Unix socket
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import logging
+import traceback
+
+def socket_path():
+    return os.environ.get("KDEV_SOCKET", os.path.join(os.path.expanduser("~"), '.kdev', 'kdevimg.sock'))
+
+class _ClientStream(object):
+    # Output of the command, including forked stage workers which inherit
+    # the socket, goes back to the client as json lines.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        try:
+            self.conn.sendall((json.dumps({"out": data}) + '\n').encode('utf-8'))
+        except socket.error:
+            # Client went away, the command still runs to completion.
+            pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class BuildDaemon(object):
+    def __init__(self, path, handler, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        self.handler = handler
+        self.sock = None
+
+    def _bind(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                self.logger.error("Build daemon already listens on %s", self.path)
+                return False
+            except socket.error:
+                # Left behind by a daemon which did not shut down cleanly.
+                os.remove(self.path)
+            finally:
+                probe.close()
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(16)
+
+        return True
+
+    def _read_request(self, conn):
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if len(chunk) == 0:
+                return None
+            data += chunk
+
+        return json.loads(data.decode('utf-8'))
+
+    def _run(self, request, conn):
+        stream = _ClientStream(conn)
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root = logging.getLogger()
+
+        saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd(), dict(os.environ))
+        devnull = open(os.devnull)
+
+        root.addHandler(handler)
+        sys.stdin = devnull
+        sys.stdout = stream
+        sys.stderr = stream
+        os.environ.clear()
+        os.environ.update(request.get("env", {}))
+
+        try:
+            os.chdir(request["cwd"])
+            return self.handler(request["argv"])
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            return e.code if isinstance(e.code, int) else 1
+        except Exception:
+            stream.write(traceback.format_exc())
+            return 1
+        finally:
+            root.removeHandler(handler)
+            sys.stdin, sys.stdout, sys.stderr = saved[:3]
+            os.chdir(saved[3])
+            os.environ.clear()
+            os.environ.update(saved[4])
+            devnull.close()
+
+    def serve(self):
+        if not self._bind():
+            return False
+
+        self.logger.info("Build daemon listening on %s", self.path)
+
+        # Requests are served one at a time, builds of the same recipe must
+        # not overlap and stage workers are forked from this process.
+        try:
+            while True:
+                conn, addr = self.sock.accept()
+                try:
+                    request = self._read_request(conn)
+                    if request is None:
+                        continue
+                    if request.get("stop"):
+                        conn.sendall((json.dumps({"exit": 0}) + '\n').encode('utf-8'))
+                        break
+                    start = time.time()
+                    code = self._run(request, conn)
+                    self.logger.info("%s -> %d in %.3fs", ' '.join(request["argv"]), code, time.time() - start)
+                    conn.sendall((json.dumps({"exit": code}) + '\n').encode('utf-8'))
+                except (socket.error, ValueError, KeyError) as e:
+                    if not isinstance(e, socket.error) or e.errno != errno.EPIPE:
+                        self.logger.error("Bad request: %s", e)
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.sock.close()
+            os.remove(self.path)
+
+        return True
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# Offline GPT disk image builder
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import zlib
+import uuid
+import struct
+import logging
+from multiprocessing.pool import ThreadPool
+from kdev._shell import ShellSession
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+SECTOR_SIZE = 512
+ALIGN = 1024 * 1024
+MB = 1024 * 1024
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_SECTORS = (GPT_ENTRIES * GPT_ENTRY_SIZE) // SECTOR_SIZE
+
+GUID_EFI_SYSTEM = 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B'
+GUID_BIOS_BOOT = '21686148-6449-6E6F-744E-656564454649'
+GUID_LINUX_SWAP = '0657FD6D-A4AB-43C4-84E5-0933C84B4F4F'
+GUID_LINUX_FS = '0FC63DAF-8483-4772-8E79-3D69E8477DE4'
+GUID_BASIC_DATA = 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7'
+
+# part-type values are the ones fdisk takes for "t" on a GPT label, plus the
+# MBR ids recipes commonly carry over.
+PART_TYPES = {
+    1: GUID_EFI_SYSTEM,
+    4: GUID_BIOS_BOOT,
+    11: GUID_BASIC_DATA,
+    12: GUID_BASIC_DATA,
+    19: GUID_LINUX_SWAP,
+    20: GUID_LINUX_FS,
+    0x82: GUID_LINUX_SWAP,
+    0x83: GUID_LINUX_FS,
+    0xef: GUID_EFI_SYSTEM,
+}
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def _align(value, align=ALIGN):
+    return ((value + align - 1) // align) * align
+
+class Partition(object):
+    def __init__(self, name, size, part_type, fstype, fsflags=None, staging=None, guid=None):
+        self.name = name
+        self.size = size
+        self.part_type = part_type
+        self.fstype = fstype
+        self.fsflags = list(fsflags or [])
+        self.staging = staging
+        self.guid = guid or uuid.uuid4()
+        self.image = None
+        self.offset = 0
+
+    def type_guid(self):
+        if self.part_type in PART_TYPES:
+            return uuid.UUID(PART_TYPES[self.part_type])
+        return uuid.UUID(GUID_BASIC_DATA if self.fstype.startswith('fat') else GUID_LINUX_FS)
+
+class DiskImage(object):
+    def __init__(self, path, size, seed=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = os.path.abspath(path)
+        self.size = size * MB
+        self.seed = seed
+        self.partitions = []
+        self.timings = []
+
+    def _guid(self, name):
+        # Recipes get stable GUIDs so rebuilt images only differ by content.
+        if self.seed is None:
+            return uuid.uuid4()
+        return uuid.uuid5(uuid.NAMESPACE_URL, "kdev:%s:%s" % (self.seed, name))
+
+    def add_partition(self, name, size, part_type, fstype, fsflags=None, staging=None):
+        part = Partition(name, size * MB, part_type, fstype, fsflags, staging,
+                         self._guid("part%d" % len(self.partitions)))
+        self.partitions.append(part)
+        return part
+
+    def _layout(self):
+        offset = ALIGN
+        for part in self.partitions:
+            part.offset = offset
+            offset = _align(offset + part.size)
+
+        last_usable = self.size - (GPT_SECTORS + 1) * SECTOR_SIZE
+        if offset > last_usable:
+            self.logger.error("Partitions need %d bytes, disk %s only has %d", offset, self.path, last_usable)
+            return False
+
+        return True
+
+    def _mkfs(self, part):
+        sh = ShellSession(logger=self.logger)
+        try:
+            return self._mkfs_session(sh, part)
+        finally:
+            sh.close()
+            self.timings.extend(sh.timings)
+
+    def _mkfs_session(self, sh, part):
+        fakeroot = which('fakeroot') if os.getuid() != 0 else None
+        prefix = "%s " % fakeroot if fakeroot is not None else ""
+
+        part.image = "%s.%s.part" % (self.path, part.name)
+        if os.path.exists(part.image):
+            os.remove(part.image)
+
+        if part.fstype.startswith('ext'):
+            cmd = "%smkfs.%s -q -F -L %s -E root_owner=0:0 %s" % (prefix, part.fstype, part.name,
+                                                                  ' '.join(part.fsflags))
+            if part.staging is not None:
+                cmd += " -d %s" % part.staging
+            cmds = ["%s %s %dk" % (cmd, part.image, part.size // 1024)]
+        elif part.fstype.startswith('fat'):
+            cmds = ["mkfs.fat -C -F %s -n %s %s %s %d" % (part.fstype[3:], part.name[:11].upper(),
+                                                         ' '.join(part.fsflags), part.image, part.size // 1024)]
+            if part.staging is not None:
+                entries = [os.path.join(part.staging, name) for name in sorted(os.listdir(part.staging))]
+                if len(entries) > 0:
+                    cmds.append("mcopy -s -p -m -Q -i %s %s ::/" % (part.image, ' '.join(entries)))
+        else:
+            self.logger.error("Unsupported filesystem %s", part.fstype)
+            return False
+
+        ret = sh.batch(cmds)
+        if ret[0] != 0:
+            self.logger.error("Creating %s filesystem for %s failed", part.fstype, part.name)
+            return False
+
+        return True
+
+    def report(self):
+        for command, elapsed, ret in self.timings:
+            self.logger.info("%8.3fs %4d %s", elapsed, ret, command)
+
+    def _gpt(self):
+        sectors = self.size // SECTOR_SIZE
+        disk_guid = self._guid("disk")
+
+        entries = b''
+        for part in self.partitions:
+            name = part.name.encode('utf-16-le')[:72]
+            entries += struct.pack('<16s16sQQQ72s', part.type_guid().bytes_le, part.guid.bytes_le,
+                                   part.offset // SECTOR_SIZE,
+                                   (part.offset + part.size) // SECTOR_SIZE - 1, 0, name)
+        entries += b'\0' * (GPT_ENTRIES * GPT_ENTRY_SIZE - len(entries))
+
+        def header(current, backup, entries_lba):
+            fields = [b'EFI PART', 0x00010000, 92, 0, 0, current, backup,
+                      2 + GPT_SECTORS, sectors - GPT_SECTORS - 2, disk_guid.bytes_le,
+                      entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE, _crc32(entries)]
+            data = struct.pack('<8sIIIIQQQQ16sQIII', *fields)
+            fields[3] = _crc32(data)
+            data = struct.pack('<8sIIIIQQQQ16sQIII', *fields)
+            return data + b'\0' * (SECTOR_SIZE - len(data))
+
+        mbr = b'\0' * 446
+        mbr += struct.pack('<B3sB3sII', 0, b'\x00\x02\x00', 0xee, b'\xff\xff\xff', 1,
+                           min(sectors - 1, 0xffffffff))
+        mbr += b'\0' * 48 + b'\x55\xaa'
+
+        primary = mbr + header(1, sectors - 1, 2) + entries
+        backup = entries + header(sectors - 1, 1, sectors - 1 - GPT_SECTORS)
+
+        return primary, backup
+
+    def _splice(self, fp, part):
+        with open(part.image, 'rb') as src:
+            offset = part.offset
+            while True:
+                data = src.read(ALIGN)
+                if len(data) == 0:
+                    break
+                # Zero blocks stay holes in the sparse disk image.
+                if data.count(b'\0') != len(data):
+                    fp.seek(offset)
+                    fp.write(data)
+                offset += len(data)
+
+        os.remove(part.image)
+
+    def build(self, jobs=None):
+        if not self._layout():
+            return False
+
+        pool = ThreadPool(max(1, min(len(self.partitions), jobs or len(self.partitions))))
+        try:
+            results = pool.map(self._mkfs, self.partitions)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not all(results):
+            for part in self.partitions:
+                if part.image is not None and os.path.exists(part.image):
+                    os.remove(part.image)
+            return False
+
+        primary, backup = self._gpt()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        with open(self.path, 'wb') as fp:
+            fp.truncate(self.size)
+            fp.write(primary)
+            fp.seek(self.size - len(backup))
+            fp.write(backup)
+            for part in self.partitions:
+                self._splice(fp, part)
+
+        self.logger.info("Created disk image %s", self.path)
+
+        return True
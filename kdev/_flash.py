@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+# Sparse aware disk image flasher
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import io
+import mmap
+import ctypes
+import json
+import time
+import errno
+import hashlib
+import logging
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+O_DIRECT = getattr(os, 'O_DIRECT', 0o40000)
+
+def data_ranges(fd, size):
+    ranges = []
+    offset = 0
+
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            end = os.lseek(fd, start, SEEK_HOLE)
+            ranges.append((start, min(end, size)))
+            offset = end
+    except OSError:
+        # No hole reporting on this filesystem, treat the whole file as data.
+        ranges = [(0, size)]
+
+    os.lseek(fd, 0, os.SEEK_SET)
+
+    return ranges
+
+def _aligned_buffer(size):
+    # Anonymous maps are page aligned, as O_DIRECT wants. py2 maps only have
+    # the old buffer interface, a ctypes array on top of the map has both.
+    buf = mmap.mmap(-1, size)
+    try:
+        return buf, memoryview(buf)
+    except TypeError:
+        return buf, memoryview((ctypes.c_char * size).from_buffer(buf))
+
+def _read_into(fp, view, length):
+    count = 0
+
+    while count < length:
+        n = fp.readinto(view[count:length])
+        if not n:
+            view[count:length] = b'\0' * (length - count)
+            break
+        count += n
+
+def _write_all(fd, view):
+    count = 0
+
+    while count < len(view):
+        count += os.write(fd, view[count:])
+
+def device_id(dev):
+    path = os.path.realpath(dev)
+    byid = '/dev/disk/by-id'
+
+    if os.path.isdir(byid):
+        for name in sorted(os.listdir(byid)):
+            if os.path.realpath(os.path.join(byid, name)) == path:
+                return name
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+    return "%s-%d" % (os.path.basename(path), size)
+
+class FlashWriter(object):
+    def __init__(self, image, dev, block_size=4 * 1024 * 1024, state_dir=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.image = os.path.abspath(image)
+        self.dev = dev
+        self.block_size = block_size
+        self.state_dir = state_dir or os.path.join(os.path.expanduser("~"), '.kdev-flash')
+
+    def _state_file(self):
+        return os.path.join(self.state_dir, "%s.json" % device_id(self.dev))
+
+    def _load_state(self):
+        path = self._state_file()
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path) as fp:
+                state = json.load(fp)
+        except ValueError:
+            return {}
+
+        if state.get("block-size") != self.block_size:
+            return {}
+
+        return state.get("blocks", {})
+
+    def _save_state(self, blocks):
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        path = self._state_file()
+        with open(path + '.tmp', 'w') as fp:
+            json.dump({"image": self.image, "block-size": self.block_size, "blocks": blocks}, fp)
+        os.rename(path + '.tmp', path)
+
+    def _clear_state(self):
+        path = self._state_file()
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _open_dev(self):
+        flags = os.O_WRONLY
+        try:
+            return os.open(self.dev, flags | O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+        return os.open(self.dev, flags), False
+
+    def write(self, full=False):
+        size = os.path.getsize(self.image)
+        prev = {} if full else self._load_state()
+        blocks = {}
+        cleared = False
+        written = 0
+        skipped = 0
+        start = time.time()
+
+        src = io.FileIO(self.image, 'r')
+        try:
+            ranges = data_ranges(src.fileno(), size)
+            dfd, direct = self._open_dev()
+        except OSError as e:
+            src.close()
+            self.logger.error("Opening %s failed: %s", self.dev, e)
+            return False
+
+        buf = view = None
+        try:
+            buf, view = _aligned_buffer(self.block_size)
+
+            dev_size = os.lseek(dfd, 0, os.SEEK_END)
+            if dev_size < size:
+                self.logger.error("Image %s (%d) does not fit on %s (%d)", self.image, size, self.dev, dev_size)
+                return False
+
+            index = 0
+            for offset in range(0, size, self.block_size):
+                length = min(self.block_size, size - offset)
+                key = str(index)
+                index += 1
+
+                if not any(s < offset + length and e > offset for s, e in ranges):
+                    # Holes are never written, like bmaptool does.
+                    skipped += 1
+                    continue
+
+                src.seek(offset)
+                _read_into(src, view, length)
+
+                digest = hashlib.sha1(view[:length]).hexdigest()
+                blocks[key] = digest
+                if prev.get(key) == digest:
+                    skipped += 1
+                    continue
+
+                # An interrupted flash leaves the device matching neither the
+                # old state nor the new one, the state only comes back once
+                # everything is written and synced.
+                if not cleared:
+                    self._clear_state()
+                    cleared = True
+
+                os.lseek(dfd, offset, os.SEEK_SET)
+                if length == self.block_size or not direct:
+                    _write_all(dfd, view[:length])
+                else:
+                    # The unaligned tail can not go through O_DIRECT.
+                    tfd = os.open(self.dev, os.O_WRONLY)
+                    try:
+                        os.lseek(tfd, offset, os.SEEK_SET)
+                        _write_all(tfd, view[:length])
+                        os.fsync(tfd)
+                    finally:
+                        os.close(tfd)
+                written += length
+
+            os.fsync(dfd)
+        except OSError as e:
+            self.logger.error("Writing %s to %s failed: %s", self.image, self.dev, e)
+            return False
+        finally:
+            if hasattr(view, 'release'):
+                view.release()
+            del view
+            if buf is not None:
+                buf.close()
+            os.close(dfd)
+            src.close()
+
+        self._save_state(blocks)
+
+        self.logger.info("Flashed %s to %s: %d bytes written, %d of %d blocks skipped in %.1fs",
+                         self.image, self.dev, written, skipped, index, time.time() - start)
+
+        return True
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# Persistent recipe index
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import json
+import stat
+import logging
+import pkg_resources
+from jsonparser import JSONParser
+
+INDEX_VERSION = 1
+
+def schema_file():
+    return pkg_resources.resource_filename('kdev', 'schemas/board-schema.json')
+
+def parse_recipe(recipe_dir, logger=None):
+    recipe = JSONParser(schema_file(), os.path.join(recipe_dir, 'board.json'), extend_defaults=True,
+                        os_env=True, logger=logger)
+    return recipe.get_cfg()
+
+class RecipeIndex(object):
+    def __init__(self, index_file=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        # Kept out of the recipe roots, writing it would otherwise change the
+        # mtime of a directory it caches.
+        self.index_file = index_file or os.path.join(os.path.expanduser("~"), '.kdev', 'recipe-index.json')
+        self.dirty = False
+        self.data = self._load()
+
+    def _schema_stamp(self):
+        st = os.stat(schema_file())
+        return [st.st_mtime, st.st_size]
+
+    def _load(self):
+        empty = {"version": INDEX_VERSION, "schema": self._schema_stamp(), "dirs": {}, "recipes": {}}
+
+        if not os.path.exists(self.index_file):
+            return empty
+
+        try:
+            with open(self.index_file) as fp:
+                data = json.load(fp)
+        except ValueError:
+            return empty
+
+        # A new schema can change validation and defaults of every recipe.
+        if data.get("version") != INDEX_VERSION or data.get("schema") != self._schema_stamp():
+            return empty
+
+        return data
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        dirname = os.path.dirname(self.index_file)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmp = "%s.%d" % (self.index_file, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(self.data, fp)
+        os.rename(tmp, self.index_file)
+
+        self.dirty = False
+
+    def _scan_dir(self, path, found):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        # Directory mtime only moves when entries are added or removed, so an
+        # unchanged directory does not need to be listed again.
+        cached = self.data["dirs"].get(path)
+        if cached is None or cached["mtime"] != st.st_mtime:
+            subdirs = []
+            has_board = False
+            for name in sorted(os.listdir(path)):
+                try:
+                    mode = os.lstat(os.path.join(path, name)).st_mode
+                except OSError:
+                    continue
+                if stat.S_ISDIR(mode):
+                    subdirs.append(name)
+                elif name == 'board.json':
+                    has_board = True
+            cached = {"mtime": st.st_mtime, "subdirs": subdirs, "board": has_board}
+            self.data["dirs"][path] = cached
+            self.dirty = True
+
+        if cached["board"]:
+            found.append(path)
+
+        for name in cached["subdirs"]:
+            self._scan_dir(os.path.join(path, name), found)
+
+    def get_cfg(self, recipe_dir):
+        recipe_dir = os.path.abspath(recipe_dir)
+        board = os.path.join(recipe_dir, 'board.json')
+        st = os.stat(board)
+
+        entry = self.data["recipes"].get(board)
+        if entry is not None and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            return entry["cfg"]
+
+        cfg = parse_recipe(recipe_dir, self.logger)
+
+        # Recipes which pull values from the environment are parsed every time.
+        with open(board) as fp:
+            if '$' in fp.read():
+                return cfg
+
+        self.data["recipes"][board] = {"mtime": st.st_mtime, "size": st.st_size, "cfg": cfg}
+        self.dirty = True
+
+        return cfg
+
+    def get_name(self, recipe_dir):
+        cfg = self.get_cfg(recipe_dir)
+        name = cfg.get("recipe-name")
+
+        return name if name is not None and len(name) > 0 else None
+
+    def discover(self, roots):
+        found = []
+        for root in roots:
+            if os.path.exists(root):
+                self._scan_dir(os.path.abspath(root), found)
+
+        recipes = []
+        names = set()
+        seen = set()
+        for recipe_dir in found:
+            if recipe_dir in seen:
+                continue
+            seen.add(recipe_dir)
+            try:
+                name = self.get_name(recipe_dir)
+            except Exception as e:
+                self.logger.warning("Skipping invalid recipe %s: %s", recipe_dir, e)
+                continue
+            if name is None or name in names:
+                continue
+            names.add(name)
+            recipes.append((name, recipe_dir))
+
+        # Entries of removed recipes are dropped so the index does not grow forever.
+        for key in ["dirs", "recipes"]:
+            for path in list(self.data[key].keys()):
+                if not os.path.exists(path):
+                    del self.data[key][path]
+                    self.dirty = True
+
+        self.save()
+
+        return recipes
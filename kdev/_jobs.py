@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Resource aware build job sizing
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import sys
+import math
+import time
+import select
+import logging
+import threading
+import multiprocessing
+
+MEM_PER_JOB = 1024 * 1024 * 1024
+
+# Memory PSI "some avg10" percentages, above PSI_HIGH builds give up job
+# slots, below PSI_LOW they get them back one at a time.
+PSI_HIGH = 20.0
+PSI_LOW = 5.0
+PSI_SETTLE = 10
+
+_size_re = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', re.IGNORECASE)
+_makeflags_j_re = re.compile(r'(^|\s)-j\s*\d*|--jobserver-(fds|auth)=\S+')
+
+def parse_size(value):
+    match = _size_re.match(str(value))
+    if match is None:
+        return None
+    scale = 1024 ** ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * scale)
+
+def _read(path):
+    try:
+        with open(path) as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return None
+
+def affinity_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def cgroup_cpus():
+    # cgroup v2, then v1. Containers usually get a quota, not fewer cpus.
+    data = _read('/sys/fs/cgroup/cpu.max')
+    if data is not None:
+        quota, period = data.split()[:2]
+        if quota != 'max':
+            return float(quota) / float(period)
+        return None
+
+    for base in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+        quota = _read(os.path.join(base, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(base, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None and int(quota) > 0:
+            return float(quota) / float(period)
+
+    return None
+
+def mem_available():
+    values = []
+
+    meminfo = _read('/proc/meminfo')
+    if meminfo is not None:
+        match = re.search(r'^MemAvailable:\s+(\d+) kB', meminfo, re.MULTILINE)
+        if match is not None:
+            values.append(int(match.group(1)) * 1024)
+
+    for limit, current in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                           ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                            '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = _read(limit)
+        current = _read(current)
+        # v1 reports "no limit" as a huge number.
+        if limit is not None and current is not None and limit.isdigit() and int(limit) < 2 ** 60:
+            values.append(max(0, int(limit) - int(current)))
+            break
+
+    return min(values) if len(values) > 0 else None
+
+def memory_pressure():
+    for path in ['/sys/fs/cgroup/memory.pressure', '/proc/pressure/memory']:
+        data = _read(path)
+        if data is None:
+            continue
+        match = re.search(r'^some avg10=(\d+(?:\.\d+)?)', data, re.MULTILINE)
+        if match is not None:
+            return float(match.group(1))
+
+    return None
+
+def auto_jobs(mem_per_job=MEM_PER_JOB):
+    jobs = affinity_cpus()
+
+    quota = cgroup_cpus()
+    if quota is not None:
+        jobs = min(jobs, int(math.ceil(quota)))
+
+    mem = mem_available()
+    if mem is not None and mem_per_job > 0:
+        jobs = min(jobs, mem // mem_per_job)
+
+    return max(1, jobs)
+
+class JobServer(object):
+    # A GNU make jobserver owned by kdev. make hands job slots back and
+    # forth through the pipe, kdev can take slots out of circulation while
+    # the build runs and put them back later.
+    def __init__(self, jobs, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.jobs = jobs
+        self.limit = jobs
+        self.held = 0
+        self.rfd, self.wfd = os.pipe()
+        for fd in [self.rfd, self.wfd]:
+            if hasattr(os, 'set_inheritable'):
+                os.set_inheritable(fd, True)
+        # make itself always owns one implicit slot.
+        os.write(self.wfd, b'+' * (jobs - 1))
+
+    def makeflags(self, flags=''):
+        flags = _makeflags_j_re.sub(' ', flags).strip()
+        return ("-j%d --jobserver-fds=%d,%d %s" % (self.jobs, self.rfd, self.wfd, flags)).strip()
+
+    def popen_args(self):
+        if sys.version_info[0] >= 3:
+            return {"pass_fds": (self.rfd, self.wfd)}
+        return {"close_fds": False}
+
+    def set_limit(self, limit):
+        self.limit = max(1, min(self.jobs, limit))
+
+    def adjust(self, timeout=0.5):
+        # Slots are only taken when make returns one, running jobs finish.
+        while self.held < self.jobs - self.limit:
+            if len(select.select([self.rfd], [], [], timeout)[0]) == 0:
+                return
+            os.read(self.rfd, 1)
+            self.held += 1
+
+        while self.held > self.jobs - self.limit:
+            os.write(self.wfd, b'+')
+            self.held -= 1
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+class PressureThrottle(threading.Thread):
+    def __init__(self, server, name, logger=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger or logging.getLogger(__name__)
+        self.server = server
+        self.label = name
+        self.done = threading.Event()
+
+    def run(self):
+        last = 0
+
+        while not self.done.is_set():
+            pressure = memory_pressure()
+            now = time.time()
+
+            # avg10 lags, a change needs time to show up before the next one.
+            if pressure is not None and now - last > PSI_SETTLE:
+                if pressure > PSI_HIGH and self.server.limit > 1:
+                    self.server.set_limit(self.server.limit // 2)
+                    self.logger.warning("%s: memory pressure %.0f%%, down to %d jobs", self.label, pressure,
+                                        self.server.limit)
+                    last = now
+                elif pressure < PSI_LOW and self.server.limit < self.server.jobs:
+                    self.server.set_limit(self.server.limit + 1)
+                    self.logger.info("%s: memory pressure %.0f%%, up to %d jobs", self.label, pressure,
+                                     self.server.limit)
+                    last = now
+
+            self.server.adjust()
+            self.done.wait(1)
+
+        # Slots held back are returned, so make can finish with all of them.
+        self.server.set_limit(self.server.jobs)
+        self.server.adjust()
+
+    def stop(self):
+        self.done.set()
+        self.join()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# In memory kernel .config handling
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+_set_re = re.compile(r'^(CONFIG_[A-Za-z0-9_]+)=(.*)$')
+_unset_re = re.compile(r'^# (CONFIG_[A-Za-z0-9_]+) is not set$')
+
+def parse_line(line):
+    line = line.strip()
+
+    match = _set_re.match(line)
+    if match is not None:
+        value = match.group(2)
+        return match.group(1), None if value == 'n' else value
+
+    match = _unset_re.match(line)
+    if match is not None:
+        return match.group(1), None
+
+    return None
+
+class KconfigMap(object):
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        # Comments and blank lines are kept as positional entries so an
+        # unchanged config is written back byte for byte.
+        self.lines = []
+        self.symbols = OrderedDict()
+
+    @classmethod
+    def load(cls, path, logger=None):
+        obj = cls(logger)
+        with open(path) as fp:
+            obj.parse(fp.read())
+        return obj
+
+    def parse(self, data):
+        for line in data.splitlines():
+            entry = parse_line(line)
+            if entry is None:
+                self.lines.append(line)
+                continue
+            if entry[0] not in self.symbols:
+                self.lines.append(entry[0])
+            self.symbols[entry[0]] = entry[1]
+
+    def get(self, symbol, default=None):
+        return self.symbols.get(symbol, default)
+
+    def merge(self, fragments):
+        changed = []
+
+        for line in fragments:
+            entry = parse_line(line)
+            if entry is None:
+                self.logger.warning("Ignoring invalid config fragment %s", line)
+                continue
+            symbol, value = entry
+            if symbol not in self.symbols:
+                self.lines.append(symbol)
+            elif self.symbols[symbol] == value:
+                continue
+            self.symbols[symbol] = value
+            changed.append(symbol)
+
+        return changed
+
+    def dumps(self):
+        out = []
+
+        for line in self.lines:
+            if line not in self.symbols:
+                out.append(line)
+            elif self.symbols[line] is None:
+                out.append("# %s is not set" % line)
+            else:
+                out.append("%s=%s" % (line, self.symbols[line]))
+
+        return '\n'.join(out) + '\n'
+
+def _read(path):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as fp:
+        return fp.read()
+
+def _digest(data):
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+# Kconfig files by path and mtime, stands in for the revision of kernel
+# trees which are not git checkouts.
+def kconfig_digest(src, skip=()):
+    h = hashlib.sha256()
+    for base, dirs, files in os.walk(src):
+        dirs[:] = sorted([name for name in dirs if base != src or name not in skip])
+        for name in sorted(files):
+            if name.startswith('Kconfig'):
+                path = os.path.join(base, name)
+                h.update(("%s %r\n" % (os.path.relpath(path, src), os.stat(path).st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+# Returns True if dst changed, False if it was kept as it is and None on
+# failure. olddefconfig only runs on a changed config, and a config which
+# ends up the same as before keeps its mtime, so Kbuild does not rebuild.
+# source identifies the kernel tree, new symbols there change the config
+# olddefconfig produces even if the recipe config did not change.
+def update_config(base, fragments, dst, olddefconfig, source=None, logger=None):
+    logger = logger or logging.getLogger(__name__)
+    stamp = os.path.join(os.path.dirname(dst), '.kdev-config')
+
+    with open(base) as fp:
+        data = fp.read()
+
+    inputs = _digest(json.dumps([_digest(data), list(fragments), source]))
+    current = _read(dst)
+
+    try:
+        with open(stamp) as fp:
+            prev = json.load(fp)
+    except (IOError, OSError, ValueError):
+        prev = {}
+
+    if current is not None and prev.get("inputs") == inputs and prev.get("config") == _digest(current):
+        logger.info("Kernel config %s is up to date", dst)
+        return False
+
+    cfg = KconfigMap(logger)
+    cfg.parse(data)
+    cfg.merge(fragments)
+    merged = cfg.dumps()
+
+    if current == merged and prev.get("source") == source:
+        # The recipe already carries a complete config, nothing for olddefconfig to do.
+        final = current
+    else:
+        st = os.stat(dst) if current is not None else None
+
+        with open(dst + '.tmp', 'w') as fp:
+            fp.write(merged)
+        os.rename(dst + '.tmp', dst)
+
+        if not olddefconfig():
+            logger.error("olddefconfig failed for %s", dst)
+            return None
+
+        final = _read(dst)
+        if st is not None and final == current:
+            os.utime(dst, (st.st_atime, st.st_mtime))
+
+    with open(stamp, 'w') as fp:
+        json.dump({"inputs": inputs, "source": source, "config": _digest(final)}, fp)
+
+    if final == current:
+        logger.info("Kernel config %s is unchanged", dst)
+        return False
+
+    return True
@@ -22,28 +22,46 @@
 #
 
 import os
+import stat
+import time
+import socket
 import logging
-import pkg_resources
-import re
-import tempfile
-from klibs import BuildKernel, is_valid_kernel, KernelConfig
-from jsonparser import JSONParser
+from klibs import BuildKernel, is_valid_kernel
 from mkrootfs import RootFS
-from shutil import copy2
-from pyshell import PyShell
+from shutil import copy2, rmtree
+from kdev._scheduler import StageScheduler, default_jobs
+from kdev._jobs import parse_size, MEM_PER_JOB
+from kdev._index import parse_recipe
+from kdev._cache import StageCache, MAX_SIZE, hash_file, hash_tree, git_revision, tree_state, tree_changes
+from kdev._manifest import TreeManifest, patch_ext_image
+from kdev._cpio import gen_cpio_image
+from kdev._diskimg import DiskImage
+from kdev._flash import FlashWriter
+from kdev._shell import ShellSession, mount_points, device_size
+from kdev._report import BuildReport, record
+from kdev._kconfig import update_config, kconfig_digest
+from kdev._stream import stream_cmd
+from kdev._treesync import TreeSync
+from kdev._ccache import CompilerCache
+from kdev._mirror import SourceMirror, remote_revision
+from kdev._watch import TreeWatcher
+from kdev._boottest import BootTest, BootHistory, median, KERNEL_IMAGE
+from kdev._remote import RemoteExecutor, pick_address
+from kdev._modules import process_modules, strip_tool, COMPRESS
+from kdev._bootimg import gen_boot_image
+from kdev._qcow2 import export_qcow2
 
 valid_str = lambda x: True if x is not None and isinstance(x, basestring) and len(x) > 0 else False
 
-def get_recipe_name(recipe_dir, logger=None):
-    recipe = JSONParser(pkg_resources.resource_filename('kdev', 'schemas/board-schema.json'),
-                             os.path.join(recipe_dir, 'board.json'), extend_defaults=True,
-                             os_env=True, logger=logger)
-    recipecfg = recipe.get_cfg()
+def get_recipe_name(recipe_dir, logger=None, recipecfg=None):
+    if recipecfg is None:
+        recipecfg = parse_recipe(recipe_dir, logger)
 
     return recipecfg["recipe-name"] if valid_str(recipecfg["recipe-name"]) else None
 
 class KdevBuild(object):
-    def __init__(self, kernel_dir, rootfs_dir, recipe_dir, out_dir, logger=None):
+    def __init__(self, kernel_dir, rootfs_dir, recipe_dir, out_dir, cache_dir=None, recipecfg=None, mirror_dir=None,
+                 remote=None, load=None, cache_size=MAX_SIZE, logger=None):
         self.logger = logger or logging.getLogger(__name__)
 
         self.ksrc = os.path.abspath(kernel_dir)
@@ -57,6 +75,11 @@ class KdevBuild(object):
         self.recipe_dir = os.path.abspath(recipe_dir)
         self.recipename = None
         self.bparams = None
+        self.cache = None
+        self.mirror = None
+        self.remote = remote
+        self.load = load
+        self.report = None
 
         if not os.path.exists(self.ksrc):
             self.logger.error("Kernel Source dir %s does not exist", self.ksrc)
@@ -74,7 +97,11 @@ class KdevBuild(object):
                 self.logger.error("Missing %s file in recipe folder" % file)
                 raise AttributeError
 
-        self.recipename = get_recipe_name(recipe_dir)
+        # Callers which keep a recipe index hand in the validated config, the
+        # recipe is parsed here only once otherwise.
+        self.recipecfg = recipecfg if recipecfg is not None else parse_recipe(recipe_dir, logger)
+
+        self.recipename = get_recipe_name(recipe_dir, recipecfg=self.recipecfg)
 
         if self.recipename is None:
             self.logger.error("Invalid recipe name %s" % self.recipename)
@@ -84,11 +111,7 @@ class KdevBuild(object):
         self.idir = os.path.join(os.path.abspath(out_dir), self.recipename, 'install/rootfs')
         self.rout = os.path.join(os.path.abspath(out_dir), self.recipename, 'obj/rootfs')
         self.iout = os.path.join(os.path.abspath(out_dir), self.recipename, 'images')
-
-        self.recipe = JSONParser(pkg_resources.resource_filename('kdev', 'schemas/board-schema.json'),
-                                 os.path.join(recipe_dir, 'board.json'), extend_defaults=True,
-                                 os_env=True, logger=logger)
-        self.recipecfg = self.recipe.get_cfg()
+        self.logdir = os.path.join(os.path.abspath(out_dir), self.recipename, 'logs')
 
         for dirname in [self.rsrc, self.rout, self.idir, self.kout, self.iout]:
             if not os.path.exists(dirname):
@@ -109,6 +132,120 @@ class KdevBuild(object):
                                 cflags=self.kparams["compiler-options"]["cflags"],
                                 logger=self.logger)
 
+        if cache_dir is not None:
+            self.cache = StageCache(cache_dir, cache_size, logger=self.logger)
+
+        if mirror_dir is not None:
+            self.mirror = SourceMirror(mirror_dir, logger=self.logger)
+
+        self.new_report()
+
+    def new_report(self):
+        rdir = os.path.dirname(self.iout)
+        self.report = BuildReport(os.path.join(rdir, 'report.json'), rdir, logger=self.logger)
+
+    def _recipe_file(self, name):
+        if name is None or len(name) == 0:
+            return None
+
+        return os.path.join(self.recipe_dir, name)
+
+    def _file_digest(self, path):
+        if path is None:
+            return ''
+
+        if not os.path.exists(path):
+            return None
+
+        return hash_file(path)
+
+    def rootfs_config_files(self, params):
+        return self._recipe_file(params["config-file"]), self._recipe_file(params["diffconfig-file"])
+
+    def rootfs_inputs(self, params):
+        # Only the params which go into RootFS.build, so recipes which differ in
+        # hostname, gadgets or images still share their busybox build.
+        config, diffconfig = self.rootfs_config_files(params)
+
+        return {
+            "name": params["name"],
+            "source-url": params["source-url"],
+            "source-branch": params["source-branch"],
+            "arch-name": params["arch-name"],
+            "compiler-options": params["compiler-options"],
+            "config": self._file_digest(config),
+            "diffconfig": self._file_digest(diffconfig),
+        }
+
+    def _source_revision(self, params):
+        # Branches move, the key has to name the commit which gets built.
+        # Builds clone from the mirror whenever it has the branch, and it is
+        # fetched before the rootfs builds.
+        if self.mirror is not None:
+            rev = self.mirror.revision(params["source-url"], params["source-branch"])
+            if rev is not None:
+                return rev
+
+        return remote_revision(params["source-url"], params["source-branch"], self.logger)
+
+    def _rootfs_cache_key(self, params):
+        if self.cache is None:
+            return None
+
+        inputs = self.rootfs_inputs(params)
+        inputs["source-revision"] = self._source_revision(params)
+
+        return self.cache.key(inputs)
+
+    def _kernel_cache_key(self, stage):
+        if self.cache is None:
+            return None
+
+        # Compiler cache and obj baseline only change how fast a kernel builds.
+        params = dict(self.kparams)
+        params["compiler-options"] = dict(params["compiler-options"])
+        params["compiler-options"].pop("cache", None)
+        params.pop("obj-baseline", None)
+        # Module post processing happens after the kernel build.
+        if stage == 'kernel_build':
+            params.pop("modules", None)
+
+        inputs = {
+            "params": params,
+            "config": self._file_digest(self._recipe_file(self.kparams["config-file"])),
+            "revision": git_revision(self.ksrc, self._skip_dirs(), self.logger),
+        }
+
+        # Initramfs is linked into the kernel image, but not into the modules.
+        if stage == 'kernel_build':
+            inputs["initramfs"] = hash_tree(self.iobj.idir) or ''
+
+        return self.cache.key(inputs)
+
+    def _kernel_image(self):
+        arch = self.kparams["arch-name"]
+        return os.path.join(self.kout, 'arch', arch, 'boot', KERNEL_IMAGE.get(arch, 'bzImage'))
+
+    def _kernel_outputs(self):
+        return {
+            "bzImage": self._kernel_image(),
+            "config": self.kobj.cfg,
+        }
+
+    def _source_url(self, params):
+        if self.mirror is None:
+            return params["source-url"]
+
+        return self.mirror.url(params["source-url"], params["source-branch"])
+
+    def fetch_sources(self, params):
+        # A failed fetch is not fatal, the build falls back to an older
+        # mirror or the remote itself.
+        if not self.mirror.fetch(params["source-url"], params["source-branch"]):
+            self.logger.warning("Mirroring %s failed", params["source-url"])
+
+        return True
+
     def initramfs_build(self):
         if not self.iparams["enable-build"]:
             self.logger.warning("Initramfs build option is not enabled")
@@ -118,26 +255,30 @@ class KdevBuild(object):
             self.logger.error("Invalid initramfs object")
             return False
 
-        get_val = lambda x: self.rparams[x] if len(self.iparams[x]) > 0 else None
+        config, diffconfig = self.rootfs_config_files(self.iparams)
 
-        if get_val("config-file") is not None:
-            config =  os.path.join(self.recipe_dir, get_val("config-file"))
-        else:
-            config = None
+        key = self._rootfs_cache_key(self.iparams)
 
-        if get_val("diffconfig-file") is not None:
-            diffconfig =  os.path.join(self.recipe_dir, get_val("diffconfig-file"))
-        else:
-            diffconfig = None
+        if self.cache is not None and self.cache.restore('rootfs', key, {"rootfs": self.iobj.idir}, merge=True):
+            return True
+
+        # Modules and recipe updates from earlier builds share the install
+        # dir, only what busybox itself installs goes into the cache.
+        before = tree_state(self.iobj.idir)
 
-        self.iobj.build(self.iparams["source-url"], self.iparams["source-branch"],
+        self.iobj.build(self._source_url(self.iparams), self.iparams["source-branch"],
                         config, diffconfig, self.iparams["arch-name"],
                         self.iparams["compiler-options"]["CC"],
                         ' '.join(self.iparams["compiler-options"]["cflags"]),
                         )
+
+        if self.cache is not None:
+            self.cache.store('rootfs', key, {"rootfs": self.iobj.idir},
+                             {"rootfs": tree_changes(before, self.iobj.idir)})
+
         return True
 
-    def kernel_build(self):
+    def kernel_compile(self):
         if not self.kparams["enable-build"]:
             self.logger.warning("Kernel build option is not enabled")
             return False
@@ -146,36 +287,387 @@ class KdevBuild(object):
             self.logger.error("Invalid kernel build object")
             return False
 
-        self.kobj.copy_newconfig(os.path.join(self.recipe_dir, self.kparams["config-file"]))
+        key = self._kernel_cache_key('kernel_build')
+
+        # A cached kernel is only usable if its modules can be restored too, since the
+        # object tree needed for modules_install is not part of the cache.
+        if self.cache is not None and self.cache.lookup('kernel_modules_install',
+                                                        self._kernel_cache_key('kernel_modules_install')):
+            if self.cache.restore('kernel_build', key, self._kernel_outputs()):
+                return True
 
-        cobj = KernelConfig(src=self.kobj.cfg, logger=self.logger)
         config_list = []
         config_list.append('CONFIG_BLK_DEV_INITRD=y')
         config_list.append('CONFIG_INITRAMFS_SOURCE=%s' % self.iobj.idir)
         config_list.append('CONFIG_INITRAMFS_ROOT_UID=0')
         config_list.append('CONFIG_INITRAMFS_ROOT_GID=0')
-        cobj.merge_config(config_list)
 
-        self.kobj.make_olddefconfig()
+        self._seed_obj_dir()
+
+        def olddefconfig():
+            ret, out, err = self.kobj.make_olddefconfig()
+            return ret == 0
 
-        ret, out, err = self.kobj.make_kernel()
+        skip = self._skip_dirs()
+        source = git_revision(self.ksrc, skip, self.logger) or kconfig_digest(self.ksrc, skip)
+
+        if update_config(os.path.join(self.recipe_dir, self.kparams["config-file"]), config_list,
+                         self.kobj.cfg, olddefconfig, source, self.logger) is None:
+            return False
+
+        ret, tail = self.make_kernel()
 
         status = True if ret == 0 else False
 
         if not status:
-            self.logger.error(err)
-            self.logger.error(out)
+            self.logger.error('\n'.join(tail))
+            self.logger.error("Kernel build failed, full log in %s", os.path.join(self.logdir, 'kernel_build.log'))
+        elif self.cache is not None:
+            self.cache.store('kernel_build', key, self._kernel_outputs())
 
-        ret, out, err = self.kobj.make_modules_install(flags=["INSTALL_MOD_PATH=%s" % self.robj.idir])
+        return status
+
+    def _seed_obj_dir(self):
+        baseline = self.kparams["obj-baseline"]
+        if len(baseline) == 0 or os.path.exists(self.kobj.cfg):
+            return
+
+        baseline = os.path.join(self.recipe_dir, os.path.expanduser(baseline))
+        if not os.path.exists(os.path.join(baseline, '.config')):
+            self.logger.warning("Kernel obj baseline %s is not a built obj dir", baseline)
+            return
+
+        # Objects keep their timestamps, so make only rebuilds what the recipe
+        # config changes. Compilers rewrite objects in place, which rules out
+        # hardlinks into the shared baseline.
+        tsync = TreeSync(logger=self.logger)
+        tsync.sync(baseline, self.kout)
+        tsync.report(self.kout)
+
+    def _compiler_cache(self):
+        cparams = self.kparams["compiler-options"]["cache"]
+        if not cparams["enable"]:
+            return None
+
+        ccache = CompilerCache(cparams["tool"], cparams["cache-dir"] or None, cparams["max-size"],
+                               os.path.dirname(os.path.commonprefix([self.ksrc + os.sep, self.kout + os.sep])),
+                               logger=self.logger)
+
+        return ccache if ccache.available() else None
+
+    def _make_cmd(self, src, obj, cc):
+        cmd = ['make', '-C', src, 'O=%s' % obj, 'ARCH=%s' % self.kparams["arch-name"]]
+        if len(cc) > 0:
+            cmd.append('CC=%s' % cc)
+        if len(self.kparams["compiler-options"]["cflags"]) > 0:
+            cmd.append('KCFLAGS=%s' % ' '.join(self.kparams["compiler-options"]["cflags"]))
+
+        return cmd
+
+    def _remote_executor(self):
+        if self.remote is None or len(self.remote) == 0:
+            return None
+
+        executor = RemoteExecutor(pick_address(self.remote, self.recipename),
+                                  os.path.join(os.path.dirname(self.logdir), 'remote'),
+                                  token=os.environ.get("KDEV_REMOTE_TOKEN"), logger=self.logger)
+        if not executor.connect():
+            self.logger.warning("Building kernel locally")
+            return None
+
+        return executor
+
+    def make_kernel_remote(self, executor):
+        # Sources, the obj dir and the initramfs tree go to the worker content
+        # addressed, so only what changed since the last build is sent. The obj
+        # dir comes back with its mtimes, modules_install runs here.
+        name = "%s/%%s" % self.recipename
+        try:
+            src = executor.sync_up(self.ksrc, name % 'kernel-src', skip=self._skip_dirs())
+            initramfs = executor.sync_up(self.iobj.idir, name % 'initramfs')
+            if src is None or initramfs is None:
+                return 1, ["Uploading sources to %s failed" % executor.address]
+
+            # Paths in the obj dir, .config, auto.conf, .cmd files and the
+            # source link, are translated both ways.
+            paths = {self.ksrc: src, self.iobj.idir: initramfs, self.kout: executor.path(name % 'kernel-obj')}
+            obj = executor.sync_up(self.kout, name % 'kernel-obj', paths=paths)
+            if obj is None:
+                return 1, ["Uploading %s to %s failed" % (self.kout, executor.address)]
+
+            cmd = self._make_cmd(src, obj, self.kparams["compiler-options"]["CC"])
+            ret = stream_cmd(cmd, 'kernel_build', self.logdir, executor=executor, logger=self.logger)
+
+            back = dict([(remote, local) for local, remote in paths.items()])
+            if ret[0] == 0 and not executor.sync_down(name % 'kernel-obj', self.kout, exclude=['.config'],
+                                                      paths=back):
+                return 1, ["Fetching %s from %s failed" % (self.kout, executor.address)]
+        except (socket.error, EOFError, ValueError) as e:
+            return 1, ["Build worker %s: %s" % (executor.address, e)]
+        finally:
+            executor.close()
+
+        return ret
+
+    def make_kernel(self, args=(), name='kernel_build'):
+        # Module rebuilds are seconds of work, not worth shipping trees around.
+        executor = self._remote_executor() if len(args) == 0 else None
+        if executor is not None:
+            return self.make_kernel_remote(executor)
+
+        cc = self.kparams["compiler-options"]["CC"]
+        ccache = self._compiler_cache()
+        env = None
+
+        if ccache is not None:
+            cc = ccache.wrap(cc)
+            env = ccache.env()
+            before = ccache.stats()
+
+        # Output goes to the stage log as it is produced, only the tail is kept for errors.
+        ret = stream_cmd(self._make_cmd(self.ksrc, self.kout, cc) + list(args), name, self.logdir, env=env,
+                         logger=self.logger)
+
+        if ccache is not None:
+            stats = ccache.diff(before, ccache.stats())
+            if stats is not None:
+                self.logger.info("Compiler cache: %d hits, %d misses (%.0f%%)", stats["hits"], stats["misses"],
+                                 stats["hit-rate"])
+                record(**{"cc-cache-hits": stats["hits"], "cc-cache-misses": stats["misses"],
+                          "cc-cache-hit-rate": stats["hit-rate"]})
+
+        return ret
+
+    def _strip_flags(self):
+        # Kbuild strips before it signs, a stripped signed module would not load.
+        if not self.kparams["modules"]["strip"]:
+            return []
+
+        return ['INSTALL_MOD_STRIP=1', 'STRIP=%s' % strip_tool(self.kparams["compiler-options"]["CC"])]
+
+    def kernel_modules_install(self):
+        if not self.kparams["enable-build"]:
+            self.logger.warning("Kernel build option is not enabled")
+            return False
+
+        if self.kobj is None:
+            self.logger.error("Invalid kernel build object")
+            return False
+
+        key = self._kernel_cache_key('kernel_modules_install')
+        outputs = {"modules": os.path.join(self.robj.idir, 'lib/modules')}
+
+        if self.cache is not None and self.cache.restore('kernel_modules_install', key, outputs):
+            return True
+
+        ret, out, err = self.kobj.make_modules_install(flags=["INSTALL_MOD_PATH=%s" % self.robj.idir] +
+                                                       self._strip_flags())
 
         status = True if ret == 0 else False
 
         if not status:
             self.logger.error(err)
             self.logger.error(out)
+            return False
+
+        # Stripped and compressed modules are what goes into the cache, the
+        # rootfs images and the flashed drive.
+        mparams = self.kparams["modules"]
+        stats = process_modules(self.robj.idir, mparams["compress"], logger=self.logger)
+        if stats is None:
+            return False
+        if stats["modules"] > 0:
+            record(**{"modules": stats["modules"], "modules-bytes-before": stats["bytes-before"],
+                      "modules-bytes-after": stats["bytes-after"]})
+
+        if self.cache is not None and os.path.exists(outputs["modules"]):
+            self.cache.store('kernel_modules_install', key, outputs)
 
         return status
 
+    def kernel_build(self):
+        if not self.kernel_compile():
+            return False
+
+        return self.kernel_modules_install()
+
+    def _skip_dirs(self):
+        skip = ['.git']
+        out = os.path.relpath(os.path.dirname(os.path.dirname(self.logdir)), self.ksrc)
+        if not out.startswith(os.pardir):
+            skip.append(out.split(os.sep)[0])
+
+        return skip
+
+    def changed_module_dirs(self, since):
+        dirs = set()
+        headers = []
+        skip = self._skip_dirs()
+
+        for base, subdirs, files in os.walk(self.ksrc):
+            if base == self.ksrc:
+                subdirs[:] = [name for name in subdirs if name not in skip]
+            rel = os.path.relpath(base, self.ksrc)
+            for name in files:
+                if not name.endswith(('.c', '.h', '.S')) and name not in ['Makefile', 'Kbuild']:
+                    continue
+                if os.stat(os.path.join(base, name)).st_mtime <= since:
+                    continue
+                # Shared headers can change any object, that needs a full kernel build.
+                if name.endswith('.h') and 'include' in rel.split(os.sep):
+                    headers.append(os.path.join(rel, name))
+                elif rel != os.curdir:
+                    dirs.add(rel)
+
+        return sorted(dirs), headers
+
+    def _modules_staging(self, path):
+        return os.path.join(os.path.dirname(self.iout), 'staging', 'modules', path.replace(os.sep, '_'))
+
+    def make_module_dir(self, path):
+        ret, tail = self.make_kernel(['M=%s' % path, 'modules'], 'modules_%s' % path.replace(os.sep, '_'))
+        if ret != 0:
+            self.logger.error('\n'.join(tail))
+            self.logger.error("Building modules in %s failed", path)
+            return False
+
+        # Modules are only signed by modules_install, so they go through it
+        # into a staging tree, at the same place an in-tree install puts
+        # them. depmod runs once the install trees are updated.
+        staging = self._modules_staging(path)
+        if os.path.exists(staging):
+            rmtree(staging)
+        ret, tail = self.make_kernel(['M=%s' % path, 'INSTALL_MOD_PATH=%s' % staging,
+                                      'INSTALL_MOD_DIR=kernel/%s' % path, 'DEPMOD=true', 'modules_install'] +
+                                     self._strip_flags(),
+                                     'modules_install_%s' % path.replace(os.sep, '_'))
+        if ret != 0:
+            self.logger.error('\n'.join(tail))
+            self.logger.error("Installing modules of %s failed", path)
+
+        return ret == 0
+
+    def _install_module(self, ko, rel, release, trees):
+        installed = []
+
+        for tree in trees:
+            dst = os.path.join(tree, 'lib/modules', release, 'kernel', rel)
+            for ext in [''] + [COMPRESS[name][1] for name in COMPRESS]:
+                if os.path.exists(dst + ext):
+                    os.remove(dst + ext)
+            if not os.path.exists(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            copy2(ko, dst)
+            installed.append(dst)
+
+        return installed
+
+    def build_modules(self, dirs=None, jobs=None):
+        if not os.path.exists(os.path.join(self.kout, 'Module.symvers')):
+            self.logger.error("No built kernel in %s, run build-kernel first", self.kout)
+            return False
+
+        self.new_report()
+
+        stamp = os.path.join(self.kout, '.kdev-modules')
+        start = time.time()
+        trees = {}
+
+        if dirs is None or len(dirs) == 0:
+            # Whatever changed since the last full or module build.
+            since = max([os.stat(path).st_mtime for path in [stamp, os.path.join(self.kout, 'Module.symvers')]
+                         if os.path.exists(path)])
+            dirs, headers = self.changed_module_dirs(since)
+            if len(headers) > 0:
+                self.logger.error("Headers changed, run build-kernel: %s", ' '.join(headers))
+                return False
+            if len(dirs) == 0:
+                self.logger.info("No module sources changed")
+                return True
+        else:
+            paths = []
+            for path in dirs:
+                rel = os.path.relpath(os.path.abspath(path), self.ksrc)
+                if rel.startswith(os.pardir) or not os.path.isdir(os.path.join(self.ksrc, rel)):
+                    self.logger.error("%s is not a dir in the kernel tree %s", path, self.ksrc)
+                    return False
+                paths.append(rel)
+            dirs = paths
+
+        self.logger.info("Building modules in %s", ' '.join(dirs))
+
+        sched = self._scheduler(jobs)
+        for path in dirs:
+            sched.add_stage('modules:%s' % path, lambda path=path: self.make_module_dir(path))
+
+        with self.report.measure_build('build-modules') as result:
+            result["status"] = sched.run()
+
+            # Only modules make actually rewrote go into the install trees,
+            # and only into trees which got modules from modules_install.
+            release_file = os.path.join(self.kout, 'include/config/kernel.release')
+            if result["status"] and os.path.exists(release_file):
+                with open(release_file) as fp:
+                    release = fp.read().strip()
+
+                for name, obj in [("rootfs", self.robj), ("initramfs", self.iobj)]:
+                    if os.path.isdir(os.path.join(obj.idir, 'lib/modules', release)):
+                        trees[name] = obj.idir
+
+                # The signed copies from the staging trees, of the modules
+                # make rebuilt.
+                built = []
+                for path in dirs:
+                    for base, subdirs, files in os.walk(os.path.join(self.kout, path)):
+                        for name in files:
+                            ko = os.path.join(base, name)
+                            if not name.endswith('.ko') or os.stat(ko).st_mtime < start:
+                                continue
+                            rel = os.path.relpath(ko, self.kout)
+                            staged = os.path.join(self._modules_staging(path), 'lib/modules', release, 'kernel', rel)
+                            if not os.path.exists(staged):
+                                self.logger.error("Module %s was not installed to %s", rel, staged)
+                                result["status"] = False
+                                continue
+                            built.append((staged, rel))
+
+                mparams = self.kparams["modules"]
+                for name, tree in trees.items():
+                    if not result["status"]:
+                        break
+                    installed = []
+                    for staged, rel in built:
+                        installed += self._install_module(staged, rel, release, [tree])
+                    stats = process_modules(tree, mparams["compress"], jobs=jobs, modules=installed,
+                                            logger=self.logger)
+                    if stats is None:
+                        result["status"] = False
+                    self.logger.info("Installed %d modules into %s", len(installed), tree)
+
+                if len(built) == 0:
+                    trees = {}
+
+        self.report.add_stages(sched)
+        self.report.save()
+
+        if not result["status"]:
+            self.logger.error("Building modules failed")
+            return False
+
+        with open(stamp, 'w') as fp:
+            fp.write("%f\n" % start)
+        os.utime(stamp, (start, start))
+
+        # Initramfs is linked into the kernel image, which only needs a relink,
+        # the modules are installed already. The rootfs only needs its image
+        # regenerated.
+        if "initramfs" in trees:
+            return self.build(kbuild=True, kmodules=False, gen_image=True, jobs=jobs, reset=False)
+        if "rootfs" in trees:
+            return self.build(gen_image=True, jobs=jobs, reset=False)
+
+        return True
+
     def rootfs_build(self):
         if not self.rparams["enable-build"]:
             self.logger.warning("Rootfs build option is not enabled")
@@ -185,24 +677,27 @@ class KdevBuild(object):
             self.logger.error("Invalid rootfs object")
             return False
 
-        get_val = lambda x: self.rparams[x] if len(self.rparams[x]) > 0 else None
+        config, diffconfig = self.rootfs_config_files(self.rparams)
 
-        if get_val("config-file") is not None:
-            config =  os.path.join(self.recipe_dir, get_val("config-file"))
-        else:
-            config = None
+        key = self._rootfs_cache_key(self.rparams)
 
-        if get_val("diffconfig-file") is not None:
-            diffconfig =  os.path.join(self.recipe_dir, get_val("diffconfig-file"))
-        else:
-            diffconfig = None
+        if self.cache is not None and self.cache.restore('rootfs', key, {"rootfs": self.robj.idir}, merge=True):
+            return True
+
+        # Modules and recipe updates from earlier builds share the install
+        # dir, only what busybox itself installs goes into the cache.
+        before = tree_state(self.robj.idir)
 
-        self.robj.build(self.rparams["source-url"], self.rparams["source-branch"],
+        self.robj.build(self._source_url(self.rparams), self.rparams["source-branch"],
                         config, diffconfig, self.rparams["arch-name"],
                         self.rparams["compiler-options"]["CC"],
                         ' '.join(self.rparams["compiler-options"]["cflags"]),
                         )
 
+        if self.cache is not None:
+            self.cache.store('rootfs', key, {"rootfs": self.robj.idir},
+                             {"rootfs": tree_changes(before, self.robj.idir)})
+
         return True
 
     def rootfs_update(self):
@@ -233,7 +728,9 @@ class KdevBuild(object):
 
         if os.path.exists(os.path.join(self.recipe_dir, update_dir)):
             if self.rparams["custom-update"]:
-                self.robj.update_rootfs(os.path.join(self.recipe_dir, update_dir), self.robj.idir)
+                tsync = TreeSync(logger=self.logger)
+                tsync.sync(os.path.join(self.recipe_dir, update_dir), self.robj.idir)
+                tsync.report(self.robj.idir)
 
         return True
 
@@ -250,239 +747,466 @@ class KdevBuild(object):
 
         if os.path.exists(os.path.join(self.recipe_dir, update_dir)):
             if self.iparams["custom-update"]:
-                self.iobj.update_rootfs(os.path.join(self.recipe_dir, update_dir), self.iobj.idir)
+                tsync = TreeSync(logger=self.logger)
+                tsync.sync(os.path.join(self.recipe_dir, update_dir), self.iobj.idir)
+                tsync.report(self.iobj.idir)
 
         return True
 
+    def _gen_rootfs_image(self, obj, params):
+        image = os.path.join(self.iout, params["image-name"])
+        mfile = image + '.manifest'
+
+        kind = params["image-type"]
+        if kind == 'cpio':
+            kind = "cpio-%s-%d-%s" % (params["compression"], params["compression-level"], params["reproducible"])
+
+        old = TreeManifest.load(mfile)
+        new = TreeManifest.scan(obj.idir, old)
+
+        if old is not None and old.image_matches(image, kind):
+            added, removed, changed = old.diff(new)
+            count = len(added) + len(removed) + len(changed)
+
+            if count == 0:
+                self.logger.info("Image %s is up to date", image)
+                return True
+
+            # Small updates are written into the existing ext image, anything
+            # larger is cheaper to regenerate from scratch.
+            if params["image-type"].startswith('ext') and count <= max(1, len(new.entries) // 10):
+                self.logger.info("Patching %d entries in image %s", count, image)
+                if patch_ext_image(image, obj.idir, old, new, self.logger):
+                    new.set_image(image, kind)
+                    new.save(mfile)
+                    return True
+                self.logger.warning("Patching image %s failed, regenerating it", image)
+
+        if os.path.exists(mfile):
+            os.remove(mfile)
+
+        if params["image-type"] == 'cpio':
+            if not gen_cpio_image(obj.idir, image, params["compression"], params["compression-level"],
+                                  params["compression-threads"], params["reproducible"], self.logger):
+                return False
+        else:
+            obj.gen_image(params["image-type"], image)
+
+        if not os.path.exists(image):
+            self.logger.error("Generating image %s failed", image)
+            return False
+
+        new.set_image(image, kind)
+        new.save(mfile)
+
+        return True
+
+    def _cmdline(self):
+        cmdline = ''
+        if os.path.exists(os.path.join(self.recipe_dir, 'cmdline.txt')):
+            with open(os.path.join(self.recipe_dir, 'cmdline.txt')) as fp:
+                cmdline = ' '.join(fp.read().split())
+        return cmdline
+
+    def _gen_boot_image(self, kernel):
+        # A compressed cpio initramfs goes in as is, the bootloader hands it
+        # to the kernel without looking at it.
+        ramdisk = None
+        if self.iparams["gen-image"] and self.iparams["image-type"] == 'cpio':
+            ramdisk = os.path.join(self.iout, self.iparams["image-name"])
+
+        return gen_boot_image(os.path.join(self.iout, self.bparams["image-name"]), kernel, ramdisk,
+                              cmdline=self._cmdline(), name=self.recipecfg["recipe-name"], params=self.bparams,
+                              logger=self.logger)
+
     def gen_image(self):
         if self.rparams["gen-image"]:
             if self.robj is None:
                 self.logger.error("Invalid rootfs object")
                 return False
-            else:
-                self.robj.gen_image(self.rparams["image-type"], os.path.join(self.iout, self.rparams["image-name"]))
+            elif not self._gen_rootfs_image(self.robj, self.rparams):
+                return False
 
         if self.iparams["gen-image"]:
             if self.iobj is None:
                 self.logger.error("Invalid initramfs object")
                 return False
-            else:
-                self.iobj.gen_image(self.iparams["image-type"], os.path.join(self.iout, self.iparams["image-name"]))
+            elif not self._gen_rootfs_image(self.iobj, self.iparams):
+                return False
 
+        kernel = self._kernel_image()
         if self.kparams["gen-image"]:
-            copy2(os.path.join(self.kout, 'arch', self.kparams["arch-name"], 'boot/bzImage'),
-                  os.path.join(self.iout, self.kparams["image-name"]))
+            copy2(kernel, os.path.join(self.iout, self.kparams["image-name"]))
+            kernel = os.path.join(self.iout, self.kparams["image-name"])
+
+        if self.bparams["gen-image"]:
+            return self._gen_boot_image(kernel)
 
         return True
 
-    def build(self, kbuild=False, rbuild=False, ibuild=False, rupdate=False, iupdate=False, gen_image=False):
+    def _scheduler(self, jobs=None):
+        # An explicit job count wins, otherwise jobs are sized from cpus, cpu
+        # quota and memory and capped by the recipe.
+        bparams = self.recipecfg["build-params"]
+        if jobs is None or jobs <= 0:
+            jobs = default_jobs(parse_size(bparams["mem-per-job"]) or MEM_PER_JOB)
+            if bparams["max-jobs"] > 0:
+                jobs = min(jobs, bparams["max-jobs"])
+
+        load = self.load if self.load is not None else bparams["load-average"]
+
+        return StageScheduler(jobs=jobs, load=load if load > 0 else None, logger=self.logger)
+
+    def build(self, kbuild=False, rbuild=False, ibuild=False, rupdate=False, iupdate=False, gen_image=False,
+              jobs=None, kmodules=True, reset=True):
         self.logger.info("Building recipe %s", self.recipecfg["recipe-name"])
-        status = True
+
+        # Watch loops and the daemon build many times with the same object,
+        # only builds called from other steps add to their report.
+        if reset:
+            self.new_report()
+
+        # Busybox rootfs and initramfs builds are independent of each other. Kernel only needs
+        # the initramfs install dir for CONFIG_INITRAMFS_SOURCE, and its modules go into the
+        # rootfs install dir. Updates and images keep the order of the sequential build.
+        sched = self._scheduler(jobs)
+
+        # Sources are mirrored in the background while the kernel builds, once
+        # per url. Cached trees need the fetch too, it decides which commit
+        # the cache key names.
+        fetches = {}
+        for enabled, name, params in [(rbuild, 'rootfs', self.rparams), (ibuild, 'initramfs', self.iparams)]:
+            if not enabled or self.mirror is None or not params["enable-build"]:
+                continue
+            if params["source-url"] not in fetches:
+                fetches[params["source-url"]] = 'fetch_%s' % name
+                sched.add_stage(fetches[params["source-url"]], lambda params=params: self.fetch_sources(params))
+
         if rbuild:
-            status = self.rootfs_build()
-            if not status:
-                self.logger.error("Rootfs build failed")
-                return status
+            sched.add_stage('rootfs_build', self.rootfs_build,
+                            deps=[fetches[url] for url in [self.rparams["source-url"]] if url in fetches])
 
         if ibuild:
-            status = self.initramfs_build()
-            if not status:
-                self.logger.error("Initramfs build failed")
-                return status
+            sched.add_stage('initramfs_build', self.initramfs_build,
+                            deps=[fetches[url] for url in [self.iparams["source-url"]] if url in fetches])
 
         if kbuild:
-            status = self.kernel_build()
-            if not status:
-                self.logger.error("Kernel build failed")
-                return status
+            sched.add_stage('kernel_build', self.kernel_compile, deps=['initramfs_build'], weight=4)
+            if kmodules:
+                sched.add_stage('kernel_modules_install', self.kernel_modules_install,
+                                deps=['kernel_build', 'rootfs_build'])
 
         if rupdate:
-            status = self.rootfs_update()
-            if not status:
-                self.logger.error("Rootfs update failed")
-                return status
+            sched.add_stage('rootfs_update', self.rootfs_update,
+                            deps=['rootfs_build', 'kernel_modules_install'])
 
         if iupdate:
-            status = self.initramfs_update()
-            if not status:
-                self.logger.error("Initramfs update failed")
-                return status
+            sched.add_stage('initramfs_update', self.initramfs_update,
+                            deps=['initramfs_build', 'kernel_build'])
 
         if gen_image:
-            status = self.gen_image()
-            if not status:
-                self.logger.error("Generate image failed")
-                return status
+            sched.add_stage('gen_image', self.gen_image,
+                            deps=list(sched.stages.keys()))
+
+        with self.report.measure_build('build') as result:
+            result["status"] = sched.run()
+
+        self.report.add_stages(sched)
+        self.report.save()
+        self.report.summary()
+
+        if not result["status"]:
+            self.logger.error("Building recipe %s failed", self.recipecfg["recipe-name"])
+
+        return result["status"]
+
+    def watch(self, delay=0.5, jobs=None):
+        # Changed input -> build() flags of the stages it invalidates. Initramfs
+        # is linked into the kernel, and a rebuilt rootfs needs its modules
+        # installed again, so both pull in the kernel stages, which are cheap
+        # when the kernel itself did not change.
+        actions = {
+            "kernel": dict(kbuild=True),
+            "kernel-config": dict(kbuild=True),
+            "rootfs-config": dict(rbuild=True, kbuild=True, rupdate=True),
+            "rootfs-update": dict(rupdate=True),
+            "initramfs-config": dict(ibuild=True, iupdate=True, kbuild=True),
+            "initramfs-update": dict(iupdate=True, kbuild=True),
+        }
+
+        watcher = TreeWatcher(logger=self.logger)
+        watcher.add_skip(os.path.dirname(os.path.dirname(self.iout)))
+        watcher.add_tree(self.ksrc, "kernel")
+        watcher.add_file(self._recipe_file(self.kparams["config-file"]), "kernel-config")
+        watcher.add_file(os.path.join(self.recipe_dir, 'board.json'), "recipe")
+
+        for name, params in [("rootfs", self.rparams), ("initramfs", self.iparams)]:
+            for cfg in self.rootfs_config_files(params):
+                if cfg is not None:
+                    watcher.add_file(cfg, "%s-config" % name)
+            if params["custom-update"]:
+                watcher.add_tree(os.path.join(self.recipe_dir, params["custom-update-dir"]), "%s-update" % name)
+
+        self.logger.info("Watching %d dirs for recipe %s", len(watcher.watches), self.recipename)
 
-        return status
+        try:
+            while True:
+                tags = watcher.wait(delay)
+                self.logger.info("Changed: %s", ' '.join(sorted(tags)))
+
+                # A new board.json can change every param, the caller has to
+                # start over with a new build object.
+                if "recipe" in tags:
+                    return True
+
+                flags = {"gen_image": True}
+                for tag in tags:
+                    flags.update(actions[tag])
+                self.build(jobs=jobs, **flags)
+        except KeyboardInterrupt:
+            return False
+        finally:
+            watcher.close()
 
-    def burn_drive(self, dev=None, force=False):
+    def boot_test(self, runs=1, timeout=120, threshold=0.1):
+        kernel = os.path.join(self.iout, self.kparams["image-name"])
+        if not os.path.exists(kernel):
+            self.logger.error("Kernel image %s does not exist, run gen-image first", kernel)
+            return False
 
-        self.logger.info("Burning %s device to %s", self.recipecfg["recipe-name"], dev)
+        images = {}
+        for name, params in [("initrd", self.iparams), ("rootfs", self.rparams)]:
+            image = os.path.join(self.iout, params["image-name"])
+            if params["gen-image"] and os.path.exists(image):
+                images[name] = image
+
+        cmdline = self._cmdline()
+
+        test = BootTest(self.kparams["arch-name"], kernel, images.get("initrd"), images.get("rootfs"), cmdline,
+                        timeout=timeout, logger=self.logger)
+        history = BootHistory(os.path.join(os.path.dirname(self.iout), 'boot-history.json'), threshold,
+                              logger=self.logger)
+
+        results = []
+        for index in range(runs):
+            if not os.path.exists(self.logdir):
+                os.makedirs(self.logdir)
+            result = test.run(os.path.join(self.logdir, 'boot-test.log'))
+            self.logger.info("Boot %d/%d: %s, userspace %s, shell %s", index + 1, runs, result["status"],
+                             "%.2fs" % result["userspace"] if result["userspace"] is not None else "-",
+                             "%.2fs" % result["shell"] if result["shell"] is not None else "-")
+            if result["status"] != "ok":
+                self.logger.error("Boot test failed, console log in %s", os.path.join(self.logdir, 'boot-test.log'))
+                history.add({"time": time.time(), "status": result["status"], "runs": index + 1})
+                return False
+            results.append(result)
+
+        # What was booted, so a regression can be tied to the change that caused it.
+        inputs = {"kernel.img": hash_file(kernel)}
+        inputs["kernel-config"] = self._file_digest(self._recipe_file(self.kparams["config-file"]))
+        for name, params in [("rootfs", self.rparams), ("initramfs", self.iparams)]:
+            config, diffconfig = self.rootfs_config_files(params)
+            inputs["%s-config" % name] = self._file_digest(config)
+            inputs["%s-diffconfig" % name] = self._file_digest(diffconfig)
+
+        entry = {
+            "time": time.time(),
+            "status": "ok",
+            "runs": runs,
+            "userspace": median([result["userspace"] for result in results]),
+            "shell": median([result["shell"] for result in results]),
+            "inputs": inputs,
+        }
+
+        regressions = history.check(entry)
+        entry["regressions"] = regressions
+        history.add(entry)
+
+        for regression in regressions:
+            self.logger.error("Boot time regression: %s", regression)
+
+        return len(regressions) == 0
+
+    def _stage_partition(self, part, staging):
+        # Staging trees are kept between runs, so only changed files are
+        # transferred. Nothing writes into them in place, which makes it
+        # safe to hardlink the sources.
+        tsync = TreeSync(hardlink=True, logger=self.logger)
+        tsync.seen.add(os.path.abspath(staging))
+        if not os.path.exists(staging):
+            os.makedirs(staging)
+
+        def get_update_dir(root, dir):
+            if root is None and len(dir) > 0:
+                if dir.startswith("/"):
+                    return dir
+                elif dir.startswith("."):
+                    return os.path.join(os.getcwd(), dir)
+            else:
+                return os.path.join(root, dir)
+
+        for uparams in part["updates"] if part["part-update"] else []:
+            sdir = get_update_dir(self.recipe_dir, uparams["update-sdir"])
+            ddir = get_update_dir(staging, uparams["update-ddir"])
+            kdir = get_update_dir(staging, uparams["kernel-ddir"])
+            if uparams["sync-kernel"]:
+                tsync.sync_file(os.path.join(self.iout, self.kparams["image-name"]),
+                                os.path.join(kdir, self.kparams["image-name"]))
+            if uparams["sync-rootfs"]:
+                tsync.sync(self.robj.idir, staging)
+
+            if len(uparams["update-sdir"]) == 0:
+                continue
+
+            if os.path.isfile(sdir):
+                tsync.sync_file(sdir, os.path.join(ddir, os.path.basename(sdir)))
+            elif os.path.exists(sdir):
+                tsync.sync(sdir, ddir)
+            else:
+                self.logger.error("Source dir %s does not exist" % sdir)
+
+        tsync.prune(staging)
+        tsync.report(staging)
+
+        if part["install-grub"]:
+            efi_dir = os.path.join(staging, 'EFI/BOOT')
+            if not os.path.exists(efi_dir):
+                os.makedirs(efi_dir)
+            if os.path.exists(os.path.join(efi_dir, 'BOOTX64.EFI')):
+                os.remove(os.path.join(efi_dir, 'BOOTX64.EFI'))
+            # The standalone image boots from its embedded memdisk, so the
+            # config goes in there. A config staged in the partition is used
+            # as is, otherwise the embedded one loads the first grub.cfg found
+            # on the disks.
+            grub_cfg = None
+            for name in ['EFI/BOOT/grub.cfg', 'boot/grub/grub.cfg']:
+                if os.path.exists(os.path.join(staging, name)):
+                    grub_cfg = os.path.join(staging, name)
+                    break
+            if grub_cfg is None:
+                grub_cfg = staging + '.grub.cfg'
+                with open(grub_cfg, 'w') as fp:
+                    fp.write("search --no-floppy --file --set=root /boot/grub/grub.cfg\n")
+                    fp.write("configfile /boot/grub/grub.cfg\n")
+            sh = ShellSession(logger=self.logger)
+            ret = sh.cmd("grub-mkstandalone -O x86_64-efi -o %s boot/grub/grub.cfg=%s" %
+                         (os.path.join(efi_dir, 'BOOTX64.EFI'), grub_cfg))
+            sh.close()
+            if ret[0] != 0:
+                self.logger.error("Installing grub to %s failed" % part["part-name"])
+                self.logger.error(ret)
+                return False
 
-        if not self.dparams:
-            self.logger.error("Invalid dparams")
-            return False
+        return True
 
-        if dev is None:
-            dev = self.dparams["disk-name"]
+    def gen_disk_image(self, image=None, jobs=None):
+        if image is None:
+            image = os.path.join(self.iout, self.dparams["disk-name"])
 
-        if not self.dparams["gen-image"]:
-            self.logger.warning("Generate disk image is disabled")
-            return False
+        disk = DiskImage(image, self.dparams["disk-size"], seed=self.recipename, logger=self.logger)
 
-        sh = PyShell(logger=self.logger)
+        with self.report.measure_build('gen_disk_image') as result:
+            result["status"] = self._gen_disk_image(disk, image, jobs)
 
-        sh.update_shell()
+        self.report.save()
+        self.report.summary()
 
-        if dev is not None:
-            sh.cmd("rm -fr %s" %  dev)
-            self.logger.warning("Creating device %s" % dev)
-            sh.cmd("dd if=/dev/zero of=%s bs=1 count=0 seek=%dM" % (self.dparams["disk-name"], self.dparams["disk-size"]))
+        return result["status"]
 
-        ret = sh.cmd("sudo parted %s print free | grep \"Disk %s\" | cut -d' ' -f3" % (dev, dev))
-        if ret[0] != 0:
-            self.logger.error("Getting disk size %s command failed" % dev)
-            return False
+    def _gen_disk_image(self, disk, image, jobs):
+        for part in self.dparams["partitions"]:
+            staging = os.path.join(os.path.dirname(self.iout), 'staging', part["part-name"])
+            with self.report.measure("stage_%s" % part["part-name"]) as result:
+                result["status"] = self._stage_partition(part, staging)
+            if not result["status"]:
+                return False
+            disk.add_partition(part["part-name"], part["part-size"], part["part-type"], part["part-fstype"],
+                               part["part-fsflags"], staging)
 
-        regex = re.compile(r'(\d+(?:\.\d+)?)\s*([kmgtp]?b)', re.IGNORECASE)
+        with self.report.measure('mkfs') as result:
+            result["status"] = disk.build(jobs)
+        if not result["status"]:
+            self.logger.error("Creating disk image %s failed" % image)
+            return False
 
-        order = ['b', 'kb', 'mb', 'gb', 'tb', 'pb']
+        if self.dparams["gen-craff-image"]:
+            with self.report.measure('craff') as result:
+                sh = ShellSession(logger=self.logger)
+                ret = sh.cmd("craff %s -o %s" % (image, self.dparams["craff-image-name"]))
+                sh.close()
+                result["status"] = ret[0] == 0
+            if not result["status"]:
+                self.logger.error("Creating craff image %s failed" % self.dparams["craff-image-name"])
+                return False
 
-        for value, unit in regex.findall(ret[1].strip()):
-            size = int(float(value) * (1024 ** order.index(unit.lower())))
+        if self.dparams["gen-qcow2-image"]:
+            export = os.path.join(os.path.dirname(image), self.dparams["qcow2-image-name"])
+            with self.report.measure('qcow2') as result:
+                result["status"] = export_qcow2(image, export, self.dparams["qcow2-compression-level"], jobs or 0,
+                                                self.logger) is not None
+            if not result["status"]:
+                return False
 
-        if size < (1024 * 1024 * 100 ):
-            self.logger.warn("Device size should be atleast 100MB")
+        disk.report()
 
-        self.logger.info("Device size is %d" % size)
+        return True
 
-        if force is False:
-            raw_input("Proceeding further will wipe all data in %s, press enter to continue" % dev)
+    def burn_drive(self, dev=None, force=False, image=None, full=False):
 
-        ret = sh.cmd("sudo fdisk -l %s | grep '^/dev' | cut -d' ' -f1" % (dev))
-        for part in ret[1].split():
-            ret = sh.cmd("mount | grep %s" % part)
-            if len(ret[1].strip()) == 0:
-                self.logger.info("%s partition is not mounted" % part)
-            else:
-                ret = sh.cmd(("sudo umount %s" % part))
-                if ret[0] != 0 and ret[0] != 32:
-                    self.logger.error(ret)
-                    return False
-                if ret[0] == 32:
-                    self.logger.warn(ret[1])
+        self.logger.info("Burning %s device to %s", self.recipecfg["recipe-name"], dev)
 
-        sh.cmd("sudo wipefs -a %s" % (dev))
+        self.new_report()
 
-        ret = sh.cmd('echo -e "g\nw" | fdisk %s' % dev)
-        if ret[0] != 0:
-            self.logger.error("Creating label failed")
-            self.logger.error(ret)
+        if not self.dparams:
+            self.logger.error("Invalid dparams")
             return False
 
-        part_index = 1
-
-        def create_loopdev():
-            ret = sh.cmd("sudo losetup -fP %s" % (dev))
-            if ret[0] != 0:
-                self.logger.error("losetup partition failed")
-                self.logger.error(ret)
-                return False
+        if not self.dparams["gen-image"]:
+            self.logger.warning("Generate disk image is disabled")
+            return False
 
-            ret = sh.cmd("losetup -a | grep %s | cut -d':' -f1" % (dev))
-            if ret[0] != 0:
-                self.logger.error("losetup grep device failed")
-                self.logger.error(ret)
+        # Paths outside /dev are image files which can be assembled offline,
+        # without loop devices, mounts or sudo. Under /dev only block devices
+        # are valid, a mistyped or unplugged /dev/sdX is not turned into a file.
+        if dev is None or not os.path.exists(dev) or not stat.S_ISBLK(os.stat(dev).st_mode):
+            if dev is not None and os.path.realpath(os.path.abspath(dev)).startswith('/dev/'):
+                self.logger.error("Device %s is not a block device" % dev)
                 return False
-
-            if ret[1].split() <  1:
-                self.logger.error("losetup grep device not found in list")
+            if image is not None:
+                self.logger.error("Prebuilt image %s can only be flashed to a block device" % image)
                 return False
+            return self.gen_disk_image(dev)
 
-            return ret[1].split()[0]
-
-        temp_dir = tempfile.mkdtemp()
-
-        for part in self.dparams["partitions"]:
-            ret = sh.cmd('echo -e "n\n%d\n\n+%dM\nw" | fdisk %s' % (part_index, part["part-size"], dev))
-            if ret[0] != 0:
-                self.logger.error("Creating parition failed")
-                self.logger.error(ret)
+        if image is None:
+            image = os.path.join(self.iout, self.dparams["disk-name"])
+            if not self.gen_disk_image(image):
                 return False
 
-            if part_index > 1:
-                ret = sh.cmd('echo -e "t\n%d\n%d\nw" | fdisk %s' % (part_index, part["part-type"], dev))
-            else:
-                ret = sh.cmd('echo -e "t\n%d\nw" | fdisk %s' % (part["part-type"], dev))
-
-            if ret[0] != 0:
-                self.logger.error("Setting parition type failed")
-                self.logger.error(ret)
-                return False
+        if not os.path.exists(image):
+            self.logger.error("Disk image %s does not exist" % image)
+            return False
 
-            ldev = create_loopdev()
+        if force is False:
+            raw_input("Proceeding further will wipe all data in %s, press enter to continue" % dev)
 
-            if "ext" in part["part-fstype"]:
-                ret = sh.cmd("sudo mkfs.%s -L %s %sp%d" % (part["part-fstype"], part["part-name"], ldev, part_index))
-            elif part["part-fstype"] == "fat32":
-                ret = sh.cmd("sudo mkfs.fat -F 32 -n %s -I %sp%d" % (part["part-name"], ldev, part_index))
-            elif part["part-fstype"] == "fat16":
-                ret = sh.cmd("sudo mkfs.fat -F 16 -n %s -I %sp%d" % (part["part-name"], ldev, part_index))
+        if device_size(dev) < os.path.getsize(image):
+            self.logger.error("Device %s is smaller than disk image %s" % (dev, image))
+            return False
 
+        targets = mount_points(dev)
+        if len(targets) > 0:
+            sh = ShellSession(sudo=True, logger=self.logger)
+            # Nested mounts have to go before their parents.
+            ret = sh.batch(["umount '%s'" % target for target in sorted(targets, reverse=True)])
+            sh.report()
+            sh.close()
             if ret[0] != 0:
-                self.logger.error("format partition %s failed" % part["part-name"])
-                self.logger.error(ret)
                 return False
 
-            sh.cmd("sudo mount -o loop,rw,sync %sp%d %s" % (ldev, part_index, temp_dir))
-
-            def get_update_dir(root, dir):
-                if root is None and len(dir) > 0:
-                    if dir.startswith("/"):
-                        return dir
-                    elif dir.startswith("."):
-                        return os.path.join(os.getcwd(), dir)
-                else:
-                    return os.path.join(root, dir)
-
-            if part["part-update"]:
-                for uparams in part["updates"]:
-                    sdir = get_update_dir(self.recipe_dir, uparams["update-sdir"])
-                    ddir = get_update_dir(temp_dir, uparams["update-ddir"])
-                    kdir = get_update_dir(temp_dir, uparams["kernel-ddir"])
-                    if uparams["sync-kernel"]:
-                        sh.cmd("sudo cp %s %s/%s" % (os.path.join(self.iout, self.kparams["image-name"]),
-                                                     kdir, self.kparams["image-name"]))
-                    if uparams["sync-rootfs"]:
-                        self.robj.install_rootfs(temp_dir)
-                        #sh.cmd("sudo /usr/bin/rsync -aDzv %s/ %s" % (self.robj.idir, temp_dir))
-
-                    if os.path.isfile(sdir):
-                        self.cmd("sudo cp %s %s" % (sdir, ddir))
-                    else:
-                        if os.path.exists(sdir):
-                            sh.cmd("sudo /usr/bin/rsync -azDv %s/ %s" % (sdir, ddir))
-                        else:
-                            self.logger.error("Source dir %s does not exist" % sdir)
-
-            if part["install-grub"]:
-                sh.cmd(
-                    "sudo grub-install --efi-directory %s --boot-directory /boot --target x86_64-efi --removable %sp%d" %
-                    (temp_dir, ldev, part_index))
-
-            sh.cmd(("sudo umount %s" % temp_dir))
-
-            sh.cmd("sudo losetup -d %s" % (ldev))
-
-            part_index = part_index + 1
+        with self.report.measure('flash') as result:
+            result["status"] = FlashWriter(image, dev, logger=self.logger).write(full)
 
-        try:
-            os.removedirs(temp_dir)
-        except Exception as e:
-            pass
+        self.report.save()
+        self.report.summary()
 
-        if self.dparams["gen-craff-image"]:
-            sh.cmd("craff %s -o %s" % (dev, self.dparams["craff-image-name"]))
-
-        return True
+        return result["status"]
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+#
+# Install tree manifest and incremental image update
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import sys
+import json
+import stat
+import logging
+import tempfile
+from pyshell import PyShell
+from kdev._cache import hash_file
+
+# Whole second mtimes miss files rewritten within the second of the last
+# scan, nanoseconds are only there on py3, py2 has the float.
+def _mtime(st):
+    return getattr(st, 'st_mtime_ns', st.st_mtime)
+
+def _seconds(mtime):
+    return mtime // 1000000000 if isinstance(mtime, int) else int(mtime)
+
+def set_mtime(path, mtime):
+    if isinstance(mtime, float):
+        os.utime(path, (mtime, mtime))
+    elif sys.version_info[0] >= 3:
+        os.utime(path, ns=(mtime, mtime))
+    else:
+        os.utime(path, (mtime / 1e9, mtime / 1e9))
+
+class TreeManifest(object):
+    def __init__(self, root=None, entries=None, image=None):
+        self.root = root
+        self.entries = entries or {}
+        self.image = image or {}
+
+    @classmethod
+    def scan(cls, root, prev=None, skip=()):
+        entries = {}
+
+        if not os.path.exists(root):
+            return cls(root, entries)
+
+        for base, dirs, files in os.walk(root):
+            if base == root:
+                dirs[:] = [name for name in dirs if name not in skip]
+                files = [name for name in files if name not in skip]
+            for name in dirs + files:
+                path = os.path.join(base, name)
+                rpath = os.path.relpath(path, root)
+                st = os.lstat(path)
+                entry = {
+                    "size": st.st_size if stat.S_ISREG(st.st_mode) else 0,
+                    "mtime": _mtime(st),
+                    "mode": st.st_mode,
+                    "uid": st.st_uid,
+                    "gid": st.st_gid,
+                }
+                if stat.S_ISLNK(st.st_mode):
+                    entry["hash"] = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode):
+                    # Only rehash files whose size or mtime moved since the last scan.
+                    old = prev.entries.get(rpath) if prev is not None else None
+                    if old is not None and old["size"] == entry["size"] and old["mtime"] == entry["mtime"] \
+                            and old["mode"] == entry["mode"]:
+                        entry["hash"] = old["hash"]
+                    else:
+                        entry["hash"] = hash_file(path)
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    entry["hash"] = "%d:%d" % (os.major(st.st_rdev), os.minor(st.st_rdev))
+                else:
+                    entry["hash"] = ""
+                entries[rpath] = entry
+
+        return cls(root, entries)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except ValueError:
+            return None
+
+        return cls(data.get("root"), data.get("entries"), data.get("image"))
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({"root": self.root, "image": self.image, "entries": self.entries}, fp, sort_keys=True)
+        os.rename(tmp, path)
+
+    def set_image(self, image, image_type):
+        st = os.stat(image)
+        self.image = {"type": image_type, "size": st.st_size, "mtime": st.st_mtime}
+
+    def image_matches(self, image, image_type):
+        if not os.path.exists(image) or self.image.get("type") != image_type:
+            return False
+
+        st = os.stat(image)
+
+        return self.image.get("size") == st.st_size and self.image.get("mtime") == st.st_mtime
+
+    def diff(self, new):
+        added = []
+        removed = []
+        changed = []
+
+        for path in self.entries:
+            if path not in new.entries:
+                removed.append(path)
+
+        for path, entry in new.entries.items():
+            old = self.entries.get(path)
+            if old is None:
+                added.append(path)
+            elif stat.S_IFMT(old["mode"]) != stat.S_IFMT(entry["mode"]):
+                # A path which changed its type is replaced, not updated.
+                removed.append(path)
+                added.append(path)
+            elif old != entry:
+                changed.append(path)
+
+        return sorted(added), sorted(removed), sorted(changed)
+
+def _ext_free(image, sh):
+    ret = sh.cmd("dumpe2fs -h %s" % image)
+    if ret[0] != 0:
+        return None
+
+    fields = {}
+    for line in ret[1].splitlines():
+        name, sep, value = line.partition(':')
+        if len(sep) > 0:
+            fields[name.strip()] = value.strip()
+
+    try:
+        return int(fields["Block size"]), int(fields["Free blocks"]), int(fields["Free inodes"])
+    except (KeyError, ValueError):
+        return None
+
+def _blocks(entry, block_size):
+    if stat.S_ISREG(entry["mode"]):
+        # One more for the extent or indirect blocks of larger files.
+        return (entry["size"] + block_size - 1) // block_size + 1
+    if stat.S_ISDIR(entry["mode"]) or (stat.S_ISLNK(entry["mode"]) and len(entry["hash"]) >= 60):
+        return 1
+    return 0
+
+def patch_ext_image(image, root, old, new, logger=None):
+    logger = logger or logging.getLogger(__name__)
+    sh = PyShell(logger=logger)
+
+    added, removed, changed = old.diff(new)
+    cmds = []
+
+    # debugfs carries on after a command fails, an image without room for
+    # the update has to be regenerated instead.
+    free = _ext_free(image, sh)
+    if free is None:
+        logger.warning("Reading free space of %s failed", image)
+        return False
+
+    block_size, free_blocks, free_inodes = free
+    blocks = sum([_blocks(new.entries[rpath], block_size) for rpath in added + changed]) - \
+        sum([_blocks(old.entries[rpath], block_size) for rpath in removed + changed])
+    if blocks > free_blocks or len(added) - len(removed) > free_inodes:
+        logger.info("Image %s has no room for the update", image)
+        return False
+
+    def fs_path(rpath):
+        return '/' + rpath.replace(os.sep, '/')
+
+    # Deepest entries go first so directories are empty when they get removed.
+    for rpath in sorted(removed, key=lambda x: x.count(os.sep), reverse=True):
+        if stat.S_ISDIR(old.entries[rpath]["mode"]):
+            cmds.append('rmdir "%s"' % fs_path(rpath))
+        else:
+            cmds.append('rm "%s"' % fs_path(rpath))
+
+    for rpath in sorted(added + changed, key=lambda x: x.count(os.sep)):
+        entry = new.entries[rpath]
+        mode = entry["mode"]
+        path = fs_path(rpath)
+        if stat.S_ISDIR(mode):
+            if rpath in added:
+                cmds.append('mkdir "%s"' % path)
+        else:
+            if rpath in changed:
+                cmds.append('rm "%s"' % path)
+            if stat.S_ISLNK(mode):
+                cmds.append('symlink "%s" "%s"' % (path, entry["hash"]))
+            elif stat.S_ISREG(mode):
+                cmds.append('cd "%s"' % os.path.dirname(path))
+                cmds.append('write "%s" "%s"' % (os.path.join(root, rpath), os.path.basename(path)))
+                cmds.append('cd /')
+            elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+                major, minor = entry["hash"].split(':')
+                cmds.append('mknod "%s" %s %s %s' % (path, 'c' if stat.S_ISCHR(mode) else 'b', major, minor))
+            else:
+                cmds.append('mknod "%s" p' % path)
+        if not stat.S_ISLNK(mode):
+            cmds.append('sif "%s" mode 0%o' % (path, mode))
+        cmds.append('sif "%s" uid %d' % (path, entry.get("uid", 0)))
+        cmds.append('sif "%s" gid %d' % (path, entry.get("gid", 0)))
+        cmds.append('sif "%s" mtime @%d' % (path, _seconds(entry["mtime"])))
+
+    fd, cmdfile = tempfile.mkstemp(suffix='.debugfs')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write('\n'.join(cmds) + '\n')
+
+    ret = sh.cmd("debugfs -w -f %s %s" % (cmdfile, image))
+    os.remove(cmdfile)
+
+    if ret[0] != 0:
+        logger.error("debugfs update of %s failed", image)
+        logger.error(ret)
+        return False
+
+    # Failed commands only show up on stderr, next to the version banner.
+    errors = [line for line in ret[2].splitlines() if len(line.strip()) > 0 and not line.startswith('debugfs ')]
+    if len(errors) > 0:
+        logger.warning("debugfs update of %s failed: %s", image, errors[0])
+        return False
+
+    # Let fsck judge the metadata debugfs left behind.
+    ret = sh.cmd("e2fsck -fn %s" % image)
+    if ret[0] != 0:
+        logger.warning("Patched image %s failed fsck", image)
+        return False
+
+    return True
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Multi recipe batch builds
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import json
+import hashlib
+import logging
+from kdev._kdev import KdevBuild
+from kdev._cache import MAX_SIZE
+from kdev._scheduler import StageScheduler
+
+class BuildMatrix(object):
+    def __init__(self, recipes, kernel_dir, rootfs_dir, out_dir, cache_dir=None, jobs=None, mirror_dir=None,
+                 remote=None, load=None, cache_size=MAX_SIZE, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.recipes = recipes
+        self.kernel_dir = kernel_dir
+        self.rootfs_dir = rootfs_dir
+        self.out_dir = os.path.abspath(out_dir)
+        # Sharing busybox trees between recipes goes through the stage cache.
+        self.cache_dir = cache_dir or os.path.join(self.out_dir, '.matrix-cache')
+        self.cache_size = cache_size
+        self.jobs = jobs
+        self.mirror_dir = mirror_dir
+        # Recipes are spread over the workers, each kernel builds on one of them.
+        self.remote = remote
+        self.load = load
+        self.sched = None
+
+    def _build_obj(self, recipe_dir, recipecfg):
+        return KdevBuild(kernel_dir=self.kernel_dir, rootfs_dir=self.rootfs_dir, recipe_dir=recipe_dir,
+                         out_dir=self.out_dir, cache_dir=self.cache_dir, recipecfg=recipecfg,
+                         mirror_dir=self.mirror_dir, remote=self.remote, load=self.load, cache_size=self.cache_size,
+                         logger=self.logger)
+
+    def _seed(self, recipe_dir, recipecfg, rbuild, ibuild):
+        def func():
+            return self._build_obj(recipe_dir, recipecfg).build(rbuild=rbuild, ibuild=ibuild)
+        return func
+
+    def _recipe(self, recipe_dir, recipecfg):
+        def func():
+            return self._build_obj(recipe_dir, recipecfg).build(kbuild=True, rbuild=True, ibuild=True,
+                                                                 rupdate=True, iupdate=True, gen_image=True)
+        return func
+
+    def run(self):
+        self.sched = StageScheduler(jobs=self.jobs, keep_going=True, load=self.load, logger=self.logger)
+        seeds = {}
+        deps = {}
+
+        for name, recipe_dir, recipecfg in self.recipes:
+            obj = self._build_obj(recipe_dir, recipecfg)
+            deps[name] = []
+            for pname, rbuild in [("rootfs-params", True), ("initramfs-params", False)]:
+                params = recipecfg[pname]
+                if not params["enable-build"]:
+                    continue
+                sig = hashlib.sha256(json.dumps(obj.rootfs_inputs(params), sort_keys=True).encode('utf-8'))
+                sig = "rootfs:%s" % sig.hexdigest()[:12]
+                # The first recipe which needs a busybox tree builds it for everyone else.
+                if sig not in seeds:
+                    seeds[sig] = name
+                    self.sched.add_stage(sig, self._seed(recipe_dir, recipecfg, rbuild, not rbuild))
+                deps[name].append(sig)
+
+        for name, recipe_dir, recipecfg in self.recipes:
+            self.sched.add_stage(name, self._recipe(recipe_dir, recipecfg), deps=deps[name], weight=4)
+
+        self.logger.info("Building %d recipes with %d shared rootfs builds", len(self.recipes), len(seeds))
+
+        return self.sched.run()
+
+    def summary(self):
+        lines = ["%-32s %-8s %10s  %s" % ("RECIPE", "STATUS", "TIME", "ROOTFS")]
+
+        for name, recipe_dir, recipecfg in self.recipes:
+            stage = self.sched.stages[name]
+            if stage.status is None:
+                status = "pending"
+            else:
+                status = "ok" if stage.status else "failed"
+            lines.append("%-32s %-8s %9.1fs  %s" % (name, status, stage.duration(), ' '.join(stage.deps)))
+
+        return '\n'.join(lines)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Local git mirrors of rootfs sources
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import fcntl
+import hashlib
+import logging
+from kdev._shell import ShellSession
+
+# Network timeouts, so a build farm without network fails over to the
+# mirror quickly instead of hanging in git.
+GIT_OPTS = "-c http.lowSpeedLimit=1000 -c http.lowSpeedTime=30"
+
+def offline():
+    return os.environ.get("KDEV_OFFLINE", "0") not in ["", "0"]
+
+def remote_revision(url, branch, logger=None):
+    if offline():
+        return None
+
+    sh = ShellSession(logger=logger)
+    try:
+        ret = sh.cmd("GIT_TERMINAL_PROMPT=0 git %s ls-remote %s refs/heads/%s" % (GIT_OPTS, url, branch))
+    finally:
+        sh.close()
+
+    if ret[0] != 0 or len(ret[1].split()) == 0:
+        return None
+
+    return ret[1].split()[0]
+
+class SourceMirror(object):
+    def __init__(self, mirror_dir=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.mirror_dir = os.path.abspath(mirror_dir or os.path.join(os.path.expanduser("~"), '.kdev-mirrors'))
+
+    def path(self, url):
+        name = re.sub(r'[^\w\.\-]+', '_', re.sub(r'^\w+://', '', url)).strip('_')
+
+        return os.path.join(self.mirror_dir, "%s-%s.git" % (name[-48:], hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]))
+
+    def _has_branch(self, sh, path, branch):
+        if not os.path.exists(os.path.join(path, 'HEAD')):
+            return False
+
+        ret = sh.cmd("git --git-dir=%s rev-parse --verify -q refs/heads/%s" % (path, branch))
+
+        return ret[0] == 0
+
+    def fetch(self, url, branch):
+        path = self.path(url)
+
+        if not os.path.exists(self.mirror_dir):
+            os.makedirs(self.mirror_dir)
+
+        sh = ShellSession(logger=self.logger)
+        lock = open(path + '.lock', 'w')
+        try:
+            # Rootfs and initramfs usually share the source, the second fetch
+            # waits for the first one and then finds the branch up to date.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if offline():
+                if self._has_branch(sh, path, branch):
+                    self.logger.info("Offline, using mirror %s as it is", path)
+                    return True
+                self.logger.error("Offline and mirror %s has no branch %s", path, branch)
+                return False
+
+            if not os.path.exists(os.path.join(path, 'HEAD')):
+                ret = sh.batch(["git init -q --bare %s" % path,
+                                "git --git-dir=%s remote add origin %s" % (path, url)])
+                if ret[0] != 0:
+                    return False
+
+            ret = sh.cmd("GIT_TERMINAL_PROMPT=0 git %s --git-dir=%s fetch -q --prune origin "
+                         "+refs/heads/%s:refs/heads/%s" % (GIT_OPTS, path, branch, branch))
+            if ret[0] == 0:
+                self.logger.info("Updated mirror %s", path)
+                return True
+
+            if self._has_branch(sh, path, branch):
+                self.logger.warning("Fetching %s failed, using the mirror as it is", url)
+                return True
+
+            self.logger.error("Fetching %s failed: %s", url, ret[2])
+            return False
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+            sh.close()
+
+    def revision(self, url, branch):
+        path = self.path(url)
+        sh = ShellSession(logger=self.logger)
+        try:
+            if not self._has_branch(sh, path, branch):
+                return None
+            ret = sh.cmd("git --git-dir=%s rev-parse refs/heads/%s" % (path, branch))
+        finally:
+            sh.close()
+
+        return ret[1].strip() if ret[0] == 0 else None
+
+    def url(self, url, branch):
+        # Builds only go through the mirror once it has the branch, anything
+        # else is left to the original remote.
+        path = self.path(url)
+        sh = ShellSession(logger=self.logger)
+        try:
+            if self._has_branch(sh, path, branch):
+                return "file://%s" % path
+        finally:
+            sh.close()
+
+        return url
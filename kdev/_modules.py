@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Kernel module strip and compression
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import logging
+import subprocess
+import multiprocessing
+from kdev._scheduler import default_jobs
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+# Same tool options as the kernel's own CONFIG_MODULE_COMPRESS_* support,
+# kmod only loads xz modules with crc32 checks.
+COMPRESS = {
+    "xz": (['xz', '-f', '--check=crc32', '--lzma2=dict=1MiB'], '.xz'),
+    "zstd": (['zstd', '-q', '-f', '--rm'], '.zst'),
+    "gzip": (['gzip', '-n', '-f'], '.gz'),
+}
+
+def depmod_tool():
+    # Like the kernel's own modules_install, depmod is often only in sbin.
+    return which('depmod') or which('depmod', path='/sbin:/usr/sbin')
+
+# modules_install strips with INSTALL_MOD_STRIP before it signs, a module
+# stripped afterwards loses its appended signature.
+def strip_tool(cc):
+    # A cross compiler's prefix also names the binutils to use.
+    if cc.endswith('gcc'):
+        return cc[:-3] + 'strip'
+    return 'strip'
+
+def _run(cmd):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    return proc.returncode, out.decode('utf-8', 'replace')
+
+def _process(args):
+    path, compress = args
+    before = os.path.getsize(path)
+
+    cmd, ext = COMPRESS[compress]
+    ret, out = _run(cmd + [path])
+    if ret != 0:
+        return path, before, None, out
+
+    return path + ext, before, os.path.getsize(path + ext), None
+
+def process_modules(base, compress='none', jobs=None, modules=None, logger=None):
+    logger = logger or logging.getLogger(__name__)
+    mod_dir = os.path.join(base, 'lib', 'modules')
+    stats = {"modules": 0, "bytes-before": 0, "bytes-after": 0}
+
+    if not os.path.exists(mod_dir):
+        return stats
+
+    compress = compress if compress in COMPRESS else None
+    if compress is not None and which(COMPRESS[compress][0][0]) is None:
+        logger.error("%s not found, can not compress modules", COMPRESS[compress][0][0])
+        return None
+
+    # Module names in modules.dep change with compression, depmod has to
+    # rewrite it, modprobe can not load anything otherwise.
+    depmod = depmod_tool()
+    if compress is not None and depmod is None:
+        logger.error("depmod not found, can not compress modules")
+        return None
+
+    # Only plain .ko files, so a rerun on a processed tree is a no-op.
+    if modules is None:
+        if compress is None:
+            return stats
+        modules = []
+        for root, dirs, files in os.walk(mod_dir):
+            modules += [os.path.join(root, name) for name in files if name.endswith('.ko')]
+    elif compress is None:
+        # Newly installed modules still need depmod.
+        modules = []
+
+    if len(modules) > 0:
+        pool = multiprocessing.Pool(min(jobs or default_jobs(), len(modules)))
+        try:
+            results = pool.map(_process, [(path, compress) for path in modules], chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+        for path, before, after, err in results:
+            if err is not None:
+                logger.error("Processing module %s failed: %s", path, err)
+                return None
+            stats["modules"] += 1
+            stats["bytes-before"] += before
+            stats["bytes-after"] += after
+
+        logger.info("Processed %d modules, %dM -> %dM", stats["modules"], stats["bytes-before"] // (1024 * 1024),
+                    stats["bytes-after"] // (1024 * 1024))
+
+    # One depmod per kernel release, after all modules are done.
+    if depmod is None:
+        logger.warning("depmod not found, modules.dep is not updated")
+        return stats
+
+    for release in sorted(os.listdir(mod_dir)):
+        if not os.path.isdir(os.path.join(mod_dir, release)):
+            continue
+        ret, out = _run([depmod, '-b', base, '-a', release])
+        if ret != 0:
+            logger.error("depmod for %s failed: %s", release, out)
+            return None
+
+    return stats
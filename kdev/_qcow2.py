@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+#
+# Compressed qcow2 export of raw disk images
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import json
+import zlib
+import errno
+import struct
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+from kdev._scheduler import cpu_count
+
+QCOW_MAGIC = b'QFI\xfb'
+QCOW_VERSION = 2
+QCOW_OFLAG_COPIED = 1 << 63
+QCOW_OFLAG_COMPRESSED = 1 << 62
+
+# Version 2 header, refcounts are always 16 bit there.
+HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+
+CLUSTER_BITS = 16
+SECTOR_SIZE = 512
+
+def _deflate(data, level):
+    # qemu inflates compressed clusters as raw deflate with a 4K window.
+    comp = zlib.compressobj(level, zlib.DEFLATED, -12, 9)
+    return comp.compress(data) + comp.flush()
+
+def _extents(fp, size):
+    # Holes in a sparse raw image are never read.
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fp.fileno(), offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            return [(0, size)]
+        end = min(os.lseek(fp.fileno(), start, os.SEEK_HOLE), size)
+        extents.append((start, end))
+        offset = end
+
+    return extents
+
+class Qcow2Writer(object):
+    def __init__(self, path, size, cluster_bits=CLUSTER_BITS, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        self.size = size
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.csize_shift = 62 - (cluster_bits - 8)
+        self.l2_entries = self.cluster_size // 8
+        self.refs = {}
+        self.l2 = {}
+        self.fp = None
+        self.offset = 0
+
+    def __enter__(self):
+        self.fp = open(self.path, 'wb')
+        # Cluster 0 is the header, written once everything else is placed.
+        self.offset = self.cluster_size
+        self.fp.seek(self.offset)
+        self._ref(0, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.fp.close()
+
+    def _ref(self, offset, length):
+        for cluster in range(offset >> self.cluster_bits, ((offset + length - 1) >> self.cluster_bits) + 1):
+            self.refs[cluster] = self.refs.get(cluster, 0) + 1
+
+    def _align(self):
+        if self.offset % self.cluster_size:
+            self.offset += self.cluster_size - self.offset % self.cluster_size
+            self.fp.seek(self.offset)
+
+    def _entry(self, index, entry):
+        self.l2.setdefault(index // self.l2_entries, {})[index % self.l2_entries] = entry
+
+    def add_raw(self, index, data):
+        self._align()
+        self._ref(self.offset, self.cluster_size)
+        self._entry(index, self.offset | QCOW_OFLAG_COPIED)
+        self.fp.write(data)
+        self.offset += len(data)
+        if len(data) < self.cluster_size:
+            self.offset = self.offset + self.cluster_size - len(data)
+            self.fp.seek(self.offset)
+
+    def add_compressed(self, index, data):
+        # Compressed clusters are packed back to back, in 512 byte sectors.
+        offset = self.offset
+        sectors = (offset + len(data) - 1) // SECTOR_SIZE - offset // SECTOR_SIZE
+        self._ref(offset & ~(SECTOR_SIZE - 1), (sectors + 1) * SECTOR_SIZE)
+        self._entry(index, offset | QCOW_OFLAG_COMPRESSED | sectors << self.csize_shift)
+        self.fp.write(data)
+        self.offset += len(data)
+        return offset
+
+    def _table(self, entries, count):
+        data = b''.join([struct.pack('>Q', entries.get(index, 0)) for index in range(count)])
+        offset = self.offset
+        self.fp.write(data)
+        self.offset += len(data)
+        self._align()
+        return offset
+
+    def close(self):
+        self._align()
+
+        l1_size = (self.size + self.l2_entries * self.cluster_size - 1) // (self.l2_entries * self.cluster_size)
+        l1 = {}
+        for index in sorted(self.l2):
+            offset = self._table(self.l2[index], self.l2_entries)
+            self._ref(offset, self.cluster_size)
+            l1[index] = offset | QCOW_OFLAG_COPIED
+
+        l1_offset = self._table(l1, l1_size)
+        self._ref(l1_offset, max(8, l1_size * 8))
+
+        # Refcount blocks count themselves, so their number is found by
+        # growing it until everything, them included, is covered.
+        per_block = self.cluster_size // 2
+        base = self.offset >> self.cluster_bits
+        blocks, table = 1, 1
+        while True:
+            need = (base + blocks + table + per_block - 1) // per_block
+            need_table = (need * 8 + self.cluster_size - 1) // self.cluster_size
+            if need == blocks and need_table == table:
+                break
+            blocks, table = need, need_table
+
+        table_offset = self.offset
+        self._ref(table_offset, table * self.cluster_size)
+        block_offset = table_offset + table * self.cluster_size
+        self._ref(block_offset, blocks * self.cluster_size)
+
+        self._table(dict([(index, block_offset + index * self.cluster_size) for index in range(blocks)]),
+                    table * self.cluster_size // 8)
+        for block in range(blocks):
+            first = block * per_block
+            self.fp.write(b''.join([struct.pack('>H', self.refs.get(cluster, 0))
+                                    for cluster in range(first, first + per_block)]))
+        self.offset = block_offset + blocks * self.cluster_size
+
+        self.fp.seek(0)
+        self.fp.write(HEADER.pack(QCOW_MAGIC, QCOW_VERSION, 0, 0, self.cluster_bits, self.size, 0, l1_size,
+                                  l1_offset, table_offset, table, 0, 0))
+        self.fp.truncate(self.offset)
+
+def _pack(args):
+    data, level, reuse, zero = args
+    if data == zero:
+        return None, None
+    digest = hashlib.sha256(data).hexdigest()
+    if digest in reuse:
+        return digest, None
+    return digest, _deflate(data, level)
+
+def export_qcow2(image, export, level=0, threads=0, logger=None):
+    logger = logger or logging.getLogger(__name__)
+    threads = threads if threads > 0 else cpu_count()
+    level = level or 6
+    index_file = export + '.chunks'
+    stats = {"clusters": 0, "zero": 0, "reused": 0, "compressed": 0, "raw": 0}
+
+    if not os.path.exists(image):
+        logger.error("Disk image %s does not exist", image)
+        return None
+
+    # Compressed clusters of the last export, by content, are copied over
+    # instead of compressed again.
+    reuse = {}
+    if os.path.exists(index_file) and os.path.exists(export):
+        with open(index_file) as fp:
+            old = json.load(fp)
+        st = os.stat(export)
+        if old.get("export") == [st.st_size, st.st_mtime] and old.get("level") == level and \
+           old.get("cluster-bits") == CLUSTER_BITS:
+            reuse = old["chunks"]
+
+    size = os.path.getsize(image)
+    cluster_size = 1 << CLUSTER_BITS
+    zero = b'\0' * cluster_size
+    chunks = {}
+    tmp = export + '.tmp'
+
+    pool = ThreadPool(threads)
+    prev = open(export, 'rb') if len(reuse) > 0 else None
+    try:
+        with open(image, 'rb') as src, Qcow2Writer(tmp, size, logger=logger) as writer:
+            def put(index, data, result):
+                digest, comp = result.get()
+                if digest is None:
+                    stats["zero"] += 1
+                    return
+                if comp is None:
+                    offset, length = reuse[digest]
+                    prev.seek(offset)
+                    comp = prev.read(length)
+                    stats["reused"] += 1
+                elif len(comp) >= cluster_size:
+                    writer.add_raw(index, data)
+                    stats["raw"] += 1
+                    return
+                else:
+                    stats["compressed"] += 1
+                chunks[digest] = [writer.add_compressed(index, comp), len(comp)]
+
+            pending = []
+            last = -1
+            for start, end in _extents(src, size):
+                for index in range(max(last + 1, start >> CLUSTER_BITS), (end + cluster_size - 1) >> CLUSTER_BITS):
+                    src.seek(index << CLUSTER_BITS)
+                    data = src.read(cluster_size)
+                    # qemu inflates every compressed cluster to a full one,
+                    # the tail of the last cluster reads back as zeros.
+                    if len(data) < cluster_size:
+                        data += zero[len(data):]
+                    pending.append((index, data, pool.apply_async(_pack, ((data, level, reuse, zero),))))
+                    stats["clusters"] += 1
+                    last = index
+                    # Bound the memory held by in-flight clusters, they are
+                    # written in disk order.
+                    while len(pending) > threads * 64:
+                        put(*pending.pop(0))
+
+            while len(pending) > 0:
+                put(*pending.pop(0))
+
+            writer.close()
+    except (IOError, OSError, ValueError) as e:
+        logger.error("Exporting %s to %s failed: %s", image, export, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+    finally:
+        pool.close()
+        pool.join()
+        if prev is not None:
+            prev.close()
+
+    os.rename(tmp, export)
+    st = os.stat(export)
+    with open(index_file, 'w') as fp:
+        json.dump({"cluster-bits": CLUSTER_BITS, "level": level, "export": [st.st_size, st.st_mtime],
+                   "chunks": chunks}, fp)
+
+    logger.info("Exported %s to %s: %d clusters, %d zero, %d reused, %d compressed, %d raw", image, export,
+                stats["clusters"], stats["zero"], stats["reused"], stats["compressed"], stats["raw"])
+
+    return stats
@@ -0,0 +1,623 @@
+# -*- coding: utf-8 -*-
+#
+# Remote build execution over TCP or Unix sockets
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import json
+import stat
+import fcntl
+import signal
+import socket
+import getpass
+import hashlib
+import logging
+import tempfile
+import subprocess
+from kdev._manifest import TreeManifest, set_mtime
+from kdev._treesync import clone_file, _remove
+from kdev._scheduler import default_jobs
+
+PROTOCOL_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+
+def parse_address(address):
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+
+    if address.startswith('tcp:'):
+        address = address[4:]
+    host, sep, port = address.rpartition(':')
+    if len(sep) == 0 or not port.isdigit():
+        raise ValueError("Invalid remote address %s" % address)
+
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+def path_map(paths):
+    # Longest first, so an obj dir inside the source tree wins over the
+    # source tree, and only whole path names match.
+    pairs = []
+    for old in sorted(paths, key=len, reverse=True):
+        pattern = re.compile(re.escape(old.rstrip('/').encode('utf-8')) + b'(?![A-Za-z0-9_.+-])')
+        pairs.append((pattern, paths[old].rstrip('/').encode('utf-8')))
+    return pairs
+
+def translate(data, pairs):
+    # Text files only, binaries keep the paths they were built with.
+    if len(pairs) == 0 or b'\0' in data[:8192]:
+        return data
+    for pattern, new in pairs:
+        data = pattern.sub(lambda match: new, data)
+    return data
+
+def _read_text(path):
+    # Binaries are told apart by their first block, without reading all of them.
+    with open(path, 'rb') as fp:
+        data = fp.read(8192)
+        if b'\0' in data:
+            return None
+        return data + fp.read()
+
+def _translate_link(target, pairs):
+    return translate(target.encode('utf-8'), pairs).decode('utf-8')
+
+def pick_address(addresses, key):
+    # A recipe always goes to the same worker of a farm, so its obj dir
+    # stays warm there.
+    addresses = [address.strip() for address in addresses.split(',') if len(address.strip()) > 0]
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    return addresses[int(digest, 16) % len(addresses)]
+
+class RemoteError(Exception):
+    pass
+
+class _Channel(object):
+    # Json header lines, each optionally followed by "size" bytes of data.
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+
+    def send(self, msg):
+        self.sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+    def send_data(self, msg, data):
+        msg["size"] = len(data)
+        self.send(msg)
+        self.sock.sendall(data)
+
+    def send_file(self, msg, path):
+        msg["size"] = os.path.getsize(path)
+        self.send(msg)
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                self.sock.sendall(chunk)
+
+    def recv(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            raise EOFError("Connection closed")
+        return json.loads(line.decode('utf-8'))
+
+    def recv_file(self, size, path):
+        h = hashlib.sha256()
+        with open(path, 'wb') as fp:
+            while size > 0:
+                chunk = self.rfile.read(min(size, CHUNK_SIZE))
+                if len(chunk) == 0:
+                    raise EOFError("Connection closed")
+                h.update(chunk)
+                fp.write(chunk)
+                size -= len(chunk)
+
+        return h.hexdigest()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+class RemoteWorker(object):
+    def __init__(self, address, work_dir, token=None, jobs=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.address = address
+        self.work_dir = os.path.abspath(work_dir)
+        self.token = token
+        self.jobs = jobs or default_jobs()
+        self.locks = {}
+
+    def _blob(self, digest):
+        return os.path.join(self.work_dir, 'blobs', digest[:2], digest)
+
+    def _workspace(self, name):
+        parts = name.split('/')
+        if name.startswith('/') or '..' in parts or '' in parts:
+            raise RemoteError("Invalid workspace %s" % name)
+
+        # Builds of the same recipe from two clients must not interleave.
+        if name not in self.locks:
+            lock = os.path.join(self.work_dir, 'locks', name.replace('/', '_') + '.lock')
+            if not os.path.exists(os.path.dirname(lock)):
+                os.makedirs(os.path.dirname(lock))
+            fp = open(lock, 'w')
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            self.locks[name] = fp
+
+        return os.path.join(self.work_dir, 'ws', name)
+
+    def _path(self, root, rpath, follow=False):
+        # Nothing a client sends may point out of its workspace, neither
+        # through .. nor through a symlink synced there earlier.
+        if rpath.startswith('/') or '..' in rpath.split('/'):
+            raise RemoteError("Invalid path %s" % rpath)
+
+        path = os.path.join(root, rpath)
+        real = os.path.realpath(path if follow else os.path.dirname(path))
+        base = os.path.realpath(root)
+        if real != base and not real.startswith(base + os.sep):
+            raise RemoteError("Invalid path %s" % rpath)
+
+        return path
+
+    def _state(self, name):
+        return os.path.join(self.work_dir, 'state', name.replace('/', '_') + '.json')
+
+    def _hello(self, chan, msg):
+        if self.token is not None and msg.get("token") != self.token:
+            raise RemoteError("Bad token")
+        if msg.get("version") != PROTOCOL_VERSION:
+            raise RemoteError("Protocol version %s is not supported" % msg.get("version"))
+        chan.send({"root": os.path.join(self.work_dir, 'ws')})
+
+    def _missing(self, chan, msg):
+        chan.send({"missing": [digest for digest in msg["hashes"] if not os.path.exists(self._blob(digest))]})
+
+    def _put(self, chan, msg):
+        path = self._blob(msg["hash"])
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            digest = chan.recv_file(msg["size"], tmp)
+            if digest != msg["hash"]:
+                raise RemoteError("Blob %s arrived as %s" % (msg["hash"], digest))
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        chan.send({"ok": True})
+
+    def _sync(self, chan, msg):
+        root = self._workspace(msg["name"])
+        entries = msg["entries"]
+        for rpath in entries:
+            self._path(root, rpath)
+        current = TreeManifest.scan(root, TreeManifest.load(self._state(msg["name"])))
+
+        # Children go before their parents, and a path which changed its
+        # type is removed before it gets recreated.
+        for rpath in sorted(current.entries, reverse=True):
+            entry = entries.get(rpath)
+            if entry is None or stat.S_IFMT(entry["mode"]) != stat.S_IFMT(current.entries[rpath]["mode"]):
+                _remove(os.path.join(root, rpath))
+                del current.entries[rpath]
+
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+        for rpath in sorted(entries):
+            entry = entries[rpath]
+            old = current.entries.get(rpath)
+            path = self._path(root, rpath)
+
+            if stat.S_ISDIR(entry["mode"]):
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                os.chmod(path, stat.S_IMODE(entry["mode"]))
+            elif stat.S_ISLNK(entry["mode"]):
+                if old is None or old["hash"] != entry["hash"]:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.symlink(entry["hash"], path)
+            elif stat.S_ISREG(entry["mode"]):
+                if old is None or old["hash"] != entry["hash"]:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    clone_file(self._blob(entry["hash"]), path)
+                if old is None or old != entry:
+                    os.chmod(path, stat.S_IMODE(entry["mode"]))
+                    # Sources keep the client's mtimes, so make on the worker
+                    # sees exactly what changed since the last build.
+                    set_mtime(path, entry["mtime"])
+
+        self._save_state(msg["name"], TreeManifest.scan(root, TreeManifest(root, entries)))
+        chan.send({"path": root})
+
+    def _save_state(self, name, manifest):
+        path = self._state(name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        manifest.save(path)
+
+    def _scan(self, chan, msg):
+        root = self._workspace(msg["name"])
+        manifest = TreeManifest.scan(root, TreeManifest.load(self._state(msg["name"])))
+        self._save_state(msg["name"], manifest)
+        chan.send({"entries": manifest.entries})
+
+    def _get(self, chan, msg):
+        root = self._workspace(msg["name"])
+        chan.send_file({}, self._path(root, msg["path"], follow=True))
+
+    def _run(self, chan, msg):
+        # Commands only run inside a workspace this client synced and locked.
+        roots = [self._workspace(name) for name in self.locks]
+        if len(roots) == 0:
+            raise RemoteError("No workspace synced to run in")
+        cwd = msg.get("cwd") or roots[0]
+        real = os.path.realpath(cwd)
+        if not any([real == os.path.realpath(root) or real.startswith(os.path.realpath(root) + os.sep)
+                    for root in roots]):
+            raise RemoteError("Invalid cwd %s" % cwd)
+
+        env = dict(os.environ)
+        env.update(msg.get("env") or {})
+        # The client's job budget is for its own cpus.
+        if "MAKEFLAGS" not in (msg.get("env") or {}):
+            env["MAKEFLAGS"] = "-j%d" % self.jobs
+
+        with open(os.devnull) as devnull:
+            proc = subprocess.Popen(msg["cmd"], cwd=cwd, env=env, stdin=devnull,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                chan.send({"out": line.decode('utf-8', 'replace').rstrip('\n')})
+        except socket.error:
+            # A client which went away does not get its build finished.
+            proc.kill()
+            proc.wait()
+            raise
+        proc.stdout.close()
+        ret = proc.wait()
+
+        chan.send({"exit": ret})
+
+    def handle(self, conn):
+        chan = _Channel(conn)
+        ops = {"hello": self._hello, "missing": self._missing, "put": self._put, "sync": self._sync,
+               "scan": self._scan, "get": self._get, "run": self._run}
+        greeted = False
+
+        try:
+            while True:
+                try:
+                    msg = chan.recv()
+                except EOFError:
+                    break
+                try:
+                    if not greeted and msg.get("op") != "hello":
+                        raise RemoteError("Expected hello")
+                    if msg.get("op") not in ops:
+                        raise RemoteError("Unknown op %s" % msg.get("op"))
+                    ops[msg["op"]](chan, msg)
+                    greeted = True
+                except (RemoteError, OSError, IOError, KeyError) as e:
+                    self.logger.error("%s failed: %s", msg.get("op"), e)
+                    chan.send({"error": str(e)})
+                    if not greeted:
+                        break
+        except socket.error:
+            pass
+        finally:
+            chan.close()
+            for fp in self.locks.values():
+                fp.close()
+            self.locks = {}
+
+    def _bind(self):
+        family, addr = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.remove(addr)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        sock.bind(addr)
+        if family == socket.AF_UNIX:
+            os.chmod(addr, 0o600)
+        sock.listen(16)
+
+        return sock
+
+    def serve(self):
+        for name in ['blobs', 'ws', 'state']:
+            if not os.path.exists(os.path.join(self.work_dir, name)):
+                os.makedirs(os.path.join(self.work_dir, name))
+
+        # Anyone who can reach a tcp port could run commands here, only a unix
+        # socket is protected by its file mode.
+        if parse_address(self.address)[0] != socket.AF_UNIX and self.token is None:
+            self.logger.error("Refusing to listen on %s without a token, set KDEV_REMOTE_TOKEN", self.address)
+            return False
+
+        sock = self._bind()
+        self.logger.info("Build worker listening on %s, work dir %s", self.address, self.work_dir)
+
+        # Every client gets its own process, workspaces are locked per recipe.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        try:
+            while True:
+                conn, addr = sock.accept()
+                pid = os.fork()
+                if pid == 0:
+                    sock.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    try:
+                        self.handle(conn)
+                    finally:
+                        os._exit(0)
+                conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+
+        return True
+
+class RemoteExecutor(object):
+    def __init__(self, address, state_dir, token=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.address = address
+        self.state_dir = state_dir
+        self.token = token
+        self.chan = None
+        self.root = None
+        # Workspaces of different users and hosts never mix on a shared worker.
+        self.client = "%s-%s" % (socket.gethostname(), getpass.getuser())
+
+    def connect(self):
+        family, addr = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(addr)
+        except socket.error as e:
+            self.logger.error("Connecting to build worker %s failed: %s", self.address, e)
+            sock.close()
+            return False
+
+        self.chan = _Channel(sock)
+        reply = self._request({"op": "hello", "version": PROTOCOL_VERSION, "token": self.token})
+        if reply is None:
+            self.close()
+            return False
+        self.root = reply["root"]
+
+        return True
+
+    def _request(self, msg):
+        self.chan.send(msg)
+        reply = self.chan.recv()
+        if "error" in reply:
+            self.logger.error("Build worker %s: %s failed: %s", self.address, msg["op"], reply["error"])
+            return None
+
+        return reply
+
+    def _name(self, name):
+        return "%s/%s" % (self.client, name)
+
+    def path(self, name):
+        return os.path.join(self.root, self._name(name))
+
+    def _manifest(self, name, root, skip=()):
+        # The previous scan saves rehashing unchanged files of big trees.
+        path = os.path.join(self.state_dir, "%s.json" % name.replace('/', '_'))
+        manifest = TreeManifest.scan(root, TreeManifest.load(path), skip)
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+        manifest.save(path)
+
+        return manifest
+
+    def _paths_file(self, name):
+        return os.path.join(self.state_dir, "%s.paths.json" % name.replace('/', '_'))
+
+    def _load_paths(self, name):
+        # rpath -> [worker hash, local hash] of files whose paths differ
+        # between the two sides, or which were checked and do not.
+        path = self._paths_file(name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as fp:
+            return json.load(fp)
+
+    def _save_paths(self, name, known):
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+        with open(self._paths_file(name) + '.tmp', 'w') as fp:
+            json.dump(known, fp)
+        os.rename(self._paths_file(name) + '.tmp', self._paths_file(name))
+
+    def sync_up(self, local_dir, name, skip=(), paths=None):
+        manifest = self._manifest(name, local_dir, skip)
+        entries = dict(manifest.entries)
+        pairs = path_map(paths or {})
+        known = self._load_paths(name) if len(pairs) > 0 else {}
+        sources = {}
+
+        for rpath, entry in entries.items():
+            if stat.S_ISLNK(entry["mode"]) and len(pairs) > 0:
+                entries[rpath] = dict(entry, hash=_translate_link(entry["hash"], pairs))
+            if not stat.S_ISREG(entry["mode"]):
+                continue
+            path = os.path.join(local_dir, rpath)
+            if len(pairs) == 0:
+                sources[entry["hash"]] = (path, None)
+                continue
+
+            # Files carrying local paths, like .cmd files and auto.conf of an
+            # obj dir, get the worker's paths instead.
+            if rpath not in known or known[rpath][1] != entry["hash"]:
+                data = _read_text(path)
+                digest = hashlib.sha256(translate(data, pairs)).hexdigest() if data is not None else entry["hash"]
+                known[rpath] = [digest, entry["hash"]]
+            digest = known[rpath][0]
+            if digest != entry["hash"]:
+                entries[rpath] = dict(entry, hash=digest)
+                sources[digest] = (path, pairs)
+            else:
+                sources[digest] = (path, None)
+
+        if len(pairs) > 0:
+            self._save_paths(name, dict([(rpath, known[rpath]) for rpath in known if rpath in entries]))
+
+        reply = self._request({"op": "missing", "hashes": sorted(sources)})
+        if reply is None:
+            return None
+
+        sent = 0
+        for digest in reply["missing"]:
+            path, pairs = sources[digest]
+            if pairs is not None:
+                with open(path, 'rb') as fp:
+                    self.chan.send_data({"op": "put", "hash": digest}, translate(fp.read(), pairs))
+            else:
+                self.chan.send_file({"op": "put", "hash": digest}, path)
+            if self.chan.recv().get("ok") is None:
+                self.logger.error("Uploading %s to %s failed", path, self.address)
+                return None
+            sent += 1
+
+        self.logger.info("%s: %d files, %d uploaded to %s", name, len(sources), sent, self.address)
+
+        reply = self._request({"op": "sync", "name": self._name(name), "entries": entries})
+
+        return reply["path"] if reply is not None else None
+
+    def sync_down(self, name, local_dir, exclude=(), paths=None):
+        reply = self._request({"op": "scan", "name": self._name(name)})
+        if reply is None:
+            return False
+
+        remote = reply["entries"]
+        local = self._manifest(name, local_dir)
+        pairs = path_map(paths or {})
+        known = self._load_paths(name) if len(pairs) > 0 else {}
+
+        # Content already present locally is copied rather than fetched, that
+        # includes files which only differ by their paths.
+        have = {}
+        for rpath, entry in local.entries.items():
+            if stat.S_ISREG(entry["mode"]):
+                have[entry["hash"]] = os.path.join(local_dir, rpath)
+                if rpath in known and known[rpath][1] == entry["hash"]:
+                    have[known[rpath][0]] = os.path.join(local_dir, rpath)
+
+        for rpath in sorted(local.entries, reverse=True):
+            if rpath in exclude:
+                continue
+            entry = remote.get(rpath)
+            if entry is None or stat.S_IFMT(entry["mode"]) != stat.S_IFMT(local.entries[rpath]["mode"]):
+                _remove(os.path.join(local_dir, rpath))
+
+        fetched = 0
+        for rpath in sorted(remote):
+            if rpath in exclude:
+                continue
+            entry = remote[rpath]
+            old = local.entries.get(rpath)
+            path = os.path.join(local_dir, rpath)
+
+            if stat.S_ISDIR(entry["mode"]):
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif stat.S_ISLNK(entry["mode"]):
+                target = _translate_link(entry["hash"], pairs)
+                if old is None or old["hash"] != target:
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.symlink(target, path)
+            elif stat.S_ISREG(entry["mode"]):
+                current = old["hash"] if old is not None else None
+                if current is not None and (current == entry["hash"] or known.get(rpath) == [entry["hash"], current]):
+                    if old["mode"] != entry["mode"] or old["mtime"] != entry["mtime"]:
+                        os.chmod(path, stat.S_IMODE(entry["mode"]))
+                        set_mtime(path, entry["mtime"])
+                    continue
+                tmp = path + '.kdev-tmp'
+                if entry["hash"] in have and os.path.exists(have[entry["hash"]]):
+                    clone_file(have[entry["hash"]], tmp)
+                else:
+                    self.chan.send({"op": "get", "name": self._name(name), "path": rpath})
+                    reply = self.chan.recv()
+                    if "error" in reply:
+                        self.logger.error("Fetching %s from %s failed: %s", rpath, self.address, reply["error"])
+                        return False
+                    self.chan.recv_file(reply["size"], tmp)
+                    fetched += 1
+                # The worker's paths go back to the local ones, so local
+                # builds of the tree see their own srctree and initramfs.
+                if len(pairs) > 0:
+                    data = _read_text(tmp)
+                    local_data = translate(data, pairs) if data is not None else None
+                    if local_data is not None and local_data != data:
+                        with open(tmp, 'wb') as fp:
+                            fp.write(local_data)
+                        known[rpath] = [entry["hash"], hashlib.sha256(local_data).hexdigest()]
+                    else:
+                        known[rpath] = [entry["hash"], entry["hash"]]
+                os.rename(tmp, path)
+                os.chmod(path, stat.S_IMODE(entry["mode"]))
+                # Outputs keep the worker's mtimes, so a local make of the
+                # same tree does not rebuild them.
+                set_mtime(path, entry["mtime"])
+
+        self.logger.info("%s: %d files fetched from %s", name, fetched, self.address)
+        local = self._manifest(name, local_dir)
+        if len(pairs) > 0:
+            self._save_paths(name, dict([(rpath, known[rpath]) for rpath in known if rpath in local.entries]))
+
+        return True
+
+    def run(self, cmd, output, cwd=None, env=None):
+        self.chan.send({"op": "run", "cmd": cmd, "cwd": cwd, "env": env})
+
+        while True:
+            msg = self.chan.recv()
+            if "out" in msg:
+                output(msg["out"])
+            elif "exit" in msg:
+                return msg["exit"]
+            elif "error" in msg:
+                self.logger.error("Running %s on %s failed: %s", cmd[0], self.address, msg["error"])
+                return 1
+
+    def close(self):
+        if self.chan is not None:
+            self.chan.close()
+            self.chan = None
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Build stage instrumentation and trace reports
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import json
+import time
+import logging
+import resource
+from contextlib import contextmanager
+
+# Extra per stage numbers, like compiler cache hits, filled in by the stage
+# worker and sent back with its rusage.
+_recorded = {}
+
+def record(**metrics):
+    _recorded.update(metrics)
+
+def recorded(clear=False):
+    metrics = dict(_recorded)
+    if clear:
+        _recorded.clear()
+    return metrics
+
+def usage():
+    # Stage workers are fresh processes, so their own counters plus the ones
+    # of the tools they waited for cover exactly one stage.
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    child = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "cpu": own.ru_utime + own.ru_stime + child.ru_utime + child.ru_stime,
+        "maxrss": max(own.ru_maxrss, child.ru_maxrss) * 1024,
+        "write_bytes": (own.ru_oublock + child.ru_oublock) * 512,
+    }
+
+class BuildReport(object):
+    def __init__(self, path, out_dir, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.path = path
+        self.out_dir = out_dir
+        self.origin = time.time()
+        self.events = []
+
+    def add(self, name, start, end, status, metrics=None, cat='stage'):
+        args = {"status": "ok" if status else "failed"}
+        args.update(metrics or {})
+        self.events.append({"name": name, "cat": cat, "start": start, "end": end, "args": args})
+
+    def add_stages(self, sched):
+        for stage in sched.stages.values():
+            if stage.start is None or stage.end is None:
+                continue
+            self.add(stage.name, stage.start, stage.end, stage.status, stage.usage)
+
+    @contextmanager
+    def measure(self, name, cat='stage'):
+        # In-process steps only see tools they waited for in the delta.
+        before = usage()
+        start = time.time()
+        result = {"status": True}
+        try:
+            yield result
+        except Exception:
+            result["status"] = False
+            raise
+        finally:
+            after = usage()
+            metrics = {
+                "cpu": after["cpu"] - before["cpu"],
+                "maxrss": after["maxrss"],
+                "write_bytes": after["write_bytes"] - before["write_bytes"],
+            }
+            self.add(name, start, time.time(), result["status"], metrics, cat)
+
+    @contextmanager
+    def measure_build(self, name):
+        # Stage workers are joined before the run returns, so the children
+        # counters already hold what every stage wrote. Walking the out dir
+        # for its growth costs more than small rebuilds do.
+        with self.measure(name, cat='build') as result:
+            yield result
+        self.events[-1]["args"]["out_bytes"] = self.events[-1]["args"]["write_bytes"]
+
+    def _lanes(self):
+        ends = []
+        lanes = {}
+
+        for index, event in sorted(enumerate(self.events), key=lambda x: (x[1]["cat"] != 'build', x[1]["start"])):
+            if event["cat"] == 'build':
+                lanes[index] = 0
+                continue
+            for lane, end in enumerate(ends):
+                if end <= event["start"]:
+                    break
+            else:
+                lane = len(ends)
+                ends.append(0)
+            ends[lane] = event["end"]
+            lanes[index] = lane + 1
+
+        return lanes
+
+    def trace(self):
+        lanes = self._lanes()
+        events = []
+
+        for index, event in enumerate(self.events):
+            events.append({
+                "name": event["name"],
+                "cat": event["cat"],
+                "ph": "X",
+                "pid": 1,
+                "tid": lanes[index],
+                "ts": int((event["start"] - self.origin) * 1000000),
+                "dur": int((event["end"] - event["start"]) * 1000000),
+                "args": event["args"],
+            })
+
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"out-dir": self.out_dir, "start": self.origin}}
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(self.trace(), fp, indent=1)
+        os.rename(self.path + '.tmp', self.path)
+
+    def summary(self):
+        for event in self.events:
+            args = event["args"]
+            self.logger.info("%-28s %-6s %8.1fs wall %8.1fs cpu %8dM rss %8dM written", event["name"],
+                             args["status"], event["end"] - event["start"], args.get("cpu", 0.0),
+                             args.get("maxrss", 0) // (1024 * 1024), args.get("write_bytes", 0) // (1024 * 1024))
+            if "cc-cache-hits" in args:
+                self.logger.info("%-28s compiler cache %d hits, %d misses (%.0f%%)", '', args["cc-cache-hits"],
+                                 args["cc-cache-misses"], args["cc-cache-hit-rate"])
+            if "modules" in args:
+                self.logger.info("%-28s %d modules %dM -> %dM", '', args["modules"],
+                                 args["modules-bytes-before"] // (1024 * 1024),
+                                 args["modules-bytes-after"] // (1024 * 1024))
+
+        self.logger.info("Build report written to %s", self.path)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Build stage scheduler
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from kdev._report import usage, recorded
+from kdev._jobs import auto_jobs, memory_pressure, MEM_PER_JOB, PSI_HIGH
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def default_jobs(mem_per_job=MEM_PER_JOB):
+    # Nested schedulers inherit the share their parent stage was given.
+    if os.environ.get("KDEV_JOBS", "").isdigit() and int(os.environ["KDEV_JOBS"]) > 0:
+        return int(os.environ["KDEV_JOBS"])
+
+    return auto_jobs(mem_per_job)
+
+def _get_context():
+    # Stages are bound methods of the build object, so they have to be
+    # forked rather than pickled into the worker.
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+def _run_stage(stage, jobs, load, queue):
+    recorded(clear=True)
+    os.environ["MAKEFLAGS"] = "-j%d" % jobs
+    if load is not None and load > 0:
+        os.environ["MAKEFLAGS"] += " -l%g" % load
+    os.environ["KDEV_JOBS"] = "%d" % jobs
+    try:
+        status = stage.func()
+    except Exception:
+        traceback.print_exc()
+        status = False
+    metrics = usage()
+    metrics.update(recorded())
+    queue.put((stage.name, bool(status), metrics))
+
+class Stage(object):
+    def __init__(self, name, func, deps=None, weight=1):
+        self.name = name
+        self.func = func
+        self.deps = list(deps or [])
+        self.weight = max(1, weight)
+        self.jobs = 0
+        self.start = None
+        self.end = None
+        self.status = None
+        self.usage = {}
+
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+class StageScheduler(object):
+    def __init__(self, jobs=None, keep_going=False, load=None, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.jobs = jobs if jobs is not None and jobs > 0 else default_jobs()
+        self.keep_going = keep_going
+        self.load = load
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, func, deps=None, weight=1):
+        if name in self.stages:
+            self.logger.error("Stage %s already exists", name)
+            raise AttributeError
+
+        self.stages[name] = Stage(name, func, deps, weight)
+
+        return self.stages[name]
+
+    def _deps(self, stage):
+        # Dependencies on stages which are not part of this run are already met.
+        return [dep for dep in stage.deps if dep in self.stages]
+
+    def _check_cycles(self):
+        state = {}
+
+        def visit(name):
+            if state.get(name) == 1:
+                return False
+            if state.get(name) == 2:
+                return True
+            state[name] = 1
+            for dep in self._deps(self.stages[name]):
+                if not visit(dep):
+                    return False
+            state[name] = 2
+            return True
+
+        for name in self.stages:
+            if not visit(name):
+                self.logger.error("Stage dependency cycle detected at %s", name)
+                return False
+
+        return True
+
+    def _ready(self, pending):
+        ready = []
+        for name in list(pending):
+            deps = self._deps(self.stages[name])
+            if any(self.stages[dep].status is False for dep in deps):
+                # Stages behind a failed dependency never run.
+                self.logger.warning("Stage %s skipped", name)
+                self.stages[name].status = False
+                pending.remove(name)
+            elif all(self.stages[dep].status is True for dep in deps):
+                ready.append(self.stages[name])
+        return ready
+
+    def run(self):
+        if not self._check_cycles():
+            return False
+
+        ctx = _get_context()
+        queue = ctx.Queue()
+        pending = list(self.stages.keys())
+        running = {}
+        failed = False
+        holding = False
+
+        while len(pending) > 0 or len(running) > 0:
+            if not failed or self.keep_going:
+                ready = self._ready(pending)
+                free = self.jobs - sum([self.stages[name].jobs for name in running])
+                # Starting more work under memory pressure only ends in the OOM killer.
+                pressure = memory_pressure() if len(running) > 0 and len(ready) > 0 else None
+                if pressure is not None and pressure > PSI_HIGH:
+                    if not holding:
+                        self.logger.info("Memory pressure %.0f%%, holding back %d stages", pressure, len(ready))
+                    holding = True
+                    ready = []
+                else:
+                    holding = False
+                total = sum([stage.weight for stage in ready])
+                for stage in ready:
+                    if free < 1 and len(running) > 0:
+                        break
+                    stage.jobs = max(1, min(free, (self.jobs * stage.weight) // total))
+                    free -= stage.jobs
+                    stage.start = time.time()
+                    self.logger.info("Starting stage %s with %d jobs", stage.name, stage.jobs)
+                    proc = ctx.Process(target=_run_stage, args=(stage, stage.jobs, self.load, queue))
+                    proc.start()
+                    running[stage.name] = proc
+                    pending.remove(stage.name)
+
+            if len(running) == 0:
+                # Nothing can be scheduled after a failure.
+                break
+
+            try:
+                name, status, stage_usage = queue.get(timeout=1)
+            except Empty:
+                # A worker which exited cleanly has already queued its result.
+                for name, proc in list(running.items()):
+                    if not proc.is_alive() and proc.exitcode != 0:
+                        proc.join()
+                        self._finish(name, False)
+                        del running[name]
+                        failed = True
+                continue
+
+            if name not in running:
+                continue
+
+            running[name].join()
+            del running[name]
+            self.stages[name].usage = stage_usage
+            self._finish(name, status)
+            if not status:
+                failed = True
+
+        for name in pending:
+            self.logger.warning("Stage %s skipped", name)
+
+        self.report()
+
+        return not failed and len(pending) == 0
+
+    def _finish(self, name, status):
+        stage = self.stages[name]
+        stage.end = time.time()
+        stage.status = status
+        if status:
+            self.logger.info("Stage %s done in %.1fs", name, stage.duration())
+        else:
+            self.logger.error("Stage %s failed after %.1fs", name, stage.duration())
+
+    def critical_path(self):
+        cost = {}
+        prev = {}
+
+        for name in self.stages:
+            stage = self.stages[name]
+            if stage.status is None:
+                continue
+            cost[name] = stage.duration()
+            prev[name] = None
+
+        total = {}
+
+        def resolve(name):
+            if name in total:
+                return
+            best = None
+            for dep in self._deps(self.stages[name]):
+                if dep not in cost:
+                    continue
+                resolve(dep)
+                if best is None or total[dep] > total[best]:
+                    best = dep
+            prev[name] = best
+            total[name] = cost[name] + (total[best] if best is not None else 0.0)
+
+        for name in cost:
+            resolve(name)
+
+        if len(total) == 0:
+            return [], 0.0
+
+        name = max(total, key=lambda x: total[x])
+        length = total[name]
+        path = []
+        while name is not None:
+            path.insert(0, self.stages[name])
+            name = prev[name]
+
+        return path, length
+
+    def report(self):
+        path, length = self.critical_path()
+
+        if len(path) == 0:
+            return
+
+        self.logger.info("Critical path %.1fs: %s", length,
+                         ' -> '.join(["%s(%.1fs)" % (stage.name, stage.duration()) for stage in path]))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+# Persistent shell sessions and system state helpers
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import time
+import uuid
+import fcntl
+import struct
+import logging
+import tempfile
+import subprocess
+
+BLKGETSIZE64 = 0x80081272
+
+def _unescape(path):
+    # mountinfo escapes blanks, tabs, newlines and backslashes as octal.
+    return path.replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n').replace('\\134', '\\')
+
+def mounts():
+    entries = []
+
+    with open('/proc/self/mountinfo') as fp:
+        for line in fp:
+            fields = line.split()
+            sep = fields.index('-')
+            entries.append({
+                "devno": fields[2],
+                "root": _unescape(fields[3]),
+                "target": _unescape(fields[4]),
+                "fstype": fields[sep + 1],
+                "source": _unescape(fields[sep + 2]),
+            })
+
+    return entries
+
+def _sysfs_block(dev):
+    return os.path.join('/sys/class/block', os.path.basename(os.path.realpath(dev)))
+
+def _read_sysfs(path):
+    with open(path) as fp:
+        return fp.read().strip()
+
+def partitions(dev):
+    sysfs = _sysfs_block(dev)
+    name = os.path.basename(sysfs)
+    parts = []
+
+    if not os.path.isdir(sysfs):
+        return parts
+
+    for entry in sorted(os.listdir(sysfs)):
+        if entry.startswith(name) and os.path.exists(os.path.join(sysfs, entry, 'partition')):
+            parts.append(os.path.join('/dev', entry))
+
+    return parts
+
+def devno(dev):
+    sysfs = _sysfs_block(dev)
+    if os.path.exists(os.path.join(sysfs, 'dev')):
+        return _read_sysfs(os.path.join(sysfs, 'dev'))
+
+    st = os.stat(dev)
+
+    return "%d:%d" % (os.major(st.st_rdev), os.minor(st.st_rdev))
+
+def device_size(dev):
+    sysfs = _sysfs_block(dev)
+    if os.path.exists(os.path.join(sysfs, 'size')):
+        return int(_read_sysfs(os.path.join(sysfs, 'size'))) * 512
+
+    fd = os.open(dev, os.O_RDONLY)
+    try:
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, b'\0' * 8)
+    finally:
+        os.close(fd)
+
+    return struct.unpack('Q', buf)[0]
+
+def mount_points(dev):
+    devnos = [devno(part) for part in [dev] + partitions(dev)]
+
+    return [entry["target"] for entry in mounts() if entry["devno"] in devnos]
+
+def loop_devices():
+    loops = {}
+
+    for name in sorted(os.listdir('/sys/block')):
+        backing = os.path.join('/sys/block', name, 'loop/backing_file')
+        if name.startswith('loop') and os.path.exists(backing):
+            loops[os.path.join('/dev', name)] = _read_sysfs(backing)
+
+    return loops
+
+class ShellSession(object):
+    def __init__(self, sudo=False, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.sudo = sudo and os.getuid() != 0
+        self.proc = None
+        self.errfile = None
+        self.erroff = 0
+        self.marker = "__kdev_%s__" % uuid.uuid4().hex
+        self.timings = []
+
+    def _start(self):
+        # All commands share one shell, so sudo asks for a password at most once.
+        args = ['sudo', 'sh'] if self.sudo else ['sh']
+        self.errfile = tempfile.TemporaryFile()
+        self.erroff = 0
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.errfile,
+                                     universal_newlines=True, bufsize=1)
+
+    def cmd(self, command):
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+
+        start = time.time()
+        self.proc.stdin.write("{ %s\n} </dev/null\nrc=$?\nprintf '\\n%s %%d\\n' $rc\n" % (command, self.marker))
+        self.proc.stdin.flush()
+
+        out = []
+        ret = None
+        while True:
+            line = self.proc.stdout.readline()
+            if len(line) == 0:
+                break
+            if line.startswith(self.marker):
+                ret = int(line.split()[1])
+                break
+            out.append(line)
+
+        out = ''.join(out)
+        if out.endswith('\n'):
+            out = out[:-1]
+
+        self.errfile.seek(self.erroff)
+        err = self.errfile.read()
+        self.erroff = self.errfile.tell()
+        if not isinstance(err, str):
+            err = err.decode('utf-8', 'replace')
+
+        if ret is None:
+            # Shell went away, the next command starts a new one.
+            ret = self.proc.wait() or 1
+
+        elapsed = time.time() - start
+        self.timings.append((command, elapsed, ret))
+        self.logger.debug("[%.3fs] %s -> %d", elapsed, command, ret)
+
+        return ret, out, err
+
+    def batch(self, commands):
+        ret = (0, '', '')
+
+        for command in commands:
+            ret = self.cmd(command)
+            if ret[0] != 0:
+                self.logger.error("%s failed", command)
+                self.logger.error(ret)
+                break
+
+        return ret
+
+    def report(self):
+        for command, elapsed, ret in self.timings:
+            self.logger.info("%8.3fs %4d %s", elapsed, ret, command)
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.write("exit\n")
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+        if self.errfile is not None:
+            self.errfile.close()
+            self.errfile = None
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Streaming build command output
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import re
+import json
+import time
+import logging
+import subprocess
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from kdev._scheduler import default_jobs
+from kdev._jobs import JobServer, PressureThrottle, memory_pressure
+
+LOG_MAX_BYTES = 16 * 1024 * 1024
+LOG_BACKUPS = 3
+TAIL_LINES = 200
+
+# Quiet Kbuild prints one "  CC      path" style line per build step.
+_kbuild_re = re.compile(r'^\s{2}(CC|CC \[M\]|LD|LD \[M\]|AR|AS|HOSTCC|HOSTLD|OBJCOPY|GZIP|MODPOST)\s+\S')
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, (seconds % 3600) // 60)
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+class KbuildProgress(object):
+    def __init__(self, name, stats_file, interval=5, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.name = name
+        self.stats_file = stats_file
+        self.interval = interval
+        self.units = 0
+        self.start = time.time()
+        self.last = self.start
+        self.expected = self._load()
+
+    def _load(self):
+        # The previous build of the same tree is the best guess for the size of this one.
+        try:
+            with open(self.stats_file) as fp:
+                return json.load(fp).get("units", 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def update(self, line):
+        if _kbuild_re.match(line) is None:
+            return
+
+        self.units += 1
+
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+
+        elapsed = now - self.start
+        if self.expected > self.units:
+            eta = elapsed * (self.expected - self.units) / self.units
+            self.logger.info("%s: %d/%d steps (%d%%), %s elapsed, ETA %s", self.name, self.units, self.expected,
+                             (100 * self.units) // self.expected, _format_time(elapsed), _format_time(eta))
+        else:
+            self.logger.info("%s: %d steps, %s elapsed", self.name, self.units, _format_time(elapsed))
+
+    def finish(self, status):
+        # Incremental builds do only a fraction of the work, so only full
+        # builds update the estimate.
+        if not status or self.units <= self.expected // 2:
+            return
+
+        with open(self.stats_file, 'w') as fp:
+            json.dump({"units": self.units, "time": time.time() - self.start}, fp)
+
+def stream_cmd(cmd, name, log_dir, cwd=None, env=None, progress=True, tail=TAIL_LINES, executor=None, throttle=True,
+               logger=None):
+    logger = logger or logging.getLogger(__name__)
+
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    # A private logger keeps build output out of the console handlers.
+    flog = logging.Logger("kdev.stream.%s" % name)
+    handler = RotatingFileHandler(os.path.join(log_dir, "%s.log" % name), maxBytes=LOG_MAX_BYTES,
+                                  backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    flog.addHandler(handler)
+
+    meter = KbuildProgress(name, os.path.join(log_dir, "%s.stats" % name), logger=logger) if progress else None
+    lines = deque(maxlen=tail)
+
+    flog.info("# %s", ' '.join(cmd))
+
+    def output(line):
+        flog.info(line)
+        lines.append(line)
+        if meter is not None:
+            meter.update(line)
+
+    if executor is not None:
+        # cwd and env are the worker's, the command runs there.
+        ret = executor.run(cmd, output, cwd=cwd, env=env)
+    else:
+        server = None
+        kwargs = {}
+        jobs = default_jobs()
+        # Without PSI there is nothing to react to, plain -j does the same.
+        if throttle and jobs > 1 and memory_pressure() is not None:
+            server = JobServer(jobs, logger=logger)
+            env = dict(env if env is not None else os.environ)
+            env["MAKEFLAGS"] = server.makeflags(env.get("MAKEFLAGS", ""))
+            kwargs = server.popen_args()
+
+        try:
+            proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    **kwargs)
+        except OSError as e:
+            logger.error("Running %s failed: %s", cmd[0], e)
+            handler.close()
+            if server is not None:
+                server.close()
+            return 1, [str(e)]
+
+        monitor = None
+        if server is not None:
+            monitor = PressureThrottle(server, name, logger=logger)
+            monitor.start()
+
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                output(line.decode('utf-8', 'replace').rstrip('\n'))
+
+            proc.stdout.close()
+            ret = proc.wait()
+        finally:
+            if monitor is not None:
+                monitor.stop()
+            if server is not None:
+                server.close()
+
+    if meter is not None:
+        meter.finish(ret == 0)
+
+    flog.info("# exit status %d", ret)
+    handler.close()
+
+    return ret, list(lines)
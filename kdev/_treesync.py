@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Incremental directory tree sync
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import stat
+import fcntl
+import errno
+import shutil
+import hashlib
+import logging
+
+FICLONE = 0x40049409
+
+def _hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def clone_file(src, dst):
+    with open(src, 'rb') as sfp:
+        with open(dst, 'wb') as dfp:
+            # Copy on write filesystems share the extents, nothing is copied.
+            try:
+                fcntl.ioctl(dfp.fileno(), FICLONE, sfp.fileno())
+                return 'reflink'
+            except (IOError, OSError):
+                pass
+
+            # In kernel copy, which NFS and overlayfs can offload.
+            if hasattr(os, 'copy_file_range'):
+                size = os.fstat(sfp.fileno()).st_size
+                offset = 0
+                try:
+                    while offset < size:
+                        count = os.copy_file_range(sfp.fileno(), dfp.fileno(), size - offset)
+                        if count == 0:
+                            break
+                        offset += count
+                    if offset == size:
+                        return 'copy'
+                except OSError as e:
+                    if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL]:
+                        raise
+                sfp.seek(0)
+                dfp.seek(0)
+                dfp.truncate()
+
+            shutil.copyfileobj(sfp, dfp, 1024 * 1024)
+
+    return 'copy'
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+class TreeSync(object):
+    def __init__(self, hardlink=False, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        # Hardlinked files share the inode with the source, so this is only
+        # safe for destinations which are never modified in place.
+        self.hardlink = hardlink
+        self.seen = set()
+        self.stats = {"same": 0, "reflink": 0, "hardlink": 0, "copy": 0, "removed": 0, "bytes": 0}
+
+    def _unchanged(self, sst, spath, dpath):
+        try:
+            dst = os.lstat(dpath)
+        except OSError:
+            return False
+
+        if stat.S_IFMT(dst.st_mode) != stat.S_IFMT(sst.st_mode):
+            return False
+
+        if stat.S_ISLNK(sst.st_mode):
+            return os.readlink(spath) == os.readlink(dpath)
+
+        if stat.S_ISREG(sst.st_mode):
+            if dst.st_ino == sst.st_ino and dst.st_dev == sst.st_dev:
+                return True
+            if dst.st_size != sst.st_size:
+                return False
+            if dst.st_mtime != sst.st_mtime:
+                # Same size, different mtime: content decides, metadata is fixed up.
+                if _hash(spath) != _hash(dpath):
+                    return False
+                shutil.copystat(spath, dpath)
+            elif dst.st_mode != sst.st_mode:
+                os.chmod(dpath, stat.S_IMODE(sst.st_mode))
+            return True
+
+        if stat.S_ISCHR(sst.st_mode) or stat.S_ISBLK(sst.st_mode):
+            return dst.st_rdev == sst.st_rdev and dst.st_mode == sst.st_mode
+
+        return True
+
+    def _transfer(self, sst, spath, dpath):
+        if os.path.lexists(dpath):
+            _remove(dpath)
+
+        if stat.S_ISLNK(sst.st_mode):
+            os.symlink(os.readlink(spath), dpath)
+            self.stats["copy"] += 1
+            return
+
+        if not stat.S_ISREG(sst.st_mode):
+            try:
+                os.mknod(dpath, sst.st_mode, sst.st_rdev)
+            except OSError:
+                self.logger.warning("Skipping special file %s", spath)
+            return
+
+        if self.hardlink:
+            try:
+                os.link(spath, dpath)
+                self.stats["hardlink"] += 1
+                return
+            except OSError:
+                pass
+
+        self.stats[clone_file(spath, dpath)] += 1
+        self.stats["bytes"] += sst.st_size
+        shutil.copystat(spath, dpath)
+
+    def sync_file(self, src, dst):
+        sst = os.lstat(src)
+        self.seen.add(os.path.abspath(dst))
+
+        if not os.path.exists(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+
+        if self._unchanged(sst, src, dst):
+            self.stats["same"] += 1
+            return
+
+        self._transfer(sst, src, dst)
+
+    def sync(self, src, dst):
+        src = os.path.abspath(src)
+        dst = os.path.abspath(dst)
+
+        if not os.path.isdir(dst):
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.makedirs(dst)
+        self.seen.add(dst)
+
+        dirs = [(src, dst)]
+        for base, dirnames, filenames in os.walk(src):
+            ddir = os.path.join(dst, os.path.relpath(base, src))
+            for name in dirnames + filenames:
+                spath = os.path.join(base, name)
+                dpath = os.path.normpath(os.path.join(ddir, name))
+                sst = os.lstat(spath)
+                self.seen.add(dpath)
+                if stat.S_ISDIR(sst.st_mode):
+                    if os.path.islink(dpath) or (os.path.lexists(dpath) and not os.path.isdir(dpath)):
+                        os.remove(dpath)
+                    if not os.path.exists(dpath):
+                        os.mkdir(dpath)
+                    dirs.append((spath, dpath))
+                elif self._unchanged(sst, spath, dpath):
+                    self.stats["same"] += 1
+                else:
+                    self._transfer(sst, spath, dpath)
+
+        # Directory times last, after their entries stopped changing.
+        for spath, dpath in reversed(dirs):
+            shutil.copystat(spath, dpath)
+
+        return True
+
+    def prune(self, root):
+        # Drops everything below root which none of the syncs produced.
+        root = os.path.abspath(root)
+        keep = set()
+        for path in self.seen:
+            while path not in keep and path != os.path.dirname(path):
+                keep.add(path)
+                path = os.path.dirname(path)
+
+        for base, dirnames, filenames in os.walk(root, topdown=False):
+            for name in dirnames + filenames:
+                path = os.path.join(base, name)
+                if path in keep:
+                    continue
+                _remove(path)
+                self.stats["removed"] += 1
+
+    def report(self, name):
+        self.logger.info("Synced %s: %d unchanged, %d reflinked, %d hardlinked, %d copied (%d bytes), %d removed",
+                         name, self.stats["same"], self.stats["reflink"], self.stats["hardlink"],
+                         self.stats["copy"], self.stats["bytes"], self.stats["removed"])
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# inotify based tree watcher
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Inital script
+# @TODO    :
+#
+#
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF)
+
+_event = struct.Struct('iIII')
+
+def _ignored(name):
+    # Editor swap and backup files, and hidden files like .git or Kbuild's
+    # .cmd files, never need a rebuild.
+    return name.startswith('.') or name.endswith('~') or name.endswith('.swp') or name == '4913'
+
+class TreeWatcher(object):
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # wd -> dir, the tag of a recursively watched tree and the tags of
+        # single files watched in the dir.
+        self.watches = {}
+        self.skip = set()
+        self.pending = {}
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self.logger.error("Out of inotify watches, raise fs.inotify.max_user_watches")
+            elif err != errno.ENOENT:
+                self.logger.warning("Watching %s failed: %s", path, os.strerror(err))
+            return None
+
+        if wd not in self.watches:
+            self.watches[wd] = {"path": path, "tree": None, "files": {}}
+
+        return self.watches[wd]
+
+    def add_tree(self, root, tag):
+        root = os.path.abspath(root)
+
+        if not os.path.isdir(root):
+            # Picked up as a tree once it gets created.
+            self.pending[root] = tag
+            self.add_file(root, tag)
+            return
+
+        for base, dirs, files in os.walk(root):
+            dirs[:] = [name for name in dirs if not _ignored(name) and os.path.join(base, name) not in self.skip]
+            watch = self._add_watch(base)
+            if watch is not None:
+                watch["tree"] = tag
+
+    def add_file(self, path, tag):
+        path = os.path.abspath(path)
+        watch = self._add_watch(os.path.dirname(path))
+        if watch is not None:
+            watch["files"][os.path.basename(path)] = tag
+
+    def add_skip(self, path):
+        # Build output inside a watched tree would retrigger builds forever.
+        self.skip.add(os.path.abspath(path))
+
+    def _read(self):
+        tags = set()
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    break
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, offset)
+                name = data[offset + _event.size:offset + _event.size + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += _event.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, every tree has to be considered changed.
+                    for watch in self.watches.values():
+                        tags.update([watch["tree"]] + list(watch["files"].values()))
+                    tags.discard(None)
+                    continue
+
+                if wd not in self.watches:
+                    continue
+
+                watch = self.watches[wd]
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                tag = watch["files"].get(name, watch["tree"])
+                if tag is None or (len(name) > 0 and _ignored(name)):
+                    continue
+
+                full = os.path.join(watch["path"], name)
+                if full in self.skip:
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    if full in self.pending:
+                        self.add_tree(full, self.pending.pop(full))
+                    elif watch["tree"] is not None:
+                        self.add_tree(full, watch["tree"])
+
+                self.logger.debug("%s changed (%s)", full, tag)
+                tags.add(tag)
+
+        return tags
+
+    def wait(self, delay=0.5):
+        # Blocks until something changed, then keeps collecting until the
+        # trees were quiet for delay seconds, so a save of many files or a
+        # git checkout turns into one rebuild.
+        tags = set()
+
+        while len(tags) == 0:
+            select.select([self.fd], [], [])
+            tags |= self._read()
+
+        while True:
+            ready = select.select([self.fd], [], [], delay)[0]
+            if len(ready) == 0:
+                break
+            tags |= self._read()
+
+        return tags
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
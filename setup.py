@@ -59,7 +59,7 @@ setup(name='kdev',
           ''
       ],
       entry_points={
-          'console_scripts': ['kdevimg = app.kdevimg:cli'],
+          'console_scripts': ['kdevimg = app.kdevimg:cli', 'kdevimg-client = app.kdevclient:main'],
       },
       include_package_data=True,
       zip_safe=False)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Android boot image writer tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+import os
+import struct
+import shutil
+import hashlib
+import tempfile
+import unittest
+from kdev._bootimg import BootImageWriter, os_version
+
+def mkbootimg_header(kernel, ramdisk, cmdline, name, pagesize):
+    # Field by field, the way mkbootimg writes a version 0 header.
+    sha = hashlib.sha1()
+    for blob in (kernel, ramdisk, b''):
+        sha.update(blob)
+        sha.update(struct.pack('<I', len(blob)))
+
+    header = b'ANDROID!'
+    header += struct.pack('<10I', len(kernel), 0x10008000, len(ramdisk), 0x11000000, 0, 0x10f00000,
+                          0x10000100, pagesize, 0, os_version('v1.0', 0))
+    header += name[:15].ljust(16, b'\0')
+    header += cmdline[:511].ljust(512, b'\0')
+    header += sha.digest().ljust(32, b'\0')
+    header += cmdline[511:].ljust(1024, b'\0')
+    return header
+
+class BootImageTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.kernel = os.urandom(10000)
+        self.ramdisk = os.urandom(5000)
+        for name, data in [('bzImage', self.kernel), ('initrd', self.ramdisk)]:
+            with open(os.path.join(self.root, name), 'wb') as fp:
+                fp.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, cmdline, name=b'kdev'):
+        image = os.path.join(self.root, 'boot.img')
+        writer = BootImageWriter(image, 2048)
+        sizes = writer.write(os.path.join(self.root, 'bzImage'), os.path.join(self.root, 'initrd'),
+                             cmdline=cmdline, name=name, version=os_version('v1.0', 0))
+        self.assertEqual(sizes, (len(self.kernel), len(self.ramdisk), 0))
+        with open(image, 'rb') as fp:
+            return fp.read()
+
+    def test_header(self):
+        cmdline = b'console=ttyS0,115200n8 root=/dev/ram0 rw'
+        data = self._write(cmdline)
+        header = mkbootimg_header(self.kernel, self.ramdisk, cmdline, b'kdev', 2048)
+        self.assertEqual(data[:len(header)], header)
+        self.assertEqual(data[len(header):2048], b'\0' * (2048 - len(header)))
+        self.assertEqual(data[2048:2048 + len(self.kernel)], self.kernel)
+        self.assertEqual(data[12288:12288 + len(self.ramdisk)], self.ramdisk)
+        self.assertEqual(len(data), 12288 + 6144)
+
+    def test_long_cmdline(self):
+        # Both command line fields keep their terminating NUL.
+        cmdline = b''.join([b'opt%d=%d ' % (index, index) for index in range(150)])[:1200]
+        data = self._write(cmdline)
+        header = mkbootimg_header(self.kernel, self.ramdisk, cmdline, b'kdev', 2048)
+        self.assertEqual(data[:len(header)], header)
+        self.assertEqual(data[48 + 16 + 511:48 + 16 + 512], b'\0')
+        self.assertEqual(data[64:64 + 511] + data[608:608 + 1024].rstrip(b'\0'), cmdline)
+
+    def test_cmdline_too_long(self):
+        self._write(b'x' * 1534)
+        self.assertRaises(ValueError, self._write, b'x' * 1535)
+
+if __name__ == '__main__':
+    unittest.main()
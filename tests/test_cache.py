@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# stage cache tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+from kdev._cache import StageCache, hash_tree
+
+class StageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.out = os.path.join(self.root, 'out')
+        os.makedirs(self.out)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _output(self, name, size):
+        path = os.path.join(self.out, name)
+        with open(path, 'wb') as fp:
+            fp.write(b'\0' * size)
+        return path
+
+    def _age(self, cache, stage, key, mtime):
+        marker = os.path.join(cache.cache_dir, stage, key, '.complete')
+        os.utime(marker, (mtime, mtime))
+
+    def test_key_changes_with_inputs(self):
+        cache = StageCache(os.path.join(self.root, 'cache'))
+        tree = os.path.join(self.root, 'tree')
+        os.makedirs(tree)
+        self._output('a', 10)
+        shutil.copy2(os.path.join(self.out, 'a'), tree)
+
+        inputs = {"params": {"arch": "x86_64"}, "tree": hash_tree(tree), "source-revision": "1" * 40}
+        key = cache.key(inputs)
+        self.assertEqual(key, cache.key(dict(inputs)))
+
+        # A moved branch, a changed tree or changed params each miss.
+        self.assertNotEqual(key, cache.key(dict(inputs, **{"source-revision": "2" * 40})))
+        self.assertNotEqual(key, cache.key(dict(inputs, params={"arch": "arm64"})))
+        with open(os.path.join(tree, 'a'), 'ab') as fp:
+            fp.write(b'x')
+        self.assertNotEqual(key, cache.key(dict(inputs, tree=hash_tree(tree))))
+
+        # An unresolved input, like an unreachable remote, is never cached.
+        self.assertEqual(cache.key(dict(inputs, **{"source-revision": None})), None)
+        self.assertFalse(cache.store('rootfs', None, {"a": os.path.join(self.out, 'a')}))
+
+    def test_store_restore(self):
+        cache = StageCache(os.path.join(self.root, 'cache'))
+        key = cache.key({"value": 1})
+        src = self._output('a', 100)
+
+        self.assertFalse(cache.lookup('stage', key))
+        self.assertTrue(cache.store('stage', key, {"a": src}))
+        self.assertTrue(cache.lookup('stage', key))
+
+        dst = os.path.join(self.root, 'restored', 'a')
+        self.assertTrue(cache.restore('stage', key, {"a": dst}))
+        self.assertEqual(os.path.getsize(dst), 100)
+
+    def test_prune_least_recently_used(self):
+        cache = StageCache(os.path.join(self.root, 'cache'), max_size=2500)
+        keys = [cache.key({"value": index}) for index in range(3)]
+
+        for index, key in enumerate(keys):
+            self.assertTrue(cache.store('stage', key, {"a": self._output('a', 1000)}))
+            self._age(cache, 'stage', key, 1000 + index)
+
+        # The third entry pushed the cache over, the oldest one went.
+        self.assertFalse(cache.lookup('stage', keys[0]))
+        self.assertTrue(cache.lookup('stage', keys[1]))
+        self.assertTrue(cache.lookup('stage', keys[2]))
+
+        # A hit makes an entry the most recently used one.
+        self.assertTrue(cache.restore('stage', keys[1], {"a": os.path.join(self.root, 'restored')}))
+        key = cache.key({"value": 3})
+        self.assertTrue(cache.store('stage', key, {"a": self._output('a', 1000)}))
+        self.assertTrue(cache.lookup('stage', keys[1]))
+        self.assertFalse(cache.lookup('stage', keys[2]))
+        self.assertTrue(cache.lookup('stage', key))
+
+    def test_prune_keeps_new_entry(self):
+        cache = StageCache(os.path.join(self.root, 'cache'), max_size=500)
+        key = cache.key({"value": 1})
+
+        # An entry larger than the whole cache still serves the next build.
+        self.assertTrue(cache.store('stage', key, {"a": self._output('a', 1000)}))
+        self.assertTrue(cache.lookup('stage', key))
+
+    def test_prune_unmarked_sizes(self):
+        cache = StageCache(os.path.join(self.root, 'cache'), max_size=1500)
+        keys = [cache.key({"value": index}) for index in range(2)]
+
+        # Entries stored before sizes were recorded have an empty marker.
+        self.assertTrue(cache.store('stage', keys[0], {"a": self._output('a', 1000)}))
+        open(os.path.join(cache.cache_dir, 'stage', keys[0], '.complete'), 'w').close()
+        self._age(cache, 'stage', keys[0], 1000)
+
+        self.assertTrue(cache.store('stage', keys[1], {"a": self._output('a', 1000)}))
+        self.assertFalse(cache.lookup('stage', keys[0]))
+        self.assertTrue(cache.lookup('stage', keys[1]))
+
+if __name__ == '__main__':
+    unittest.main()
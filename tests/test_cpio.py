@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# cpio image writer tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+import os
+import zlib
+import random
+import shutil
+import tempfile
+import unittest
+from kdev._cpio import gen_cpio_image, crc32_combine, BLOCK_SIZE, lzma
+
+def read_newc(data):
+    entries = {}
+    offset = 0
+
+    while True:
+        assert data[offset:offset + 6] == b'070701', "bad magic at %d" % offset
+        fields = [int(data[offset + 6 + index * 8:offset + 14 + index * 8], 16) for index in range(13)]
+        mode, size, namesize = fields[1], fields[6], fields[11]
+        offset += 110
+        name = data[offset:offset + namesize - 1].decode('utf-8')
+        offset = (offset + namesize + 3) & ~3
+        if name == 'TRAILER!!!':
+            return entries
+        entries[name] = (mode, data[offset:offset + size])
+        offset = (offset + size + 3) & ~3
+
+class CpioTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.tree = os.path.join(self.root, 'tree')
+        rnd = random.Random(0)
+
+        os.makedirs(os.path.join(self.tree, 'bin'))
+        os.makedirs(os.path.join(self.tree, 'lib', 'modules'))
+        # Well over one compression block, with entries straddling block ends.
+        with open(os.path.join(self.tree, 'bin', 'busybox'), 'wb') as fp:
+            fp.write(os.urandom(BLOCK_SIZE + 12345))
+        for index in range(200):
+            with open(os.path.join(self.tree, 'lib', 'modules', 'm%d.ko' % index), 'wb') as fp:
+                fp.write(os.urandom(rnd.randint(0, 40000)) + b'\0' * rnd.randint(0, 4096))
+        os.symlink('busybox', os.path.join(self.tree, 'bin', 'sh'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _check(self, data):
+        entries = read_newc(data)
+        for base, dirs, files in os.walk(self.tree):
+            for name in dirs + files:
+                path = os.path.join(base, name)
+                rel = os.path.relpath(path, self.tree)
+                self.assertIn(rel, entries)
+                if os.path.islink(path):
+                    self.assertEqual(entries[rel][1], os.readlink(path).encode('utf-8'))
+                elif os.path.isfile(path):
+                    with open(path, 'rb') as fp:
+                        self.assertEqual(entries[rel][1], fp.read())
+
+    def test_gzip_single_member(self):
+        image = os.path.join(self.root, 'initramfs.cpio.gz')
+        self.assertTrue(gen_cpio_image(self.tree, image, 'gzip', threads=4))
+
+        with open(image, 'rb') as fp:
+            data = fp.read()
+        # The kernel unpacker stops after the first member.
+        comp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = comp.decompress(data)
+        self.assertEqual(comp.unused_data, b'')
+        self.assertGreater(len(out), BLOCK_SIZE)
+        self._check(out)
+
+    def test_gzip_thread_count_reproducible(self):
+        one = os.path.join(self.root, 'one.cpio.gz')
+        four = os.path.join(self.root, 'four.cpio.gz')
+        self.assertTrue(gen_cpio_image(self.tree, one, 'gzip', threads=1))
+        self.assertTrue(gen_cpio_image(self.tree, four, 'gzip', threads=4))
+        with open(one, 'rb') as fp1, open(four, 'rb') as fp2:
+            self.assertEqual(fp1.read(), fp2.read())
+
+    @unittest.skipIf(lzma is None, "lzma module not available")
+    def test_xz_single_stream(self):
+        image = os.path.join(self.root, 'initramfs.cpio.xz')
+        self.assertTrue(gen_cpio_image(self.tree, image, 'xz', threads=4))
+
+        with open(image, 'rb') as fp:
+            data = fp.read()
+        comp = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        out = comp.decompress(data)
+        self.assertEqual(comp.unused_data, b'')
+        self._check(out)
+
+    def test_none(self):
+        image = os.path.join(self.root, 'initramfs.cpio')
+        self.assertTrue(gen_cpio_image(self.tree, image, 'none'))
+        with open(image, 'rb') as fp:
+            self._check(fp.read())
+
+    def test_crc32_combine(self):
+        first = os.urandom(1000)
+        second = os.urandom(3333)
+        self.assertEqual(crc32_combine(zlib.crc32(first) & 0xffffffff, zlib.crc32(second) & 0xffffffff,
+                                       len(second)), zlib.crc32(first + second) & 0xffffffff)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# GPT disk image layout tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+
+import zlib
+import uuid
+import struct
+import unittest
+from kdev._diskimg import DiskImage, SECTOR_SIZE, GPT_ENTRIES, GPT_ENTRY_SIZE, GPT_SECTORS, GUID_EFI_SYSTEM, \
+    GUID_LINUX_FS, MB
+
+HEADER = '<8sIIIIQQQQ16sQIII'
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+class GptTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = DiskImage('/tmp/kdev-test.img', 64, seed='test')
+        self.disk.add_partition('boot', 16, 0xef, 'fat32')
+        self.disk.add_partition('rootfs', 32, 0x83, 'ext4')
+        self.assertTrue(self.disk._layout())
+        self.primary, self.backup = self.disk._gpt()
+        self.sectors = self.disk.size // SECTOR_SIZE
+
+    def _header(self, data):
+        fields = list(struct.unpack(HEADER, data[:struct.calcsize(HEADER)]))
+        self.assertEqual(fields[0], b'EFI PART')
+        self.assertEqual(fields[2], 92)
+        # The header CRC covers its own 92 bytes with the CRC field zeroed.
+        crc = fields[3]
+        fields[3] = 0
+        self.assertEqual(crc32(struct.pack(HEADER, *fields)), crc)
+        self.assertEqual(data[92:], b'\0' * (SECTOR_SIZE - 92))
+        return fields
+
+    def test_protective_mbr(self):
+        mbr = self.primary[:SECTOR_SIZE]
+        self.assertEqual(mbr[510:], b'\x55\xaa')
+        self.assertEqual(bytearray(mbr)[450], 0xee)
+        self.assertEqual(struct.unpack('<II', mbr[454:462]), (1, self.sectors - 1))
+
+    def test_headers(self):
+        entries = self.primary[2 * SECTOR_SIZE:]
+        self.assertEqual(len(entries), GPT_ENTRIES * GPT_ENTRY_SIZE)
+        self.assertEqual(self.backup[:len(entries)], entries)
+
+        primary = self._header(self.primary[SECTOR_SIZE:2 * SECTOR_SIZE])
+        backup = self._header(self.backup[len(entries):])
+
+        self.assertEqual(primary[5:7], [1, self.sectors - 1])
+        self.assertEqual(backup[5:7], [self.sectors - 1, 1])
+        self.assertEqual(primary[7:9], [2 + GPT_SECTORS, self.sectors - GPT_SECTORS - 2])
+        self.assertEqual(primary[9], backup[9])
+        self.assertEqual(primary[10], 2)
+        self.assertEqual(backup[10], self.sectors - 1 - GPT_SECTORS)
+        self.assertEqual(primary[11:13], [GPT_ENTRIES, GPT_ENTRY_SIZE])
+        self.assertEqual(primary[13], crc32(entries))
+        self.assertEqual(backup[13], crc32(entries))
+
+    def test_entries(self):
+        entries = self.primary[2 * SECTOR_SIZE:]
+        parts = []
+        for index in range(GPT_ENTRIES):
+            entry = entries[index * GPT_ENTRY_SIZE:(index + 1) * GPT_ENTRY_SIZE]
+            type_guid, guid, first, last, flags, name = struct.unpack('<16s16sQQQ72s', entry)
+            if type_guid == b'\0' * 16:
+                continue
+            parts.append((str(uuid.UUID(bytes_le=type_guid)).upper(), first, last,
+                          name.decode('utf-16-le').rstrip('\0')))
+
+        self.assertEqual(parts, [(GUID_EFI_SYSTEM, MB // SECTOR_SIZE, 17 * MB // SECTOR_SIZE - 1, 'boot'),
+                                 (GUID_LINUX_FS, 17 * MB // SECTOR_SIZE, 49 * MB // SECTOR_SIZE - 1, 'rootfs')])
+
+    def test_stable_guids(self):
+        other = DiskImage('/tmp/kdev-test.img', 64, seed='test')
+        other.add_partition('boot', 16, 0xef, 'fat32')
+        other.add_partition('rootfs', 32, 0x83, 'ext4')
+        other._layout()
+        self.assertEqual(other._gpt(), (self.primary, self.backup))
+
+if __name__ == '__main__':
+    unittest.main()
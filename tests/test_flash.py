@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# Block device flashing tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from kdev._flash import FlashWriter
+
+BLOCK = 64 * 1024
+
+class FlashWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.image = os.path.join(self.root, 'disk.img')
+        self.dev = os.path.join(self.root, 'dev')
+        self.state = os.path.join(self.root, 'state')
+
+        # Data, a hole, data up to an unaligned tail.
+        self.size = 10 * BLOCK + 1000
+        with open(self.image, 'wb') as fp:
+            fp.truncate(self.size)
+            fp.write(os.urandom(BLOCK + 10))
+            fp.seek(6 * BLOCK)
+            fp.write(os.urandom(4 * BLOCK + 1000))
+        with open(self.dev, 'wb') as fp:
+            fp.write(b'\xff' * (12 * BLOCK))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _flash(self, full=False):
+        return FlashWriter(self.image, self.dev, block_size=BLOCK, state_dir=self.state).write(full)
+
+    def _read(self, path, size):
+        with open(path, 'rb') as fp:
+            return fp.read(size)
+
+    def test_round_trip(self):
+        self.assertTrue(self._flash())
+        dev = self._read(self.dev, 12 * BLOCK)
+        image = self._read(self.image, self.size)
+        data = [(0, 2 * BLOCK), (6 * BLOCK, self.size)]
+        for start, end in data:
+            self.assertEqual(dev[start:end], image[start:end])
+        # Holes are skipped, whatever the device had there stays.
+        self.assertEqual(dev[3 * BLOCK:5 * BLOCK], b'\xff' * (2 * BLOCK))
+        self.assertEqual(dev[self.size:], b'\xff' * (12 * BLOCK - self.size))
+
+    def test_incremental(self):
+        self.assertTrue(self._flash())
+        with open(self.image, 'r+b') as fp:
+            fp.seek(7 * BLOCK + 5)
+            fp.write(b'kdev')
+        # Unchanged blocks are skipped, so scribbling on one shows they are
+        # not written again.
+        with open(self.dev, 'r+b') as fp:
+            fp.seek(8 * BLOCK)
+            fp.write(b'\0' * 4)
+        self.assertTrue(self._flash())
+        dev = self._read(self.dev, self.size)
+        image = self._read(self.image, self.size)
+        self.assertEqual(dev[7 * BLOCK:8 * BLOCK], image[7 * BLOCK:8 * BLOCK])
+        self.assertEqual(dev[8 * BLOCK:8 * BLOCK + 4], b'\0' * 4)
+
+        self.assertTrue(self._flash(full=True))
+        self.assertEqual(self._read(self.dev, self.size)[6 * BLOCK:], image[6 * BLOCK:])
+
+    def test_too_small(self):
+        with open(self.dev, 'r+b') as fp:
+            fp.truncate(BLOCK)
+        self.assertFalse(self._flash())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# kernel .config handling tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from kdev._kconfig import KconfigMap, update_config
+
+CONFIG = """#
+# Automatically generated file; DO NOT EDIT.
+#
+CONFIG_64BIT=y
+CONFIG_LOCALVERSION=""
+# CONFIG_MODULES is not set
+
+CONFIG_BLK_DEV_INITRD=y
+CONFIG_INITRAMFS_SOURCE="/old"
+"""
+
+class KconfigMapTest(unittest.TestCase):
+    def setUp(self):
+        self.cfg = KconfigMap()
+        self.cfg.parse(CONFIG)
+
+    def test_round_trip(self):
+        self.assertEqual(self.cfg.dumps(), CONFIG)
+        self.assertEqual(self.cfg.get('CONFIG_64BIT'), 'y')
+        self.assertEqual(self.cfg.get('CONFIG_LOCALVERSION'), '""')
+        self.assertIsNone(self.cfg.get('CONFIG_MODULES'))
+
+    def test_merge(self):
+        changed = self.cfg.merge(['CONFIG_MODULES=y', 'CONFIG_64BIT=y', 'CONFIG_BLK_DEV_INITRD=n',
+                                  'CONFIG_INITRAMFS_SOURCE="/new"', 'CONFIG_NEW=m', 'bogus'])
+        self.assertEqual(changed, ['CONFIG_MODULES', 'CONFIG_BLK_DEV_INITRD', 'CONFIG_INITRAMFS_SOURCE',
+                                   'CONFIG_NEW'])
+        # Symbols keep their place, new ones go last.
+        self.assertEqual(self.cfg.dumps(), CONFIG.replace('# CONFIG_MODULES is not set', 'CONFIG_MODULES=y')
+                         .replace('CONFIG_BLK_DEV_INITRD=y', '# CONFIG_BLK_DEV_INITRD is not set')
+                         .replace('/old', '/new') + 'CONFIG_NEW=m\n')
+
+    def test_merge_unchanged(self):
+        self.assertEqual(self.cfg.merge(['CONFIG_64BIT=y', '# CONFIG_MODULES is not set']), [])
+        self.assertEqual(self.cfg.dumps(), CONFIG)
+
+class UpdateConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.base = os.path.join(self.root, 'config')
+        self.dst = os.path.join(self.root, 'obj', '.config')
+        os.makedirs(os.path.dirname(self.dst))
+        with open(self.base, 'w') as fp:
+            fp.write(CONFIG)
+        self.runs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def olddefconfig(self):
+        self.runs += 1
+        return True
+
+    def test_update(self):
+        fragments = ['CONFIG_INITRAMFS_SOURCE="/new"']
+        self.assertTrue(update_config(self.base, fragments, self.dst, self.olddefconfig, 'rev1'))
+        self.assertEqual(self.runs, 1)
+        mtime = os.stat(self.dst).st_mtime
+
+        self.assertFalse(update_config(self.base, fragments, self.dst, self.olddefconfig, 'rev1'))
+        self.assertEqual(self.runs, 1)
+
+        # A new kernel source can bring new symbols, olddefconfig runs
+        # again but an unchanged result keeps its mtime.
+        self.assertFalse(update_config(self.base, fragments, self.dst, self.olddefconfig, 'rev2'))
+        self.assertEqual(self.runs, 2)
+        self.assertAlmostEqual(os.stat(self.dst).st_mtime, mtime, places=5)
+
+if __name__ == '__main__':
+    unittest.main()
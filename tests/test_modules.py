@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Kernel module post processing tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+
+import os
+import gzip
+import logging
+import stat
+import shutil
+import tempfile
+import unittest
+from kdev._modules import process_modules
+from kdev._kdev import KdevBuild
+
+SIGNATURE = b'~Module signature appended~\n'
+
+class ProcessModulesTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.base = os.path.join(self.root, 'rootfs')
+        self.mod_dir = os.path.join(self.base, 'lib/modules/5.0.0/kernel/drivers/foo')
+        os.makedirs(self.mod_dir)
+
+        # Signed like modules_install leaves them, the ELF part does not
+        # matter here.
+        self.modules = {}
+        for name in ['a.ko', 'b.ko']:
+            data = b'\x7fELF' + os.urandom(3000) + b'\0' * 2000 + b'PKCS7' + SIGNATURE
+            with open(os.path.join(self.mod_dir, name), 'wb') as fp:
+                fp.write(data)
+            self.modules[name] = data
+
+        # depmod only has to leave a trace, it is not what is tested.
+        self.bin = os.path.join(self.root, 'bin')
+        os.makedirs(self.bin)
+        depmod = os.path.join(self.bin, 'depmod')
+        with open(depmod, 'w') as fp:
+            fp.write('#!/bin/sh\ntouch "$2/lib/modules/$4/modules.dep"\n')
+        os.chmod(depmod, stat.S_IRWXU)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.bin + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.root)
+
+    def test_compress_keeps_signature(self):
+        stats = process_modules(self.base, 'gzip', jobs=2)
+        self.assertEqual(stats["modules"], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.base, 'lib/modules/5.0.0/modules.dep')))
+
+        for name, data in self.modules.items():
+            self.assertFalse(os.path.exists(os.path.join(self.mod_dir, name)))
+            with gzip.open(os.path.join(self.mod_dir, name + '.gz'), 'rb') as fp:
+                out = fp.read()
+            self.assertTrue(out.endswith(SIGNATURE))
+            self.assertEqual(out, data)
+
+    def test_installed_subset(self):
+        stats = process_modules(self.base, 'gzip', modules=[os.path.join(self.mod_dir, 'a.ko')])
+        self.assertEqual(stats["modules"], 1)
+        self.assertTrue(os.path.exists(os.path.join(self.mod_dir, 'a.ko.gz')))
+        with open(os.path.join(self.mod_dir, 'b.ko'), 'rb') as fp:
+            self.assertEqual(fp.read(), self.modules['b.ko'])
+
+    def test_no_compression(self):
+        stats = process_modules(self.base, 'none')
+        self.assertEqual(stats["modules"], 0)
+        for name, data in self.modules.items():
+            with open(os.path.join(self.mod_dir, name), 'rb') as fp:
+                self.assertEqual(fp.read(), data)
+
+class ModuleInstallTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.release = '5.0.0'
+        self.calls = []
+
+        # Only what make_module_dir and _install_module use of a build.
+        self.build = KdevBuild.__new__(KdevBuild)
+        self.build.iout = os.path.join(self.root, 'out', 'images')
+        self.build.kparams = {"modules": {"strip": True}, "compiler-options": {"CC": "aarch64-linux-gnu-gcc"}}
+        self.build.logger = logging.getLogger(__name__)
+        self.build.make_kernel = self._make_kernel
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    # Installs a signed module like Kbuild's modules_install would.
+    def _make_kernel(self, args, name):
+        self.calls.append(args)
+        if 'modules_install' in args:
+            params = dict([arg.split('=', 1) for arg in args if '=' in arg])
+            dst = os.path.join(params["INSTALL_MOD_PATH"], 'lib/modules', self.release, params["INSTALL_MOD_DIR"])
+            os.makedirs(dst)
+            with open(os.path.join(dst, 'foo.ko'), 'wb') as fp:
+                fp.write(b'\x7fELF' + SIGNATURE)
+        return 0, []
+
+    def test_signed_install(self):
+        path = os.path.join('drivers', 'foo')
+        self.assertTrue(self.build.make_module_dir(path))
+        self.assertEqual(self.calls[0], ['M=%s' % path, 'modules'])
+
+        # Signing and stripping are left to modules_install, depmod to the caller.
+        args = self.calls[1]
+        self.assertTrue('modules_install' in args)
+        self.assertTrue('DEPMOD=true' in args)
+        self.assertTrue('INSTALL_MOD_STRIP=1' in args)
+        self.assertTrue('STRIP=aarch64-linux-gnu-strip' in args)
+
+        rel = os.path.join(path, 'foo.ko')
+        staged = os.path.join(self.build._modules_staging(path), 'lib/modules', self.release, 'kernel', rel)
+        self.assertTrue(os.path.exists(staged))
+
+        tree = os.path.join(self.root, 'rootfs')
+        old = os.path.join(tree, 'lib/modules', self.release, 'kernel', rel)
+        os.makedirs(os.path.dirname(old))
+        with open(old + '.xz', 'wb') as fp:
+            fp.write(b'old')
+
+        installed = self.build._install_module(staged, rel, self.release, [tree])
+        self.assertEqual(installed, [old])
+        self.assertFalse(os.path.exists(old + '.xz'))
+        with open(old, 'rb') as fp:
+            self.assertTrue(fp.read().endswith(SIGNATURE))
+
+    def test_no_strip(self):
+        self.build.kparams["modules"]["strip"] = False
+        self.assertTrue(self.build.make_module_dir('drivers'))
+        self.assertFalse('INSTALL_MOD_STRIP=1' in self.calls[1])
+
+if __name__ == '__main__':
+    unittest.main()
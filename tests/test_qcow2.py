@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# qcow2 export tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+
+import os
+import zlib
+import struct
+import shutil
+import tempfile
+import unittest
+from kdev._qcow2 import export_qcow2, HEADER, QCOW_MAGIC, QCOW_OFLAG_COPIED, QCOW_OFLAG_COMPRESSED, SECTOR_SIZE
+
+def read_qcow2(path):
+    with open(path, 'rb') as fp:
+        (magic, version, _, _, cluster_bits, size, _, l1_size, l1_offset, refcount_offset, refcount_clusters,
+         _, _) = HEADER.unpack(fp.read(HEADER.size))
+        assert magic == QCOW_MAGIC and version == 2, "bad header"
+        cluster_size = 1 << cluster_bits
+        l2_entries = cluster_size // 8
+        csize_shift = 62 - (cluster_bits - 8)
+        offset_mask = (1 << 62) - 1
+
+        fp.seek(l1_offset)
+        l1 = struct.unpack('>%dQ' % l1_size, fp.read(l1_size * 8))
+        clusters = {}
+        for l1_index, l1_entry in enumerate(l1):
+            if l1_entry == 0:
+                continue
+            assert l1_entry & QCOW_OFLAG_COPIED, "L1 entry without copied flag"
+            fp.seek(l1_entry & offset_mask)
+            l2 = struct.unpack('>%dQ' % l2_entries, fp.read(cluster_size))
+            for l2_index, entry in enumerate(l2):
+                if entry == 0:
+                    continue
+                index = l1_index * l2_entries + l2_index
+                if entry & QCOW_OFLAG_COMPRESSED:
+                    offset = entry & ((1 << csize_shift) - 1)
+                    sectors = ((entry & offset_mask) >> csize_shift) + 1
+                    fp.seek(offset)
+                    data = fp.read(sectors * SECTOR_SIZE - offset % SECTOR_SIZE)
+                    # qemu inflates exactly one cluster out of the sectors.
+                    clusters[index] = zlib.decompressobj(-12).decompress(data, cluster_size)
+                    assert len(clusters[index]) == cluster_size, "compressed cluster %d is short" % index
+                else:
+                    assert entry & QCOW_OFLAG_COPIED, "raw cluster without copied flag"
+                    fp.seek(entry & offset_mask)
+                    clusters[index] = fp.read(cluster_size)
+
+        fp.seek(refcount_offset)
+        table = [entry for entry in struct.unpack('>%dQ' % (refcount_clusters * cluster_size // 8),
+                                                  fp.read(refcount_clusters * cluster_size)) if entry != 0]
+        refs = {}
+        for block, offset in enumerate(table):
+            fp.seek(offset)
+            for index, count in enumerate(struct.unpack('>%dH' % (cluster_size // 2), fp.read(cluster_size))):
+                if count != 0:
+                    refs[block * cluster_size // 2 + index] = count
+
+    return size, cluster_size, clusters, refs
+
+class Qcow2Test(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.image = os.path.join(self.root, 'disk.img')
+        self.export = os.path.join(self.root, 'disk.qcow2')
+        self.cluster = 1 << 16
+
+        # Random, zero, compressible and a partial last cluster.
+        self.size = 40 * self.cluster + 1000
+        with open(self.image, 'wb') as fp:
+            fp.truncate(self.size)
+            fp.write(os.urandom(self.cluster + 10))
+            fp.seek(5 * self.cluster)
+            fp.write(b'kdev ' * 30000)
+            fp.seek(40 * self.cluster)
+            fp.write(b'end' * 300)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _check(self):
+        size, cluster_size, clusters, refs = read_qcow2(self.export)
+        self.assertEqual(size, self.size)
+        self.assertEqual(cluster_size, self.cluster)
+
+        with open(self.image, 'rb') as fp:
+            data = fp.read()
+        data += b'\0' * (-len(data) % cluster_size)
+        for index in range(len(data) // cluster_size):
+            expected = data[index * cluster_size:(index + 1) * cluster_size]
+            if index in clusters:
+                self.assertEqual(clusters[index], expected)
+            else:
+                self.assertEqual(expected, b'\0' * cluster_size)
+
+        # Every cluster of the file is in use.
+        used = (os.path.getsize(self.export) + cluster_size - 1) // cluster_size
+        self.assertEqual(sorted(refs), list(range(used)))
+        return clusters
+
+    def test_export(self):
+        stats = export_qcow2(self.image, self.export, threads=4)
+        # Holes are only skipped where SEEK_DATA is there.
+        self.assertEqual(stats["clusters"] - stats["zero"], 6)
+        self.assertEqual(stats["raw"], 1)
+        clusters = self._check()
+        self.assertIn(40, clusters)
+
+    def test_reuse(self):
+        self.assertIsNotNone(export_qcow2(self.image, self.export, threads=4))
+        with open(self.image, 'r+b') as fp:
+            fp.seek(5 * self.cluster)
+            fp.write(b'KDEV')
+        stats = export_qcow2(self.image, self.export, threads=4)
+        self.assertEqual(stats["compressed"], 1)
+        self.assertGreater(stats["reused"], 0)
+        self._check()
+
+if __name__ == '__main__':
+    unittest.main()
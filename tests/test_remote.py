@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# remote build worker tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+import threading
+from kdev._remote import RemoteWorker, RemoteExecutor, RemoteError, _Channel, path_map, translate, PROTOCOL_VERSION
+
+class PathMapTest(unittest.TestCase):
+    def test_translate(self):
+        pairs = path_map({"/home/u/kernel": "/ws/kernel", "/home/u/kernel/out": "/ws/obj"})
+        data = b'srctree := /home/u/kernel\nobj := /home/u/kernel/out/drivers\nother := /home/u/kernel2\n'
+        self.assertEqual(translate(data, pairs),
+                         b'srctree := /ws/kernel\nobj := /ws/obj/drivers\nother := /home/u/kernel2\n')
+
+    def test_binary_untouched(self):
+        pairs = path_map({"/home/u/kernel": "/ws/kernel"})
+        data = b'\x7fELF\0\0/home/u/kernel/vmlinux'
+        self.assertEqual(translate(data, pairs), data)
+        self.assertEqual(translate(b'/home/u/kernel', []), b'/home/u/kernel')
+
+class RemoteWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.worker = RemoteWorker('unix:' + os.path.join(self.root, 'sock'), os.path.join(self.root, 'worker'),
+                                   token='secret', jobs=1)
+        for name in ['blobs', 'ws', 'state']:
+            os.makedirs(os.path.join(self.worker.work_dir, name))
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.executor.close()
+            self.thread.join(10)
+        shutil.rmtree(self.root)
+
+    # The worker side of a socket pair, served like a forked connection.
+    def _connect(self, token):
+        client, server = socket.socketpair()
+        self.thread = threading.Thread(target=self.worker.handle, args=(server,))
+        self.thread.start()
+        self.executor = RemoteExecutor('unix:none', os.path.join(self.root, 'state'), token=token)
+        self.executor.chan = _Channel(client)
+        reply = self.executor._request({"op": "hello", "version": PROTOCOL_VERSION, "token": token})
+        if reply is not None:
+            self.executor.root = reply["root"]
+        return reply
+
+    def test_bad_token(self):
+        self.assertEqual(self._connect('wrong'), None)
+        # The worker hangs up on a client which failed the hello.
+        self.thread.join(10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertRaises(EOFError, self.executor.chan.recv)
+
+    def test_tcp_needs_token(self):
+        worker = RemoteWorker('localhost:0', os.path.join(self.root, 'tcp'))
+        self.assertFalse(worker.serve())
+
+    def test_path_escape(self):
+        ws = os.path.join(self.root, 'ws')
+        os.makedirs(ws)
+        os.symlink('/etc', os.path.join(ws, 'etc'))
+        self.assertEqual(self.worker._path(ws, 'a/b'), os.path.join(ws, 'a/b'))
+        for rpath in ['../x', '/etc/passwd', 'a/../../x', 'etc/passwd']:
+            self.assertRaises(RemoteError, self.worker._path, ws, rpath)
+        for name in ['/abs', 'a/../b', 'a//b']:
+            self.assertRaises(RemoteError, self.worker._workspace, name)
+
+    def test_sync_translates_paths(self):
+        reply = self._connect('secret')
+        self.assertEqual(reply["root"], os.path.join(self.worker.work_dir, 'ws'))
+
+        local = os.path.join(self.root, 'obj')
+        os.makedirs(os.path.join(local, 'include'))
+        with open(os.path.join(local, 'Makefile'), 'wb') as fp:
+            fp.write(('include %s/Makefile\n' % local).encode('utf-8'))
+        with open(os.path.join(local, 'include', 'blob.o'), 'wb') as fp:
+            fp.write(b'\0' + local.encode('utf-8'))
+        os.symlink(os.path.join(local, 'include'), os.path.join(local, 'inc'))
+
+        remote = self.executor.path('obj')
+        path = self.executor.sync_up(local, 'obj', paths={local: remote})
+        self.assertEqual(path, remote)
+        with open(os.path.join(remote, 'Makefile'), 'rb') as fp:
+            self.assertEqual(fp.read(), ('include %s/Makefile\n' % remote).encode('utf-8'))
+        with open(os.path.join(remote, 'include', 'blob.o'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'\0' + local.encode('utf-8'))
+        self.assertEqual(os.readlink(os.path.join(remote, 'inc')), os.path.join(remote, 'include'))
+
+        # Outputs written on the worker come back with the local paths.
+        with open(os.path.join(remote, 'auto.conf'), 'wb') as fp:
+            fp.write(('O=%s\n' % remote).encode('utf-8'))
+        self.assertTrue(self.executor.sync_down('obj', local, paths={remote: local}))
+        with open(os.path.join(local, 'auto.conf'), 'rb') as fp:
+            self.assertEqual(fp.read(), ('O=%s\n' % local).encode('utf-8'))
+        with open(os.path.join(local, 'Makefile'), 'rb') as fp:
+            self.assertEqual(fp.read(), ('include %s/Makefile\n' % local).encode('utf-8'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# stage scheduler tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from kdev._scheduler import StageScheduler
+
+class StageSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.log = os.path.join(self.root, 'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    # Stages run in forked workers, so they leave their trace in a file.
+    def _stage(self, name, status=True, delay=0.0):
+        def func():
+            time.sleep(delay)
+            with open(self.log, 'a') as fp:
+                fp.write(name + '\n')
+            if status is None:
+                raise ValueError(name)
+            return status
+        return func
+
+    def _ran(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as fp:
+            return fp.read().split()
+
+    def test_dependency_order(self):
+        sched = StageScheduler(jobs=4)
+        sched.add_stage('c', self._stage('c'), deps=['a', 'b'])
+        sched.add_stage('b', self._stage('b'), deps=['a'])
+        sched.add_stage('a', self._stage('a', delay=0.2))
+        # Dependencies outside of this run are already met.
+        sched.add_stage('d', self._stage('d', delay=0.4), deps=['kernel_build'])
+
+        self.assertTrue(sched.run())
+        ran = self._ran()
+        self.assertEqual(sorted(ran), ['a', 'b', 'c', 'd'])
+        self.assertTrue(ran.index('a') < ran.index('b') < ran.index('c'))
+        for name, deps in [('b', ['a']), ('c', ['a', 'b'])]:
+            for dep in deps:
+                self.assertTrue(sched.stages[name].start >= sched.stages[dep].end)
+        for stage in sched.stages.values():
+            self.assertTrue(stage.status)
+
+    def test_failure_skips_dependents(self):
+        sched = StageScheduler(jobs=2, keep_going=True)
+        sched.add_stage('a', self._stage('a', status=False))
+        sched.add_stage('b', self._stage('b'), deps=['a'])
+        sched.add_stage('c', self._stage('c'), deps=['b'])
+        sched.add_stage('d', self._stage('d'))
+
+        self.assertFalse(sched.run())
+        self.assertEqual(sorted(self._ran()), ['a', 'd'])
+        self.assertEqual([sched.stages[name].status for name in 'abcd'], [False, False, False, True])
+
+    def test_failure_stops_new_stages(self):
+        sched = StageScheduler(jobs=1)
+        sched.add_stage('a', self._stage('a', status=None))
+        sched.add_stage('b', self._stage('b'), deps=['a'])
+        sched.add_stage('c', self._stage('c'), deps=['a'])
+
+        # A raising stage fails like one returning False.
+        self.assertFalse(sched.run())
+        self.assertEqual(self._ran(), ['a'])
+        self.assertFalse(sched.stages['a'].status)
+
+    def test_cycle(self):
+        sched = StageScheduler(jobs=2)
+        sched.add_stage('a', self._stage('a'), deps=['b'])
+        sched.add_stage('b', self._stage('b'), deps=['a'])
+
+        self.assertFalse(sched.run())
+        self.assertEqual(self._ran(), [])
+
+    def test_duplicate_stage(self):
+        sched = StageScheduler(jobs=1)
+        sched.add_stage('a', self._stage('a'))
+        self.assertRaises(AttributeError, sched.add_stage, 'a', self._stage('a'))
+
+if __name__ == '__main__':
+    unittest.main()
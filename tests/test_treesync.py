@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# tree sync tests
+#
+# Copyright (C) 2019 Sathya Kuppuswamy
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# @Author  : Sathya Kupppuswamy(sathyaosid@gmail.com)
+# @History :
+#            @v0.0 - Initial update
+# @TODO    :
+#
+#
+
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+import kdev._treesync as treesync
+from kdev._treesync import TreeSync, clone_file
+
+class _NoClone(object):
+    # fcntl without FICLONE support, like ext4 or tmpfs.
+    def ioctl(self, fd, request, arg):
+        raise IOError(errno.EOPNOTSUPP, "no reflink")
+
+def _no_copy_range(*args):
+    raise OSError(errno.EXDEV, "cross device")
+
+class TreeSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='kdev-test-')
+        self.src = os.path.join(self.root, 'src')
+        self.dst = os.path.join(self.root, 'dst')
+        os.makedirs(os.path.join(self.src, 'etc', 'init.d'))
+        self._write('etc/passwd', b'root:x:0:0::/root:/bin/sh\n')
+        self._write('etc/init.d/rcS', os.urandom(300000))
+        os.symlink('init.d/rcS', os.path.join(self.src, 'etc', 'rc'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, rpath, data, root=None):
+        with open(os.path.join(root or self.src, rpath), 'wb') as fp:
+            fp.write(data)
+
+    def _read(self, root, rpath):
+        with open(os.path.join(root, rpath), 'rb') as fp:
+            return fp.read()
+
+    def test_clone_fallback(self):
+        src = os.path.join(self.src, 'etc/init.d/rcS')
+        dst = os.path.join(self.root, 'copy')
+        fcntl = treesync.fcntl
+        copy_range = getattr(os, 'copy_file_range', None)
+        treesync.fcntl = _NoClone()
+        if copy_range is not None:
+            os.copy_file_range = _no_copy_range
+        try:
+            self.assertEqual(clone_file(src, dst), 'copy')
+        finally:
+            treesync.fcntl = fcntl
+            if copy_range is not None:
+                os.copy_file_range = copy_range
+        self.assertEqual(self._read(self.root, 'copy'), self._read(self.src, 'etc/init.d/rcS'))
+
+    def test_clone(self):
+        dst = os.path.join(self.root, 'copy')
+        self.assertTrue(clone_file(os.path.join(self.src, 'etc/passwd'), dst) in ['reflink', 'copy'])
+        self.assertEqual(self._read(self.root, 'copy'), self._read(self.src, 'etc/passwd'))
+
+    def test_sync(self):
+        tsync = TreeSync()
+        self.assertTrue(tsync.sync(self.src, self.dst))
+        self.assertEqual(tsync.stats["same"], 0)
+        self.assertEqual(tsync.stats["reflink"] + tsync.stats["copy"], 3)
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'etc/rc')), 'init.d/rcS')
+        self.assertEqual(self._read(self.dst, 'etc/init.d/rcS'), self._read(self.src, 'etc/init.d/rcS'))
+
+        # Same size, new content and mtime is copied again, a touched file is not.
+        self._write('etc/passwd', b'ROOT:x:0:0::/root:/bin/sh\n')
+        os.utime(os.path.join(self.src, 'etc/init.d/rcS'), (1000, 1000))
+        tsync = TreeSync()
+        tsync.sync(self.src, self.dst)
+        self.assertEqual(tsync.stats["same"], 2)
+        self.assertEqual(tsync.stats["bytes"], len(b'ROOT:x:0:0::/root:/bin/sh\n'))
+        self.assertEqual(self._read(self.dst, 'etc/passwd'), b'ROOT:x:0:0::/root:/bin/sh\n')
+        self.assertEqual(os.stat(os.path.join(self.dst, 'etc/init.d/rcS')).st_mtime, 1000)
+
+    def test_hardlink_and_prune(self):
+        self._write('stale', b'old', root=self.root)
+        os.makedirs(self.dst)
+        shutil.move(os.path.join(self.root, 'stale'), os.path.join(self.dst, 'stale'))
+
+        tsync = TreeSync(hardlink=True)
+        tsync.sync(self.src, self.dst)
+        self.assertEqual(tsync.stats["hardlink"], 2)
+        self.assertEqual(os.stat(os.path.join(self.dst, 'etc/passwd')).st_ino,
+                         os.stat(os.path.join(self.src, 'etc/passwd')).st_ino)
+
+        tsync.prune(self.dst)
+        self.assertEqual(tsync.stats["removed"], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'stale')))
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'etc/passwd')))
+
+if __name__ == '__main__':
+    unittest.main()